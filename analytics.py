@@ -0,0 +1,277 @@
+"""
+analytics.py : in-memory columnar statistics on movies and play
+
+Keeps numpy columns of movies (id, year, duration, id_director) and of the
+play edges (id_movie, id_actor), loaded on first use, and answers the
+/analytics routes with vectorized grouped aggregates, percentiles,
+histograms and career spans, without a database round trip.
+
+crud calls movie_changed / movie_removed / cast_changed / star_removed after
+its commits so the columns follow the writes; bulk loads drop them
+(reset) and they are reloaded on next use, as when the catalog version
+shows a write of another worker (versions.py).
+
+numpy is optional: without it available() is False and the /analytics
+routes answer 503, the other stats routes are unchanged. It is imported
+by the first available() call, not with the app.
+"""
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import models, versions
+
+np = None
+
+PERCENTILES = (50, 90, 99)
+NO_DIRECTOR = -1
+
+
+def available() -> bool:
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:  # optional, /analytics routes disabled
+            return False
+        np = numpy
+    return True
+
+
+def _value(x) -> Optional[float]:
+    """ numpy scalar to json: None for nan, int when integral """
+    x = float(x)
+    if x != x:
+        return None
+    return int(x) if x.is_integer() else round(x, 2)
+
+
+def _group_starts(sorted_keys):
+    """ index of the first row of each run of equal keys """
+    return np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+
+
+def _rows(groups: Dict, selected, key_name: str) -> List[Dict]:
+    """ json rows of the selected groups """
+    names = [name for name in groups if name != "key"]
+    columns = [groups["key"][selected].tolist()] + [[_value(x) for x in groups[name][selected]] for name in names]
+    return [dict(zip([key_name] + names, values)) for values in zip(*columns)]
+
+
+class Columns:
+
+    def __init__(self, movies: List[tuple], play: List[tuple]):
+        movies = sorted(movies)
+        self.id = np.array([row[0] for row in movies], dtype=np.int64)
+        self.year = np.array([row[1] for row in movies], dtype=np.int64)
+        self.duration = np.array([np.nan if row[2] is None else row[2] for row in movies], dtype=np.float64)
+        self.director = np.array([NO_DIRECTOR if row[3] is None else row[3] for row in movies], dtype=np.int64)
+        self.play_movie = np.array([row[0] for row in play], dtype=np.int64)
+        self.play_actor = np.array([row[1] for row in play], dtype=np.int64)
+        self._careers = None
+
+    # updates
+
+    def upsert_movie(self, movie_id: int, year: int, duration: Optional[int], director: Optional[int]):
+        i = int(np.searchsorted(self.id, movie_id))
+        values = (year, np.nan if duration is None else duration, NO_DIRECTOR if director is None else director)
+        if i < len(self.id) and self.id[i] == movie_id:
+            self.year[i], self.duration[i], self.director[i] = values
+        else:
+            self.id = np.insert(self.id, i, movie_id)
+            self.year = np.insert(self.year, i, values[0])
+            self.duration = np.insert(self.duration, i, values[1])
+            self.director = np.insert(self.director, i, values[2])
+        self._careers = None
+
+    def remove_movie(self, movie_id: int):
+        keep = self.id != movie_id
+        self.id, self.year, self.duration, self.director = (
+            self.id[keep], self.year[keep], self.duration[keep], self.director[keep])
+        self.set_cast(movie_id, [])
+
+    def set_cast(self, movie_id: int, actors_id: Iterable[int]):
+        keep = self.play_movie != movie_id
+        actors_id = np.array(sorted(set(actors_id)), dtype=np.int64)
+        self.play_movie = np.concatenate([self.play_movie[keep], np.full(len(actors_id), movie_id, dtype=np.int64)])
+        self.play_actor = np.concatenate([self.play_actor[keep], actors_id])
+        self._careers = None
+
+    def remove_star(self, star_id: int):
+        keep = self.play_actor != star_id
+        self.play_movie, self.play_actor = self.play_movie[keep], self.play_actor[keep]
+        self.director[self.director == star_id] = NO_DIRECTOR
+        self._careers = None
+
+    # queries
+
+    def year_mask(self, year_min: Optional[int], year_max: Optional[int]):
+        mask = np.ones(len(self.year), dtype=bool)
+        if year_min is not None:
+            mask &= self.year >= year_min
+        if year_max is not None:
+            mask &= self.year <= year_max
+        return mask
+
+    def by_year(self, year_min: Optional[int] = None, year_max: Optional[int] = None) -> List[Dict]:
+        """ per year: movie count and duration min / max / mean / percentiles """
+        mask = self.year_mask(year_min, year_max)
+        groups = self._grouped_durations(self.year[mask], self.duration[mask])
+        return _rows(groups, np.arange(len(groups["key"])), "year")
+
+    def by_director(self, min_count: int = 1, limit: int = 100) -> List[Dict]:
+        """ per director: movie count, first / last year and duration stats, most movies first """
+        mask = self.director != NO_DIRECTOR
+        groups = self._grouped_durations(self.director[mask], self.duration[mask], self.year[mask])
+        selected = np.flatnonzero(groups["count_movies"] >= min_count)
+        selected = selected[np.lexsort((groups["key"][selected], -groups["count_movies"][selected]))][:limit]
+        return _rows(groups, selected, "id_director")
+
+    @staticmethod
+    def _grouped_durations(keys, durations, years=None) -> Dict:
+        """ column per aggregate, one row per key (every column empty without keys);
+            percentiles interpolated like np.percentile
+        """
+        # by key then duration, nan last inside a key
+        order = np.lexsort((durations, keys))
+        keys, durations = keys[order], durations[order]
+        starts = _group_starts(keys) if len(keys) else np.zeros(0, dtype=np.int64)
+        known = ~np.isnan(durations)
+        groups = {
+            "key": keys[starts],
+            "count_movies": np.diff(np.r_[starts, len(keys)]),
+            "min_duration": np.fmin.reduceat(durations, starts),
+            "max_duration": np.fmax.reduceat(durations, starts),
+        }
+        count_duration = np.add.reduceat(known.astype(np.int64), starts)
+        total = np.add.reduceat(np.where(known, durations, 0), starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            groups["mean_duration"] = total / count_duration
+        last = np.maximum(count_duration - 1, 0)
+        for p in PERCENTILES:
+            rank = last * p / 100
+            low, frac = np.floor(rank).astype(np.int64), rank % 1
+            high = np.minimum(low + 1, last)
+            value = durations[starts + low] * (1 - frac) + durations[starts + high] * frac
+            groups["p{}_duration".format(p)] = np.where(count_duration > 0, value, np.nan)
+        if years is not None:
+            years = years[order]
+            groups["first_year"] = np.minimum.reduceat(years, starts)
+            groups["last_year"] = np.maximum.reduceat(years, starts)
+        return groups
+
+    def durations(self, bins: int = 20, year_min: Optional[int] = None, year_max: Optional[int] = None) -> Dict:
+        """ histogram and percentiles of the known durations """
+        durations = self.duration[self.year_mask(year_min, year_max)]
+        durations = durations[~np.isnan(durations)]
+        if len(durations) == 0:
+            return {"count": 0, "edges": [], "counts": [], "percentiles": {}}
+        counts, edges = np.histogram(durations, bins=bins)
+        return {
+            "count": int(len(durations)),
+            "mean": _value(durations.mean()),
+            "std": _value(durations.std()),
+            "edges": [_value(edge) for edge in edges],
+            "counts": counts.tolist(),
+            "percentiles": {"p{}".format(p): _value(v) for p, v in zip(PERCENTILES, np.percentile(durations, PERCENTILES))},
+        }
+
+    def _actor_groups(self):
+        """ (actor id, movie count, first year, last year) columns, kept until the next update """
+        if self._careers is None:
+            position = np.searchsorted(self.id, self.play_movie)
+            position[position == len(self.id)] = 0
+            known = self.id[position] == self.play_movie if len(self.id) else np.zeros(len(position), dtype=bool)
+            actors, years = self.play_actor[known], self.year[position[known]]
+            if len(actors) == 0:
+                empty = np.zeros(0, dtype=np.int64)
+                self._careers = (empty, empty, empty, empty)
+            else:
+                order = np.argsort(actors, kind="stable")
+                actors, years = actors[order], years[order]
+                starts = _group_starts(actors)
+                self._careers = (actors[starts], np.diff(np.r_[starts, len(actors)]),
+                                 np.minimum.reduceat(years, starts), np.maximum.reduceat(years, starts))
+        return self._careers
+
+    def careers(self, min_count: int = 1, limit: int = 20, sort: str = "span") -> Dict:
+        """ per actor first / last year of play, span in years and movie count
+            summary over the actors with at least min_count movies, top limit by span or count
+        """
+        ids, count, first, last = self._actor_groups()
+        keep = count >= min_count
+        ids, count, first, last = ids[keep], count[keep], first[keep], last[keep]
+        span = last - first
+        if len(ids) == 0:
+            return {"actors": 0, "summary": {}, "top": []}
+        rank = np.lexsort((ids, -count, -span)) if sort == "span" else np.lexsort((ids, -span, -count))
+        return {
+            "actors": int(len(ids)),
+            "summary": {
+                "mean_span": _value(span.mean()),
+                "max_span": int(span.max()),
+                "mean_count_movies": _value(count.mean()),
+                **{"p{}_span".format(p): _value(v) for p, v in zip(PERCENTILES, np.percentile(span, PERCENTILES))},
+            },
+            "top": [{"id_actor": int(ids[i]), "first_year": int(first[i]), "last_year": int(last[i]),
+                     "span": int(span[i]), "count_movies": int(count[i])} for i in rank[:limit]],
+        }
+
+
+_columns: Optional[Columns] = None
+_version = versions.Tracker()
+_lock = threading.Lock()
+
+
+def _load(db: Session) -> Columns:
+    global _columns
+    if _columns is not None and _version.stale(db):
+        _columns = None
+    if _columns is None:
+        _version.load(db)
+        movies = models.Movie.__table__
+        play = models.play_table
+        _columns = Columns(
+            db.execute(select([movies.c.id, movies.c.year, movies.c.duration, movies.c.id_director])).fetchall(),
+            db.execute(select([play.c.id_movie, play.c.id_actor])).fetchall())
+    return _columns
+
+
+def query(db: Session, name: str, **kwargs):
+    """ Columns.<name>(**kwargs), columns loaded from db on first use; under the lock
+        so that a query never sees a write half applied
+    """
+    with _lock:
+        return getattr(_load(db), name)(**kwargs)
+
+
+def _update(method: str, *args):
+    with _lock:
+        if _columns is not None:
+            getattr(_columns, method)(*args)
+
+
+def movie_changed(movie_id: int, year: int, duration: Optional[int], id_director: Optional[int]):
+    """ called by crud after a movie is created or updated, no-op while not loaded """
+    _update("upsert_movie", movie_id, year, duration, id_director)
+
+
+def movie_removed(movie_id: int):
+    _update("remove_movie", movie_id)
+
+
+def cast_changed(movie_id: int, actors_id: Iterable[int]):
+    _update("set_cast", movie_id, actors_id)
+
+
+def star_removed(star_id: int):
+    _update("remove_star", star_id)
+
+
+def reset():
+    global _columns
+    with _lock:
+        _columns = None
+        _version.reset()
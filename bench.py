@@ -0,0 +1,917 @@
+"""
+bench.py : reproducible load benchmark of the api on a local database
+
+    python bench.py seed [--scale 10]
+        recreate the tables of DATABASE_URL (sqlite, postgresql or mysql) and
+        load sql/cine_data_stars.sql and sql/cine_data_movies.sql; play is not
+        shipped, casts are drawn at random (fixed seed). --scale N adds N - 1
+        synthetic copies of every row (ids shifted, "#k" appended to titles
+        and names).
+
+    python bench.py run [--url http://127.0.0.1:8000] [--concurrency 8] [--duration 20]
+                        [--out bench_results.json] [--baseline bench_baseline.json]
+        drive every route of main.py with concurrent keep-alive clients and
+        report p50 / p95 / p99 latency and throughput per route, as json in
+        --out. Without --url, uvicorn main:app (--app) is started on the
+        DATABASE_URL database. With --baseline the results are compared to it.
+
+    python bench.py compare bench_baseline.json bench_results.json [--threshold 0.2]
+        list the routes whose p95 grew by more than threshold, exit code 1 if any.
+
+    python bench.py async [--concurrency 8] [--duration 20] [--out bench_async.json]
+        sync against async handlers: the same read mix (the movie and star
+        reads that main_async.py serves with async def routes) driven against
+        uvicorn main:app (def routes, threadpool) then main_async:app, one
+        after the other on the DATABASE_URL database; throughput and latency
+        percentiles of each, in total and per route.
+
+    python bench.py startup [--app main:app --app main_snapshot:app] [--workers 2] [--no-read]
+        cold start of each app: import time of the module in a fresh
+        interpreter, then uvicorn (preforking --workers) time until it
+        answers and until GET /ready is 200 on every worker (warm-up done,
+        see lifecycle.py); after reading the whole catalog once (not with
+        --no-read), the average memory of a worker (RssFile: shared file
+        pages, e.g. the snapshot of main_snapshot).
+
+    python bench.py partitions [--rounds 20] [--out bench_partitions.json]
+        latency of the year range and count by year queries of crud on
+        DATABASE_URL, with the tables / partitions each one reads (EXPLAIN,
+        postgresql and mysql). Run it on a database seeded with --scale 100,
+        before and after sql/pg_cine_partitions.sql or my_cine_partitions.sql.
+
+    python bench.py pages [--limit 100] [--rounds 5]
+        latency of page N of /movies/ and /stars (crud, no http) for N = 1,
+        10, 100, ... up to the last page, with skip (OFFSET) and with the
+        after cursor: OFFSET grows with N, the cursor stays flat.
+
+    python bench.py serialize [--rows 10000] [--rounds 5]
+        rows/sec of the response serialization alone, no http: ORM entities
+        through the response_model (pydantic validation + jsonable_encoder +
+        JSONResponse) against column tuples through fastjson, for movies and
+        stars; the fetch time of each is reported apart.
+
+Writes run on rows created by the benchmark itself, which are deleted
+afterwards, so the dataset is the same from one run to the next.
+POST /bulk/{table} and POST /stats/rebuild rewrite whole tables and are not
+driven (bulk.py and stats.py report their own timings): they are listed in
+not_benched of the results.
+"""
+import argparse
+import asyncio
+import datetime
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from sqlalchemy import event, func
+
+import bulk, crud, fastjson, models, pagination, schemas, snapshot, stats
+
+SEED = 1
+CAST_SIZE = (3, 10)
+MAX_ID = 2 ** 31 - 1
+SAMPLE_MODULO = 997
+
+
+
+# seed
+
+def _read(sql_dir: str, table_name: str) -> List[Dict]:
+    path = os.path.join(sql_dir, "cine_data_{}.sql".format(table_name))
+    with open(path, encoding="utf-8") as f:
+        return list(bulk.normalize(bulk.BULK_TABLES[table_name], bulk.parse_sql_inserts(f, table_name)))
+
+
+def random_casts(movies: List[Dict], stars: List[Dict], rng: random.Random) -> List[Dict]:
+    """ play rows: CAST_SIZE actors per movie, out of a pool of 2 actors per movie so that casts overlap """
+    pool = rng.sample([star["id"] for star in stars], min(len(stars), 2 * len(movies)))
+    return [{"id_movie": movie["id"], "id_actor": actor_id}
+            for movie in movies
+            for actor_id in rng.sample(pool, min(len(pool), rng.randint(*CAST_SIZE)))]
+
+
+def scale_up(table_name: str, rows: List[Dict], scale: int, offset: int):
+    """ the rows then scale - 1 copies with ids shifted by k * offset """
+    for k in range(scale):
+        shift = k * offset
+        suffix = " #{}".format(k) if k else ""
+        for row in rows:
+            row = dict(row)
+            if table_name == "stars":
+                row["id"] += shift
+                row["name"] += suffix
+            elif table_name == "movies":
+                row["id"] += shift
+                row["title"] += suffix
+                if row.get("id_director") is not None:
+                    row["id_director"] += shift
+            else:
+                row["id_movie"] += shift
+                row["id_actor"] += shift
+            yield row
+
+
+def seed(db, scale: int = 1, sql_dir: str = "sql") -> List[dict]:
+    """ drop / create the tables and load the dataset, return a rows/sec report per table """
+    engine = db.get_bind()
+    models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    rows = {"stars": _read(sql_dir, "stars"), "movies": _read(sql_dir, "movies")}
+    # a director missing from the stars dump would break the foreign key
+    star_ids = {star["id"] for star in rows["stars"]}
+    for movie in rows["movies"]:
+        if movie.get("id_director") not in star_ids:
+            movie["id_director"] = None
+    if os.path.exists(os.path.join(sql_dir, "cine_data_play.sql")):
+        rows["play"] = _read(sql_dir, "play")
+    else:
+        rows["play"] = random_casts(rows["movies"], rows["stars"], random.Random(SEED))
+    offset = max(row["id"] for table_name in ("stars", "movies") for row in rows[table_name]) + 1
+    if scale * offset > MAX_ID:
+        raise ValueError("scale {} overflows the integer ids (max {})".format(scale, MAX_ID // offset))
+    reports = []
+    for table_name in bulk.BULK_TABLES:
+        start = time.perf_counter()
+        count = 0
+        for batch in bulk.batches(scale_up(table_name, rows[table_name], scale, offset)):
+            count += bulk.load_batch(db, table_name, batch)
+        reports.append(bulk.report(table_name, count, time.perf_counter() - start))
+    bulk.after_load(db, bulk.BULK_TABLES)
+    return reports
+
+
+# load generation
+
+class Client:
+    """ one keep-alive connection, records (route, status, seconds) of every request """
+
+    def __init__(self, url: str, results: List[Tuple[str, int, float]]):
+        parts = urllib.parse.urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        self.results = results
+        self.recording = True
+
+    def request(self, route: str, path: str, params: Optional[dict] = None, body=None):
+        """ route: "METHOD /template" as in main.py, returns (status, headers, decoded json or None) """
+        method = route.split(" ", 1)[0]
+        if params:
+            path += "?" + urllib.parse.urlencode(params, doseq=True)
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            content = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            content, status, response = b"", 599, None
+        if self.recording:
+            self.results.append((route, status, time.perf_counter() - start))
+        value = None
+        if content and response is not None and response.getheader("Content-Type", "").startswith("application/json"):
+            value = json.loads(content)
+        return status, response, value
+
+
+class Dataset:
+    """ sample of existing rows the scenarios draw their parameters from,
+        the same from one run to the next: spread over the ids by id % SAMPLE_MODULO
+    """
+
+    def __init__(self, db, size: int = 500):
+        self.movies = db.query(models.Movie.id, models.Movie.title, models.Movie.year, models.Movie.duration) \
+                .order_by(models.Movie.id % SAMPLE_MODULO, models.Movie.id).limit(size).all()
+        self.stars = db.query(models.Star.id, models.Star.name, models.Star.birthdate) \
+                .order_by(models.Star.id % SAMPLE_MODULO, models.Star.id).limit(size).all()
+        play = models.play_table
+        self.actors = [row[0] for row in db.query(play.c.id_actor)
+                       .order_by(play.c.id_actor % SAMPLE_MODULO, play.c.id_movie).limit(size)]
+        if not self.movies or not self.stars or not self.actors:
+            raise ValueError("empty database, run python bench.py seed first")
+
+    @staticmethod
+    def word(text: str) -> str:
+        """ longest word of a title or a name """
+        return max(text.split(), key=len)
+
+
+def _movie_reads(c: Client, rng: random.Random, data: Dataset):
+    movie = rng.choice(data.movies)
+    c.request("GET /movies/by_id/{movie_id}", "/movies/by_id/{}".format(movie.id))
+    c.request("GET /director/by_id_movie/{idMovie}", "/director/by_id_movie/{}".format(movie.id))
+    c.request("GET /movie/by_title", "/movie/by_title", {"searchTitle": movie.title})
+    c.request("GET /movie/by_partTitle", "/movie/by_partTitle", {"searchTitle": data.word(movie.title)})
+    c.request("GET /movies/by_title_year", "/movies/by_title_year", {"t": movie.title, "y": movie.year})
+    c.request("GET /actor/by_movie_title", "/actor/by_movie_title", {"movieTitle": data.word(movie.title)})
+    c.request("GET /search/movies", "/search/movies", {"q": data.word(movie.title)[:5]})
+    ids = [other.id for other in rng.sample(data.movies, 20)]
+    c.request("POST /movies/by_ids", "/movies/by_ids", body=ids)
+    c.request("POST /movies/by_ids/detail", "/movies/by_ids/detail", body=ids)
+
+
+def _movie_lists(c: Client, rng: random.Random, data: Dataset):
+    sort = rng.choice(["id", "year"])
+    status, response, _ = c.request("GET /movies/", "/movies/", {"limit": 100, "sort": sort})
+    cursor = response.getheader("X-Next-Cursor") if response is not None else None
+    if cursor:
+        c.request("GET /movies/", "/movies/", {"limit": 100, "sort": sort, "after": cursor})
+    year = rng.choice(data.movies).year
+    c.request("GET /movies/by_range_year", "/movies/by_range_year", {"year_min": year, "year_max": year + 5})
+    c.request("GET /movies/search", "/movies/search", {"year_min": year, "year_max": year + 10,
+              "sort": rng.choice(["-year", "title", "duration"]), "limit": 50})
+    name = rng.choice(data.stars).name.split()[-1]
+    c.request("GET /movies/by_director", "/movies/by_director", {"n": name})
+    c.request("GET /movies/by_actor", "/movies/by_actor", {"n": name})
+
+
+def _star_reads(c: Client, rng: random.Random, data: Dataset):
+    star = rng.choice(data.stars)
+    c.request("GET /stars/by_id/{star_id}", "/stars/by_id/{}".format(star.id))
+    c.request("GET /stars/by_name", "/stars/by_name", {"starName": star.name})
+    c.request("GET /stars/by_partname", "/stars/by_partname", {"starName": data.word(star.name)})
+    c.request("GET /search/stars", "/search/stars", {"q": star.name[:6]})
+    year = star.birthdate.year if star.birthdate is not None else 1950
+    c.request("GET /stars/by_birthyear/{year}", "/stars/by_birthyear/{}".format(year))
+    c.request("GET /stars", "/stars", {"limit": 100, "sort": rng.choice(["id", "name"])})
+    c.request("POST /stars/by_ids", "/stars/by_ids", body=[other.id for other in rng.sample(data.stars, 20)])
+
+
+def _graph_reads(c: Client, rng: random.Random, data: Dataset):
+    c.request("GET /graph/costars/{star_id}", "/graph/costars/{}".format(rng.choice(data.actors)))
+    c.request("GET /graph/separation", "/graph/separation",
+              {"from_id": rng.choice(data.actors), "to_id": rng.choice(data.actors)})
+    c.request("GET /graph/most_connected", "/graph/most_connected")
+
+
+def _stats_reads(c: Client, rng: random.Random, data: Dataset):
+    year = rng.choice(data.movies).year
+    c.request("GET /movies/count_by_year/", "/movies/count_by_year/", {"year_min": year - 10, "year_max": year})
+    c.request("GET /movies/stat_duration/", "/movies/stat_duration/")
+    for name in ("stat_movie_by_director/", "stat_count_movie_by_actor/", "stat_first_movie_by_actor/",
+                 "stat_last_movie_by_actor/", "stat_movies"):
+        c.request("GET /stars/" + name, "/stars/" + name, {"min_count": rng.choice([2, 5, 10])})
+    c.request("GET /stats/freshness", "/stats/freshness")
+    c.request("GET /analytics/years", "/analytics/years", {"year_min": year - 10, "year_max": year})
+    c.request("GET /analytics/durations", "/analytics/durations", {"bins": 20})
+    c.request("GET /analytics/directors", "/analytics/directors", {"min_count": 2, "limit": 20})
+    c.request("GET /analytics/careers", "/analytics/careers", {"min_count": rng.choice([1, 5]),
+              "sort": rng.choice(["span", "count"])})
+
+
+def _admin_reads(c: Client, rng: random.Random, data: Dataset):
+    c.request("GET /db/pool", "/db/pool")
+    c.request("GET /cache/stats", "/cache/stats")
+    c.request("GET /metrics", "/metrics")
+    c.request("GET /writes/stats", "/writes/stats")
+    c.request("GET /health", "/health")
+    c.request("GET /ready", "/ready")
+
+
+def _exports(c: Client, rng: random.Random, data: Dataset):
+    c.request("GET /movies/all", "/movies/all")
+    c.request("GET /export/{table}", "/export/{}".format(rng.choice(["movies", "stars", "play"])),
+              {"format": rng.choice(["ndjson", "csv"])})
+
+
+def _writes(c: Client, rng: random.Random, data: Dataset):
+    """ create a star and a movie, edit them and their links, delete them """
+    _, _, star = c.request("POST /star/", "/star/", body={"name": "bench star", "birthdate": "1970-01-01"})
+    _, _, movie = c.request("POST /movie/", "/movie/", body={"title": "bench movie", "year": 2000, "duration": 90})
+    if not isinstance(star, dict) or not isinstance(movie, dict):
+        return
+    c.request("PUT /star/", "/star/", body=dict(star, name="bench star edited"))
+    c.request("PUT /movie/", "/movie/", body=dict(movie, duration=100))
+    c.request("PUT /movies/director/", "/movies/director/", {"mid": movie["id"], "sid": star["id"]})
+    c.request("POST /movies/actor/", "/movies/actor/", {"mid": movie["id"], "sid": star["id"]})
+    actors = rng.sample(data.actors, 3)
+    c.request("PUT /movies/actors/", "/movies/actors/", {"mid": movie["id"]}, body=actors + [star["id"]])
+    c.request("PUT /movies/actors/batch", "/movies/actors/batch", body=[{"mid": movie["id"], "sids": actors}])
+    c.request("DELETE /movie/{movie_id}", "/movie/{}".format(movie["id"]))
+    c.request("DELETE /star/{star_id}", "/star/{}".format(star["id"]))
+
+
+def _async_reads(c: Client, rng: random.Random, data: Dataset):
+    """ reads of the routes that main_async.py serves with async def routes """
+    movie, star = rng.choice(data.movies), rng.choice(data.stars)
+    c.request("GET /movies/by_id/{movie_id}", "/movies/by_id/{}".format(movie.id))
+    c.request("GET /director/by_id_movie/{idMovie}", "/director/by_id_movie/{}".format(movie.id))
+    c.request("GET /movie/by_title", "/movie/by_title", {"searchTitle": movie.title})
+    c.request("GET /movie/by_partTitle", "/movie/by_partTitle", {"searchTitle": data.word(movie.title)})
+    c.request("GET /movies/by_title_year", "/movies/by_title_year", {"t": movie.title, "y": movie.year})
+    c.request("GET /search/movies", "/search/movies", {"q": data.word(movie.title)[:5]})
+    c.request("GET /movies/", "/movies/", {"limit": 100, "sort": rng.choice(["id", "year"])})
+    c.request("GET /movies/by_range_year", "/movies/by_range_year", {"year_min": movie.year, "year_max": movie.year + 5})
+    c.request("GET /stars/by_id/{star_id}", "/stars/by_id/{}".format(star.id))
+    c.request("GET /stars/by_partname", "/stars/by_partname", {"starName": data.word(star.name)})
+    c.request("GET /search/stars", "/search/stars", {"q": star.name[:6]})
+    year = star.birthdate.year if star.birthdate is not None else 1950
+    c.request("GET /stars/by_birthyear/{year}", "/stars/by_birthyear/{}".format(year))
+    c.request("GET /stars", "/stars", {"limit": 100, "sort": rng.choice(["id", "name"])})
+
+
+# (scenario, weight)
+SCENARIOS: List[Tuple[Callable, int]] = [
+    (_movie_reads, 10),
+    (_movie_lists, 6),
+    (_star_reads, 8),
+    (_graph_reads, 3),
+    (_stats_reads, 3),
+    (_admin_reads, 1),
+    (_exports, 1),
+    (_writes, 2),
+]
+
+
+def _worker(url: str, data: Dataset, seed_value: int, warmup_until: float, until: float,
+            results: List[Tuple[str, int, float]], scenarios: List[Tuple[Callable, int]] = SCENARIOS):
+    rng = random.Random(seed_value)
+    client = Client(url, results)
+    scenarios, weights = zip(*scenarios)
+    client.recording = False
+    while time.perf_counter() < until:
+        client.recording = time.perf_counter() >= warmup_until
+        rng.choices(scenarios, weights)[0](client, rng, data)
+    client.connection.close()
+
+
+def percentile(values: List[float], p: float) -> float:
+    """ nearest rank, values sorted """
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def summarize(results: List[Tuple[str, int, float]], seconds: float) -> dict:
+    """ count, errors (5xx and connection errors), throughput and latency percentiles in ms """
+    def stats(rows):
+        latencies = sorted(duration for _, _, duration in rows)
+        return {
+            "requests": len(rows),
+            "errors": sum(1 for _, status, _ in rows if status >= 500),
+            "throughput": round(len(rows) / seconds, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2),
+        }
+    by_route: Dict[str, list] = {}
+    for row in results:
+        by_route.setdefault(row[0], []).append(row)
+    return {
+        "total": stats(results) if results else {},
+        "routes": {route: stats(rows) for route, rows in sorted(by_route.items())},
+    }
+
+
+def api_routes(url: str) -> List[str]:
+    """ "METHOD /path" of every route of the running api, from its openapi schema """
+    client = Client(url, [])
+    status, _, schema = client.request("GET /openapi.json", "/openapi.json")
+    client.connection.close()
+    if status != 200:
+        raise ConnectionError("no api at {} (status {})".format(url, status))
+    return sorted("{} {}".format(method.upper(), path) for path, item in schema["paths"].items() for method in item)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(app: str, port: int, workers: int = 1) -> subprocess.Popen:
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", app, "--port", str(port), "--log-level", "warning"]
+                              + (["--workers", str(workers)] if workers > 1 else []),
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    url = "http://127.0.0.1:{}".format(port)
+    deadline = time.perf_counter() + 60
+    while time.perf_counter() < deadline:
+        try:
+            api_routes(url)
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("uvicorn {} did not start".format(app))
+
+
+def _drive(url: str, data: Dataset, concurrency: int, duration: float, warmup: float,
+           scenarios: List[Tuple[Callable, int]] = SCENARIOS) -> dict:
+    """ concurrency clients running scenarios for warmup + duration seconds, summary of the last duration """
+    results: List[Tuple[str, int, float]] = []
+    start = time.perf_counter()
+    threads = [threading.Thread(target=_worker, args=(url, data, SEED + i, start + warmup, start + warmup + duration,
+                                                      results, scenarios))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(results, duration)
+
+
+def _config(db, concurrency: int, duration: float, warmup: float) -> dict:
+    return {
+        "database": db.get_bind().dialect.name,
+        "movies": db.query(func.count(models.Movie.id)).scalar(),
+        "stars": db.query(func.count(models.Star.id)).scalar(),
+        "concurrency": concurrency,
+        "duration": duration,
+        "warmup": warmup,
+        "python": platform.python_version(),
+        "machine": "{} {} cpus".format(platform.machine(), os.cpu_count()),
+    }
+
+
+def run(db, url: str, concurrency: int = 8, duration: float = 20, warmup: float = 3) -> dict:
+    data = Dataset(db)
+    routes = api_routes(url)
+    report = _drive(url, data, concurrency, duration, warmup)
+    benched = set(report["routes"])
+    report["not_benched"] = [route for route in routes if route not in benched and route != "GET /openapi.json"]
+    report["config"] = _config(db, concurrency, duration, warmup)
+    report["commit"] = _git_commit()
+    report["created"] = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+    return report
+
+
+SYNC_ASYNC_APPS = ("main:app", "main_async:app")
+
+
+def sync_async(db, port: int, concurrency: int = 8, duration: float = 20, warmup: float = 3) -> dict:
+    """ the async reads mix against the def routes of main:app then the async def routes of main_async:app,
+        each app started alone on port
+    """
+    data = Dataset(db)
+    url = "http://127.0.0.1:{}".format(port)
+    apps = {}
+    for app in SYNC_ASYNC_APPS:
+        server = start_server(app, port)
+        try:
+            apps[app] = _drive(url, data, concurrency, duration, warmup, [(_async_reads, 1)])
+        finally:
+            server.terminate()
+            server.wait()
+    return {
+        "apps": apps,
+        "config": _config(db, concurrency, duration, warmup),
+        "commit": _git_commit(),
+        "created": datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
+    }
+
+
+def _workers(pid: int) -> List[int]:
+    """ pids of the uvicorn workers of master pid, from /proc (linux): its multiprocessing
+        children except the resource tracker
+    """
+    workers = []
+    for entry in os.listdir("/proc"):
+        try:
+            with open("/proc/{}/stat".format(entry)) as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open("/proc/{}/cmdline".format(entry), "rb") as f:
+                spawned = b"spawn_main" in f.read()
+        except (OSError, ValueError, IndexError):
+            continue
+        if parent == pid and spawned:
+            workers.append(int(entry))
+    return workers
+
+
+def _read_catalog(url: str, rounds: int):
+    """ every page of movies and stars, in parallel so that each worker serves some """
+    def walk(route: str, path: str):
+        client, after = Client(url, []), None
+        while True:
+            status, response, rows = client.request(route, path, {"limit": 1000, **({"after": after} if after else {})})
+            after = response.getheader("X-Next-Cursor") if status == 200 else None
+            if after is None:
+                return
+    threads = [threading.Thread(target=walk, args=route)
+               for route in [("GET /movies/", "/movies/"), ("GET /stars", "/stars")] * rounds]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _import_time(app: str) -> float:
+    """ seconds to import the module of app in a new interpreter (interpreter start included) """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import " + app.split(":")[0]], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    return time.perf_counter() - start
+
+
+def _wait_ready(url: str, workers: int, timeout: float = 60):
+    """ until GET /ready answered 200 from workers distinct pids, one new connection per probe
+        so that the kernel hands them to every worker
+    """
+    ready, deadline = set(), time.perf_counter() + timeout
+    while len(ready) < workers:
+        if time.perf_counter() > deadline:
+            raise RuntimeError("{} of {} workers ready after {} s".format(len(ready), workers, timeout))
+        client = Client(url, [])
+        status, _, body = client.request("GET /ready", "/ready")
+        client.connection.close()
+        if status == 200:
+            ready.add(body["pid"])
+        else:
+            time.sleep(0.02)
+
+
+def startup(app: str, port: int, workers: int = 1, read: bool = True) -> dict:
+    """ cold start seconds (import, listening, all workers ready), then average memory (kB)
+        of a worker once the catalog was read
+    """
+    url = "http://127.0.0.1:{}".format(port)
+    import_time = _import_time(app)
+    start = time.perf_counter()
+    server = start_server(app, port, workers)
+    listening = time.perf_counter() - start
+    try:
+        _wait_ready(url, workers)
+        ready = time.perf_counter() - start
+        if read:
+            _read_catalog(url, max(workers, 1) * 2)
+        pids = (_workers(server.pid) if workers > 1 else []) or [server.pid]
+        memory = [snapshot.memory_usage(pid) for pid in pids]
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "app": app,
+        "import_s": round(import_time, 3),
+        "listening_s": round(listening, 3),
+        "ready_s": round(ready, 3),
+        "workers": len(memory),
+        **{name + "_kb": round(sum(m[name] or 0 for m in memory) / len(memory)) for name in ("VmRSS", "RssAnon", "RssFile")},
+    }
+
+
+# page N
+
+PAGED = {
+    "movies": (models.Movie, crud.MOVIE_SORT_KEYS, crud.get_movies),
+    "stars": (models.Star, crud.STAR_SORT_KEYS, crud.get_stars),
+}
+
+
+def _page_numbers(count: int, limit: int) -> List[int]:
+    """ 1, 10, 100, ... and the last page """
+    last = max(math.ceil(count / limit), 1)
+    numbers = [n for n in (10 ** k for k in range(len(str(last)))) if n < last]
+    return numbers + [last]
+
+
+def pages(db, limit: int = 100, rounds: int = 5) -> dict:
+    """ p50 of page N read with skip and with the cursor of page N - 1, for every sort of PAGED """
+    result = {}
+    for table_name, (model, sort_keys, get_page) in PAGED.items():
+        count = db.query(func.count(model.id)).scalar()
+        for sort, attrs in sort_keys.items():
+            for n in _page_numbers(count, limit):
+                skip = (n - 1) * limit
+                after = None
+                if skip:
+                    last = db.query(*[getattr(model, attr) for attr in attrs]) \
+                            .order_by(*[getattr(model, attr) for attr in attrs]).offset(skip - 1).first()
+                    after = pagination.encode_cursor(sort, list(last))
+                timings = {}
+                for mode, kwargs in (("offset", {"skip": skip}), ("cursor", {"after": after})):
+                    times = []
+                    for _ in range(rounds):
+                        start = time.perf_counter()
+                        rows = get_page(db, limit=limit, sort=sort, as_rows=True, **kwargs)
+                        times.append(time.perf_counter() - start)
+                    times.sort()
+                    timings[mode] = (percentile(times, 50), rows)
+                db.rollback()
+                if timings["offset"][1] != timings["cursor"][1]:
+                    raise AssertionError("{} sort {} page {}: offset and cursor pages differ".format(
+                        table_name, sort, n))
+                result.setdefault("{} sort={}".format(table_name, sort), []).append({
+                    "page": n,
+                    "rows": len(timings["cursor"][1]),
+                    "offset_ms": round(timings["offset"][0] * 1000, 3),
+                    "cursor_ms": round(timings["cursor"][0] * 1000, 3),
+                })
+    return {
+        "pages": result,
+        "config": {"database": db.get_bind().dialect.name, "limit": limit, "rounds": rounds},
+        "commit": _git_commit(),
+    }
+
+
+# serialization
+
+def _default_serialize(rows: List, schema) -> bytes:
+    """ what a route with response_model=List[schema] does with the ORM entities it returns """
+    field = create_response_field(name="Response_bench", type_=List[schema])
+    content = asyncio.run(serialize_response(field=field, response_content=rows))
+    return JSONResponse(content).body
+
+
+def _fast_serialize(rows: List, schema) -> bytes:
+    return fastjson.rows_response(rows, schema).body
+
+
+def _best_of(rounds: int, run: Callable) -> Tuple[float, object]:
+    """ shortest of rounds runs in seconds, and the result of the last one """
+    best, result = None, None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def serialization(db, rows: int = 10000, rounds: int = 5) -> dict:
+    """ fetch and serialization rows/sec of rows movies and stars, default path against fastjson """
+    tables = {
+        "movies": (lambda as_rows: crud.get_movies(db, limit=rows, as_rows=as_rows), schemas.Movie),
+        "stars": (lambda as_rows: crud.get_stars(db, limit=rows, as_rows=as_rows), schemas.Star),
+    }
+    result = {}
+    for name, (fetch, schema) in tables.items():
+        for mode, as_rows, serialize in (("default", False, _default_serialize), ("fastjson", True, _fast_serialize)):
+            fetch_seconds, fetched = _best_of(rounds, lambda: fetch(as_rows))
+            serialize_seconds, body = _best_of(rounds, lambda: serialize(fetched, schema))
+            db.rollback()
+            result["{} {}".format(name, mode)] = {
+                "rows": len(fetched),
+                "bytes": len(body),
+                "fetch_rows_per_sec": round(len(fetched) / fetch_seconds) if fetch_seconds else None,
+                "serialize_rows_per_sec": round(len(fetched) / serialize_seconds) if serialize_seconds else None,
+            }
+    return {
+        "serialization": result,
+        "config": {"database": db.get_bind().dialect.name, "rows": rows, "rounds": rounds,
+                   "orjson": fastjson.orjson is not None},
+        "commit": _git_commit(),
+    }
+
+
+# partitions
+
+YEAR_QUERIES = (
+    ("by_range_year 1990-1999", lambda db: crud.get_movies_by_range_year(db, year_min=1990, year_max=1999)),
+    ("by_range_year 1970-1999", lambda db: crud.get_movies_by_range_year(db, year_min=1970, year_max=1999)),
+    ("by_range_year >= 2010", lambda db: crud.get_movies_by_range_year(db, year_min=2010)),
+    ("by_range_year all", lambda db: crud.get_movies_by_range_year(db, year_min=0)),
+    ("count_by_year 1990-1999", lambda db: crud.get_movies_count_by_year(db, year_min=1990, year_max=1999)),
+    ("count_by_year all", lambda db: crud.get_movies_count_by_year(db)),
+)
+
+
+def _plan_relations(plan: dict) -> List[str]:
+    """ tables scanned by a postgresql json plan """
+    relations = [plan["Relation Name"]] if "Relation Name" in plan else []
+    for child in plan.get("Plans", ()):
+        relations += _plan_relations(child)
+    return relations
+
+
+def scanned(db, run: Callable) -> Optional[List[str]]:
+    """ tables (postgresql) or table:partitions (mysql) read by the statements of run(db),
+        None on the other databases
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect not in ("postgresql", "mysql"):
+        return None
+    statements = []
+    engine = db.get_bind()
+    listener = lambda conn, cursor, statement, parameters, context, executemany: statements.append((statement, parameters))
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        run(db)
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    connection, tables = db.connection(), set()
+    for statement, parameters in statements:
+        if dialect == "postgresql":
+            plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            tables.update(_plan_relations(plan[0]["Plan"]))
+        else:
+            for row in connection.exec_driver_sql("EXPLAIN " + statement, parameters).mappings():
+                tables.add("{}:{}".format(row["table"], row.get("partitions") or "-"))
+    return sorted(tables)
+
+
+def partitions(db, rounds: int = 20) -> dict:
+    """ p50 / p95 of each YEAR_QUERIES over rounds runs, rows returned and what it scanned """
+    queries = {}
+    for name, run in YEAR_QUERIES:
+        run(db)
+        times = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            rows = run(db)
+            times.append(time.perf_counter() - start)
+        db.rollback()
+        times.sort()
+        queries[name] = {
+            "rows": len(rows),
+            "p50_ms": round(percentile(times, 50) * 1000, 3),
+            "p95_ms": round(percentile(times, 95) * 1000, 3),
+            "scanned": scanned(db, run),
+        }
+    return {
+        "queries": queries,
+        "config": {
+            "database": db.get_bind().dialect.name,
+            "movies": db.query(func.count(models.Movie.id)).scalar(),
+            # count_by_year reads stat_year instead of movies once the aggregates are built
+            "stats_built": stats.is_built(db),
+            "rounds": rounds,
+        },
+        "commit": _git_commit(),
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.2) -> List[str]:
+    """ routes whose p95 latency grew by more than threshold (0.2 = +20%) or that started failing """
+    regressions = []
+    for route, new in current["routes"].items():
+        old = baseline["routes"].get(route)
+        if old is None:
+            continue
+        if new["p95_ms"] > old["p95_ms"] * (1 + threshold):
+            regressions.append("{}: p95 {} ms -> {} ms".format(route, old["p95_ms"], new["p95_ms"]))
+        if new["errors"] > old["errors"]:
+            regressions.append("{}: errors {} -> {}".format(route, old["errors"], new["errors"]))
+    return regressions
+
+
+def print_report(report: dict):
+    print("{:45} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}".format("route", "requests", "errors", "req/s", "p50 ms",
+                                                             "p95 ms", "p99 ms"))
+    for route, row in list(report["routes"].items()) + [("total", report["total"])]:
+        print("{:45} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}".format(route, row["requests"], row["errors"],
+              row["throughput"], row["p50_ms"], row["p95_ms"], row["p99_ms"]))
+    if report.get("not_benched"):
+        print("not benched:", ", ".join(report["not_benched"]))
+
+
+def print_sync_async(report: dict):
+    (sync_app, sync), (async_app, asynced) = report["apps"].items()
+    print("{:40} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format("route", "sync r/s", "async r/s", "sync p50",
+                                                             "async p50", "sync p99", "async p99"))
+    rows = [(route, sync["routes"].get(route), asynced["routes"].get(route))
+            for route in sorted(set(sync["routes"]) | set(asynced["routes"]))]
+    for route, a, b in rows + [("total", sync["total"], asynced["total"])]:
+        a, b = a or {}, b or {}
+        print("{:40} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(route, a.get("throughput", "-"),
+              b.get("throughput", "-"), a.get("p50_ms", "-"), b.get("p50_ms", "-"), a.get("p99_ms", "-"),
+              b.get("p99_ms", "-")))
+    print("sync: {}, async: {}, errors {} / {}".format(sync_app, async_app, sync["total"].get("errors"),
+                                                       asynced["total"].get("errors")))
+
+
+def _load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="api benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+    seed_parser = commands.add_parser("seed")
+    seed_parser.add_argument("--scale", type=int, default=1)
+    seed_parser.add_argument("--sql-dir", default="sql")
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--url")
+    run_parser.add_argument("--app", default="main:app")
+    run_parser.add_argument("--port", type=int, default=8765)
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--duration", type=float, default=20)
+    run_parser.add_argument("--warmup", type=float, default=3)
+    run_parser.add_argument("--out", default="bench_results.json")
+    run_parser.add_argument("--baseline")
+    run_parser.add_argument("--threshold", type=float, default=0.2)
+    async_parser = commands.add_parser("async")
+    async_parser.add_argument("--port", type=int, default=8765)
+    async_parser.add_argument("--concurrency", type=int, default=8)
+    async_parser.add_argument("--duration", type=float, default=20)
+    async_parser.add_argument("--warmup", type=float, default=3)
+    async_parser.add_argument("--out", default="bench_async.json")
+    startup_parser = commands.add_parser("startup")
+    startup_parser.add_argument("--app", action="append")
+    startup_parser.add_argument("--port", type=int, default=8765)
+    startup_parser.add_argument("--workers", type=int, default=1)
+    startup_parser.add_argument("--no-read", dest="read", action="store_false")
+    pages_parser = commands.add_parser("pages")
+    pages_parser.add_argument("--limit", type=int, default=100)
+    pages_parser.add_argument("--rounds", type=int, default=5)
+    pages_parser.add_argument("--out")
+    serialize_parser = commands.add_parser("serialize")
+    serialize_parser.add_argument("--rows", type=int, default=10000)
+    serialize_parser.add_argument("--rounds", type=int, default=5)
+    serialize_parser.add_argument("--out")
+    partitions_parser = commands.add_parser("partitions")
+    partitions_parser.add_argument("--rounds", type=int, default=20)
+    partitions_parser.add_argument("--out")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        regressions = compare(_load(args.baseline), _load(args.current), args.threshold)
+        print("\n".join(regressions) or "no regression")
+        sys.exit(1 if regressions else 0)
+    if args.command == "startup":
+        line = "{:25} {:>8} {:>11} {:>8} {:>8} {:>10} {:>11} {:>11}"
+        print(line.format("app", "import s", "listening s", "ready s", "workers", "VmRSS kB", "RssAnon kB",
+                          "RssFile kB"))
+        for app in args.app or ["main:app", "main_snapshot:app"]:
+            row = startup(app, args.port, args.workers, args.read)
+            print(line.format(app, row["import_s"], row["listening_s"], row["ready_s"], row["workers"],
+                              row["VmRSS_kb"], row["RssAnon_kb"], row["RssFile_kb"]))
+        sys.exit(0)
+
+    from database import SessionLocal
+    session = SessionLocal()
+    try:
+        if args.command == "seed":
+            for line in seed(session, args.scale, args.sql_dir):
+                print(line)
+            sys.exit(0)
+        if args.command == "pages":
+            result = pages(session, args.limit, args.rounds)
+            print("{:18} {:>8} {:>6} {:>10} {:>10}".format("list", "page", "rows", "offset ms", "cursor ms"))
+            for name, rows in result["pages"].items():
+                for row in rows:
+                    print("{:18} {:>8} {:>6} {:>10} {:>10}".format(name, row["page"], row["rows"],
+                          row["offset_ms"], row["cursor_ms"]))
+            print(result["config"])
+            if args.out:
+                with open(args.out, "w") as f:
+                    json.dump(result, f, indent=2)
+            sys.exit(0)
+        if args.command == "serialize":
+            result = serialization(session, args.rows, args.rounds)
+            print("{:18} {:>8} {:>10} {:>12} {:>16}".format("path", "rows", "bytes", "fetch rows/s",
+                                                            "serialize rows/s"))
+            for name, row in result["serialization"].items():
+                print("{:18} {:>8} {:>10} {:>12} {:>16}".format(name, row["rows"], row["bytes"],
+                      row["fetch_rows_per_sec"], row["serialize_rows_per_sec"]))
+            print(result["config"])
+            if args.out:
+                with open(args.out, "w") as f:
+                    json.dump(result, f, indent=2)
+            sys.exit(0)
+        if args.command == "async":
+            result = sync_async(session, args.port, args.concurrency, args.duration, args.warmup)
+            print_sync_async(result)
+            print(result["config"])
+            with open(args.out, "w") as f:
+                json.dump(result, f, indent=2)
+            sys.exit(0)
+        if args.command == "partitions":
+            result = partitions(session, args.rounds)
+            print("{:25} {:>8} {:>9} {:>9}  scanned".format("query", "rows", "p50 ms", "p95 ms"))
+            for name, row in result["queries"].items():
+                print("{:25} {:>8} {:>9} {:>9}  {}".format(name, row["rows"], row["p50_ms"], row["p95_ms"],
+                      ", ".join(row["scanned"]) if row["scanned"] is not None else "-"))
+            print(result["config"])
+            if args.out:
+                with open(args.out, "w") as f:
+                    json.dump(result, f, indent=2)
+            sys.exit(0)
+        server = None if args.url else start_server(args.app, args.port)
+        try:
+            result = run(session, args.url or "http://127.0.0.1:{}".format(args.port),
+                         args.concurrency, args.duration, args.warmup)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+    finally:
+        session.close()
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+    print_report(result)
+    if args.baseline:
+        regressions = compare(_load(args.baseline), result, args.threshold)
+        print("\n".join(regressions) or "no regression")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,315 @@
+"""
+bulk.py : bulk import of movies, stars and play links
+
+Rows come from ndjson, csv or the insert statements of the shipped
+sql/cine_data_*.sql files and are written in batches, one transaction per
+batch, with upsert semantics on the primary key:
+    - postgresql: COPY into a temp table then INSERT ... ON CONFLICT
+    - mysql: multi-row INSERT ... ON DUPLICATE KEY UPDATE (executemany)
+    - sqlite: INSERT ... ON CONFLICT DO UPDATE (executemany)
+Unknown columns are ignored. A nullable column missing in a row is NULL in
+a new row and left as it is in an existing one (only the columns of the
+row are updated). A row without a required column (movies title and year,
+stars name, both ids of play) is rejected with BulkError, as a row
+breaking a constraint. On postgresql the id sequences of movies and stars
+are moved past the loaded ids after each load.
+
+    python bulk.py load stars data/stars.ndjson
+    python bulk.py load-dataset [sql_dir]
+"""
+import csv
+import datetime
+import io
+import json
+import os
+import re
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from sqlalchemy import Date, Integer, SmallInteger, text
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+
+import analytics, cache, graph, models, search, stats, versions
+
+BATCH_SIZE = 5000
+
+# load order respects the foreign keys
+BULK_TABLES = {
+    "stars": models.Star.__table__,
+    "movies": models.Movie.__table__,
+    "play": models.play_table,
+}
+
+
+class BulkError(ValueError):
+    pass
+
+
+def _converter(column):
+    if isinstance(column.type, (Integer, SmallInteger)):
+        return int
+    if isinstance(column.type, Date):
+        return lambda value: value if isinstance(value, datetime.date) else datetime.date.fromisoformat(value)
+    return str
+
+
+def generated_key(table):
+    """ the single integer primary key (autoincrement) or None """
+    keys = list(table.primary_key.columns)
+    return keys[0] if len(keys) == 1 and isinstance(keys[0].type, Integer) else None
+
+
+def required_columns(table) -> List[str]:
+    """ not nullable columns, except a generated key """
+    generated = generated_key(table)
+    return [column.name for column in table.columns if not column.nullable and column is not generated]
+
+
+def normalize(table, rows: Iterable[Dict]) -> Iterator[Dict]:
+    """ keep the columns of table, convert values to the column types, '' and NULL become None """
+    converters = {column.name: _converter(column) for column in table.columns}
+    required = required_columns(table)
+    for row in rows:
+        try:
+            normalized = {
+                name: None if row.get(name) in (None, "", "NULL") else convert(row[name])
+                for name, convert in converters.items()
+                if name in row
+            }
+        except (TypeError, ValueError) as e:
+            raise BulkError("invalid row {}: {}".format(row, e)) from e
+        missing = [name for name in required if normalized.get(name) is None]
+        if missing:
+            raise BulkError("invalid row {}: {} required".format(row, ", ".join(missing)))
+        yield normalized
+
+
+def parse_ndjson(lines: Iterable[str]) -> Iterator[Dict]:
+    for line in lines:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise BulkError("invalid json line: {}".format(line[:200])) from e
+
+
+def parse_csv(lines: Iterable[str]) -> Iterator[Dict]:
+    return csv.DictReader(lines)
+
+
+_INSERT_RE = re.compile(r"insert\s+into\s+(\w+)\s*\(([^)]*)\)\s*values\s*\(", re.IGNORECASE)
+_VALUE_RE = re.compile(r"\s*(?:'((?:[^']|'')*)'|(NULL)|(-?[\d.]+))\s*([,)])", re.IGNORECASE)
+
+
+def parse_sql_inserts(lines: Iterable[str], table_name: str) -> Iterator[Dict]:
+    """ rows of the 'insert into <table> (cols) values (...);' statements of a sql dump """
+    statement = ""
+    for line in lines:
+        statement += line
+        if not statement.rstrip().endswith(";"):
+            continue
+        match = _INSERT_RE.search(statement)
+        if match and match.group(1).lower() == table_name:
+            columns = [column.strip().lower() for column in match.group(2).split(",")]
+            values, position = [], match.end()
+            while True:
+                value = _VALUE_RE.match(statement, position)
+                if value is None:
+                    raise BulkError("can't parse: {}".format(statement[:200]))
+                text, null, number, end = value.groups()
+                values.append(None if null else number if number is not None else text.replace("''", "'"))
+                position = value.end()
+                if end == ")":
+                    break
+            yield dict(zip(columns, values))
+        statement = ""
+
+
+def parse(fmt: str, lines: Iterable[str], table_name: str) -> Iterator[Dict]:
+    if fmt == "ndjson":
+        return parse_ndjson(lines)
+    if fmt == "csv":
+        return parse_csv(lines)
+    if fmt == "sql":
+        return parse_sql_inserts(lines, table_name)
+    raise BulkError("unknown format {}".format(fmt))
+
+
+def batches(rows: Iterable[Dict], size: int = BATCH_SIZE) -> Iterator[List[Dict]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _upsert_statement(db: Session, table, columns: List[str]):
+    dialect = db.get_bind().dialect.name
+    keys = [column.name for column in table.primary_key.columns]
+    updates = [name for name in columns if name not in keys]
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table)
+        if not keys or not updates:
+            return statement.prefix_with("IGNORE")
+        return statement.on_duplicate_key_update({name: statement.inserted[name] for name in updates})
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        statement = insert(table)
+        if not keys or not updates:
+            return statement.on_conflict_do_nothing()
+        return statement.on_conflict_do_update(index_elements=keys,
+            set_={name: statement.excluded[name] for name in updates})
+    return table.insert()
+
+
+def _copy_batch(db: Session, table, rows: List[Dict], columns: List[str]):
+    """ postgresql: COPY the batch into a temp table then upsert from it """
+    connection = db.connection().connection
+    staging = "bulk_" + table.name
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["\\N" if row.get(name) is None else row[name] for name in columns])
+    buffer.seek(0)
+    keys = [column.name for column in table.primary_key.columns]
+    updates = [name for name in columns if name not in keys]
+    if keys and updates:
+        conflict = "ON CONFLICT ({}) DO UPDATE SET {}".format(
+            ", ".join(keys), ", ".join("{0} = EXCLUDED.{0}".format(name) for name in updates))
+    else:
+        conflict = "ON CONFLICT DO NOTHING"
+    column_list = ", ".join(columns)
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+                       .format(staging, table.name))
+        cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(staging, column_list), buffer)
+        cursor.execute("INSERT INTO {0} ({1}) SELECT {1} FROM {2} {3}".format(table.name, column_list, staging, conflict))
+
+
+def load_batch(db: Session, table_name: str, rows: List[Dict]) -> int:
+    """ upsert one batch of normalized rows and commit it
+        one statement per set of columns: a row only writes the columns it has
+    """
+    if not rows:
+        return 0
+    table = BULK_TABLES[table_name]
+    groups: Dict[tuple, List[Dict]] = {}
+    for row in rows:
+        groups.setdefault(tuple(column.name for column in table.columns if column.name in row), []).append(row)
+    copy = db.get_bind().dialect.name == "postgresql" and db.get_bind().dialect.driver == "psycopg2"
+    try:
+        for columns, group in groups.items():
+            if copy:
+                _copy_batch(db, table, group, list(columns))
+            else:
+                db.execute(_upsert_statement(db, table, list(columns)), group)
+        db.commit()
+    except (IntegrityError, DataError) as e:
+        db.rollback()
+        raise BulkError("{} rejected by the database: {}".format(table_name, e.orig)) from e
+    return len(rows)
+
+
+def sync_sequences(db: Session, table_names: Iterable[str]):
+    """ postgresql: the explicit ids loaded don't move the serial sequence, the next
+        insert of crud would take an id already loaded
+    """
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    for table_name in table_names:
+        key = generated_key(BULK_TABLES[table_name])
+        if key is not None:
+            db.execute(text("SELECT setval(pg_get_serial_sequence(:table, :column), max({1})) FROM {0}"
+                            " HAVING max({1}) IS NOT NULL".format(table_name, key.name)),
+                       {"table": table_name, "column": key.name})
+    db.commit()
+
+
+def after_load(db: Session, table_names: Iterable[str]):
+    """ bulk writes bypass crud: rebuild what crud keeps up to date, here and,
+        through the catalog version bumped last, in the other workers
+    """
+    sync_sequences(db, table_names)
+    for table_name in table_names:
+        search.reset_index(table_name)
+    graph.reset()
+    analytics.reset()
+    cache.cache.clear()
+    if stats.is_built(db):
+        stats.rebuild(db)
+    versions.bump(db)
+
+
+def load(db: Session, table_name: str, fmt: str, lines: Iterable[str], batch_size: int = BATCH_SIZE) -> dict:
+    """ parse, normalize and upsert lines in batches, return a rows/sec report
+        on a BulkError the batches before the invalid row stay committed
+    """
+    if table_name not in BULK_TABLES:
+        raise BulkError("unknown table {}".format(table_name))
+    start = time.perf_counter()
+    count = 0
+    try:
+        for batch in batches(normalize(BULK_TABLES[table_name], parse(fmt, lines, table_name)), batch_size):
+            count += load_batch(db, table_name, batch)
+    finally:
+        if count:
+            after_load(db, [table_name])
+    return report(table_name, count, time.perf_counter() - start)
+
+
+def report(table_name: str, rows: int, seconds: float) -> dict:
+    return {
+        "table": table_name,
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds) if seconds else None,
+    }
+
+
+def format_of(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    return {".ndjson": "ndjson", ".jsonl": "ndjson", ".csv": "csv", ".sql": "sql"}.get(extension, "ndjson")
+
+
+def load_file(db: Session, table_name: str, path: str, fmt: Optional[str] = None) -> dict:
+    with open(path, encoding="utf-8", newline="") as f:
+        return load(db, table_name, fmt or format_of(path), f)
+
+
+def load_dataset(db: Session, sql_dir: str = "sql") -> List[dict]:
+    """ the shipped dump: cine_data_stars.sql, cine_data_movies.sql and cine_data_play.sql if present """
+    reports = []
+    for table_name in BULK_TABLES:
+        path = os.path.join(sql_dir, "cine_data_{}.sql".format(table_name))
+        if os.path.exists(path):
+            reports.append(load_file(db, table_name, path, "sql"))
+    return reports
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, get_engine
+    args = sys.argv[1:]
+    if args[:1] == ["load"] and len(args) in (3, 4):
+        job = lambda db: [load_file(db, args[1], args[2], args[3] if len(args) == 4 else None)]
+    elif args[:1] == ["load-dataset"] and len(args) <= 2:
+        job = lambda db: load_dataset(db, *args[1:])
+    else:
+        sys.exit("usage: python bulk.py load <stars|movies|play> <file> [ndjson|csv|sql]\n"
+                 "       python bulk.py load-dataset [sql_dir]")
+    models.Base.metadata.create_all(bind=get_engine())
+    session = SessionLocal()
+    try:
+        for line in job(session):
+            print(line)
+    finally:
+        session.close()
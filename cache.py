@@ -0,0 +1,344 @@
+"""
+cache.py : read-through response cache for the hot read routes
+
+Entries are keyed on the route path and its query parameters and hold the
+serialized json body with its ETag. Each entry carries tags naming the rows
+it was built from ("movie:12", "star:33", "stats"); the crud mutations call
+invalidate() with the tags of the rows they touch, which drops exactly the
+entries depending on them. Every invalidate() or clear() moves the
+generation of the cache: a value loaded while it moved (a write committed
+meanwhile) is returned but not stored.
+
+The in-process cache only sees the invalidations of its own worker: before
+reading it, the catalog version (versions.py) is checked at most every
+INDEX_VERSION_CHECK seconds and the cache is cleared when another worker
+wrote. The shared redis cache gets the invalidations of every worker.
+
+Read-your-writes (main.get_read_db, request.state): while the client is in
+the window following its write the cache is neither read nor written. The
+values read on a replica are stored for CACHE_REPLICA_TTL seconds only (5),
+so that a replica lagging behind a write can't pin its stale rows.
+
+Backends:
+    - LRUCache: in-process, bounded in number of entries, with a ttl
+    - RedisCache: shared between workers, used when CACHE_URL is set and
+      the optional redis package is installed
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+
+import versions
+from database import SessionLocal
+from singleflight import flights
+
+try:
+    import redis
+except ImportError:  # optional shared backend
+    redis = None
+
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", "300"))
+CACHE_REPLICA_TTL = float(os.environ.get("CACHE_REPLICA_TTL", "5"))
+CACHE_URL = os.environ.get("CACHE_URL")
+
+# (body, etag)
+Entry = Tuple[bytes, str]
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.not_modified = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(vars(self))
+
+
+class LRUCache:
+    """ in-process cache: least recently used entry evicted first, entries expire after ttl seconds """
+    shared = False
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._generation = 0
+        self._entries: "OrderedDict[str, Tuple[float, Entry, Set[str]]]" = OrderedDict()
+        self._tags: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.stats.misses += 1
+                return None
+            expires, entry, _ = item
+            if expires < time.monotonic():
+                self._remove(key)
+                self.stats.evictions += 1
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry
+
+    def generation(self) -> int:
+        return self._generation
+
+    def set(self, key: str, entry: Entry, tags: Iterable[str], ttl: Optional[float] = None,
+            generation: Optional[int] = None):
+        """ not stored if the generation moved since the given one """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._remove(key)
+            tags = set(tags)
+            self._entries[key] = (time.monotonic() + min(ttl or self.ttl, self.ttl), entry, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats.evictions += 1
+
+    def invalidate(self, *tags: str):
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+                    self.stats.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tags.clear()
+
+    def _remove(self, key: str):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            for tag in item[2]:
+                keys = self._tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+
+
+class RedisCache:
+    """ shared cache: body and etag in a hash with a ttl, one redis set of keys per tag """
+    shared = True
+
+    def __init__(self, url: str, ttl: float = CACHE_TTL, prefix: str = "api-cache:"):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self.stats = CacheStats()
+
+    def get(self, key: str) -> Optional[Entry]:
+        item = self.client.hmget(self.prefix + key, "body", "etag")
+        if item[0] is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return item[0], item[1].decode()
+
+    def generation(self) -> int:
+        return int(self.client.get(self.prefix + "generation") or 0)
+
+    def set(self, key: str, entry: Entry, tags: Iterable[str], ttl: Optional[float] = None,
+            generation: Optional[int] = None):
+        """ not stored if the generation moved since the given one """
+        pipe = self.client.pipeline()
+        if generation is not None:
+            pipe.watch(self.prefix + "generation")
+            if int(pipe.get(self.prefix + "generation") or 0) != generation:
+                pipe.reset()
+                return
+            pipe.multi()
+        pipe.hset(self.prefix + key, mapping={"body": entry[0], "etag": entry[1]})
+        pipe.expire(self.prefix + key, max(int(min(ttl or self.ttl, self.ttl)), 1))
+        for tag in tags:
+            pipe.sadd(self.prefix + "tag:" + tag, key)
+            pipe.expire(self.prefix + "tag:" + tag, self.ttl)
+        try:
+            pipe.execute()
+        except redis.WatchError:
+            pass
+
+    def invalidate(self, *tags: str):
+        self.client.incr(self.prefix + "generation")
+        for tag in tags:
+            keys = self.client.smembers(self.prefix + "tag:" + tag)
+            if keys:
+                self.client.delete(*[self.prefix + key.decode() for key in keys])
+                self.stats.invalidations += len(keys)
+            self.client.delete(self.prefix + "tag:" + tag)
+
+    def clear(self):
+        # the generation keeps counting
+        keys = [key for key in self.client.scan_iter(self.prefix + "*") if key != (self.prefix + "generation").encode()]
+        if keys:
+            self.client.delete(*keys)
+        self.client.incr(self.prefix + "generation")
+
+
+def make_cache():
+    if CACHE_URL and redis is not None:
+        return RedisCache(CACHE_URL)
+    return LRUCache()
+
+
+cache = make_cache()
+_catalog = versions.Tracker()
+
+
+def invalidate(*tags: str):
+    cache.invalidate(*tags)
+
+
+def check_catalog():
+    """ clear the in-process cache when another worker wrote (catalog version) """
+    if cache.shared:
+        return
+    db = SessionLocal()
+    try:
+        if _catalog.version is None:
+            _catalog.load(db)
+        elif _catalog.stale(db):
+            cache.clear()
+            _catalog.load(db)
+    finally:
+        db.close()
+
+
+def movie_tags(db_movie) -> Set[str]:
+    """ a movie detail depends on the movie, its director and its actors """
+    tags = {"movie:{}".format(db_movie.id)}
+    if db_movie.director is not None:
+        tags.add("star:{}".format(db_movie.director.id))
+    tags.update("star:{}".format(actor.id) for actor in db_movie.actors)
+    return tags
+
+
+def request_key(request: Request) -> str:
+    query = "&".join("{}={}".format(k, v) for k, v in sorted(request.query_params.multi_items()))
+    return request.url.path + "?" + query
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    return header.strip() == "*" or etag in [value.strip() for value in header.split(",")]
+
+
+def _lookup(request: Request) -> Tuple[str, Optional[Entry]]:
+    key = request_key(request)
+    if getattr(request.state, "recent_write", False):
+        return key, None
+    return key, cache.get(key)
+
+
+def _storable(request: Request) -> bool:
+    """ not in the read-your-writes window of the client """
+    return not getattr(request.state, "recent_write", False)
+
+
+def _ttl(request: Request) -> Optional[float]:
+    """ short for the values read on a replica (the routes on another session than
+        get_read_db's read on the primary), the ttl of the cache otherwise
+    """
+    return None if getattr(request.state, "read_primary", True) else CACHE_REPLICA_TTL
+
+
+def _flight_key(request: Request, key: str) -> Optional[str]:
+    """ key under which concurrent requests share a load: none in the read-your-writes
+        window, the replica reads apart from the primary reads
+    """
+    if getattr(request.state, "recent_write", False):
+        return None
+    return key if getattr(request.state, "read_primary", True) else "replica:" + key
+
+
+def _entry(value: object) -> Entry:
+    body = json.dumps(jsonable_encoder(value), separators=(",", ":")).encode()
+    return body, '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+
+def _store(key: str, value: object, tags: Iterable[str], ttl: Optional[float], generation: int) -> Entry:
+    entry = _entry(value)
+    cache.set(key, entry, tags, ttl, generation)
+    return entry
+
+
+def _respond(request: Request, entry: Entry) -> Response:
+    body, etag = entry
+    if _etag_matches(request, etag):
+        cache.stats.not_modified += 1
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+def cached_response(request: Request, load: Callable[[], Tuple[object, Iterable[str]]],
+        coalesce: bool = False) -> Response:
+    """ read-through: return the cached body or call load() -> (value, tags) and cache it
+        answer 304 when If-None-Match holds the current ETag
+        coalesce: concurrent misses of the same key share one load (singleflight.py)
+    """
+    check_catalog()
+    key, entry = _lookup(request)
+    if entry is None:
+        def build():
+            if not _storable(request):
+                return _entry(load()[0])
+            generation = cache.generation()
+            return _store(key, *load(), _ttl(request), generation)
+        flight = _flight_key(request, key) if coalesce else None
+        entry = flights.do(flight, build) if flight is not None else build()
+    return _respond(request, entry)
+
+
+async def cached_response_async(request: Request, load: Callable[[], Awaitable[Tuple[object, Iterable[str]]]],
+        coalesce: bool = False) -> Response:
+    """ cached_response for async routes, load is a coroutine function """
+    await run_in_threadpool(check_catalog)
+    key, entry = _lookup(request)
+    if entry is None:
+        async def build():
+            if not _storable(request):
+                return _entry((await load())[0])
+            generation = cache.generation()
+            value, tags = await load()
+            return _store(key, value, tags, _ttl(request), generation)
+        flight = _flight_key(request, key) if coalesce else None
+        entry = await (flights.do_async(flight, build) if flight is not None else build())
+    return _respond(request, entry)
+
+
+def coalesced_response(request: Request, load: Callable[[], object]) -> Response:
+    """ not cached, but concurrent identical requests share one load() and its serialized body """
+    flight = _flight_key(request, request_key(request))
+    build = lambda: _entry(load())
+    return _respond(request, flights.do(flight, build) if flight is not None else build())
+
+
+async def coalesced_response_async(request: Request, load: Callable[[], Awaitable[object]]) -> Response:
+    async def serialize():
+        return _entry(await load())
+    flight = _flight_key(request, request_key(request))
+    return _respond(request, await (flights.do_async(flight, serialize) if flight is not None else serialize()))
@@ -3,22 +3,76 @@ file crud.py
 manage CRUD and adapt model data from db to schema data to api rest
 """
 
-from typing import Optional, List
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, extract, between
+from functools import partial
+from typing import Dict, Optional, List
+from datetime import date
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy import desc, between, tuple_
 from sqlalchemy import func
 from fastapi.logger import logger
 import models, schemas
+import pagination
+import search
+import cache
+import stats
+import fastjson
+import graph
+import analytics
+import versions
+import writebatch
+
+# sort name -> columns of the keyset, always ending with the primary key
+MOVIE_SORT_KEYS = {"id": ("id",), "year": ("year", "id")}
+STAR_SORT_KEYS = {"id": ("id",), "name": ("name", "id")}
+
+def _keyset_query(query, model, sort_keys: dict, sort: str, after: Optional[str]):
+    attrs = sort_keys[sort]
+    columns = [getattr(model, attr) for attr in attrs]
+    if after is not None:
+        values = pagination.decode_cursor(after, sort, len(attrs), [column.type.python_type for column in columns])
+        query = query.filter(pagination.after_filter(columns, values))
+    return query.order_by(*columns)
+
+# loader strategies for MovieDetail: director is many to one (joined in the
+# same SELECT), actors is many to many (one extra SELECT ... IN for all movies)
+MOVIE_DETAIL_OPTIONS = (joinedload(models.Movie.director), selectinload(models.Movie.actors))
 
 def get_movie(db: Session, movie_id: int):
-    db_movie = db.query(models.Movie).filter(models.Movie.id == movie_id).first()
-    logger.error("Movie retrieved from DB: {} ; director: {}".format( 
-              db_movie.title, 
-              db_movie.director.name if db_movie.director is not None else "no director"))
+    db_movie = db.query(models.Movie) \
+            .options(*MOVIE_DETAIL_OPTIONS) \
+            .filter(models.Movie.id == movie_id) \
+            .first()
+    if db_movie is not None:
+        logger.debug("Movie retrieved from DB: %s ; director: %s",
+                  db_movie.title,
+                  db_movie.director.name if db_movie.director is not None else "no director")
     return db_movie
 
-def get_movies(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Movie).offset(skip).limit(limit).all()
+BY_IDS_MAX = 500
+
+def _by_ids(query, model, ids: List[int]):
+    """ one IN query for all ids: (entities in ids order without duplicates, ids not found) """
+    ids = list(dict.fromkeys(ids))
+    found = {entity.id: entity for entity in query.filter(model.id.in_(ids))} if ids else {}
+    return [found[id] for id in ids if id in found], [id for id in ids if id not in found]
+
+def get_movies_by_ids(db: Session, ids: List[int], detail: bool = False):
+    """ detail: director (joined) and actors (one selectin query) loaded too """
+    query = db.query(models.Movie)
+    if detail:
+        query = query.options(*MOVIE_DETAIL_OPTIONS)
+    return _by_ids(query, models.Movie, ids)
+
+def _movie_query(db: Session, as_rows: bool = False):
+    """ as_rows: column tuples in schemas.Movie field order instead of entities (fastjson) """
+    if as_rows:
+        return db.query(*fastjson.columns_of(models.Movie, schemas.Movie))
+    return db.query(models.Movie)
+
+def get_movies(db: Session, skip: int = 0, limit: int = 100, sort: str = "id", after: Optional[str] = None,
+        as_rows: bool = False):
+    query = _keyset_query(_movie_query(db, as_rows), models.Movie, MOVIE_SORT_KEYS, sort, after)
+    return query.offset(skip).limit(limit).all()
 
 def get_allMovies(db: Session):
     return db.query(models.Movie).all()
@@ -31,6 +85,9 @@ def get_movies_by_parttitle(db: Session, title: str):
 
 
 
+def search_movies(db: Session, q: str, limit: int = 20, prefix: bool = True):
+    return search.search(db, "movies", q, limit=limit, prefix=prefix)
+
 def get_movies_by_title_year(db: Session, title: str, year: int):
     return db.query(models.Movie).filter(models.Movie.title == title, models.Movie.year == year).order_by(models.Movie.year, models.Movie.title).all()
 
@@ -48,12 +105,17 @@ def get_movies_by_actor_endname(db: Session, endname: str):
             .all()
 
 
-def get_director_by_movie(db: Session, idMovie: str):
-    movie_director = db.query(models.Movie).filter(models.Movie.id == idMovie).join(models.Movie.director).first()
-    return movie_director.director
+def get_director_by_movie(db: Session, idMovie: int):
+    return db.query(models.Star) \
+            .join(models.Movie, models.Movie.id_director == models.Star.id) \
+            .filter(models.Movie.id == idMovie) \
+            .first()
 
 def get_actor_by_movie_title(db: Session, movieTitle: str):
-    movie_actors = db.query(models.Movie).filter(models.Movie.title.like(f'%{movieTitle}%')).join(models.Movie.actors).all()
+    movie_actors = db.query(models.Movie) \
+            .options(selectinload(models.Movie.actors)) \
+            .filter(models.Movie.title.like(f'%{movieTitle}%'), models.Movie.actors.any()) \
+            .all()
 
     allactors = [movie_actor.actors for movie_actor in movie_actors]
 
@@ -62,11 +124,42 @@ def get_actor_by_movie_title(db: Session, movieTitle: str):
 
 
 
+# mutations commit through _commit and update the in-memory indexes through
+# _after_commit, so that writebatch can group them in one transaction
+
+def _commit(db: Session, *refresh):
+    """ commit and reload refresh entities, only flush in a write batch (committed by writebatch) """
+    if writebatch.in_batch(db):
+        db.flush()
+        return
+    db.commit()
+    for entity in refresh:
+        db.refresh(entity)
+
+def _after_commit(db: Session, *hooks):
+    """ call hooks then bump the catalog version (the in-memory copies they updated
+        move to it), now or after the group commit in a write batch
+    """
+    if writebatch.in_batch(db):
+        db.info[writebatch.AFTER_COMMIT].extend(hooks)
+        return
+    try:
+        for hook in hooks:
+            hook()
+    finally:
+        versions.bump(db)
+
+
 def create_movie(db: Session, movie: schemas.MovieCreate):
     db_movie = models.Movie(title=movie.title, year=movie.year, duration=movie.duration)
     db.add(db_movie)
-    db.commit()
-    db.refresh(db_movie)
+    db.flush()
+    stats.movies_changed(db, years=[db_movie.year])
+    _commit(db, db_movie)
+    _after_commit(db,
+        partial(search.index_changed, "movies", db_movie.id, db_movie.title),
+        partial(analytics.movie_changed, db_movie.id, db_movie.year, db_movie.duration, db_movie.id_director),
+        partial(cache.invalidate, "stats"))
     return db_movie
 
 
@@ -74,10 +167,18 @@ def create_movie(db: Session, movie: schemas.MovieCreate):
 def update_movie(db: Session, movie: schemas.Movie):
     db_movie = db.query(models.Movie).filter(models.Movie.id == movie.id).first()
     if db_movie is not None:
+        old_year = db_movie.year
         db_movie.title = movie.title
         db_movie.year = movie.year
         db_movie.duration = movie.duration
-        db.commit()
+        db.flush()
+        stats.movies_changed(db, years={old_year, db_movie.year},
+            actors=[actor.id for actor in db_movie.actors] if old_year != db_movie.year else ())
+        _commit(db)
+        _after_commit(db,
+            partial(search.index_changed, "movies", db_movie.id, db_movie.title),
+            partial(analytics.movie_changed, db_movie.id, db_movie.year, db_movie.duration, db_movie.id_director),
+            partial(cache.invalidate, "movie:{}".format(db_movie.id), "stats"))
     return db_movie
 
 
@@ -85,31 +186,81 @@ def update_movie(db: Session, movie: schemas.Movie):
 def delete_movie(db: Session, movie_id: int):
      db_movie = db.query(models.Movie).filter(models.Movie.id == movie_id).first()
      if db_movie is not None:
+         actors_id = [actor.id for actor in db_movie.actors]
          db.delete(db_movie)
-         db.commit()
+         db.flush()
+         stats.movies_changed(db, years=[db_movie.year], directors=[db_movie.id_director], actors=actors_id)
+         _commit(db)
+         _after_commit(db,
+             partial(search.index_removed, "movies", movie_id),
+             partial(graph.cast_changed, movie_id, []),
+             partial(analytics.movie_removed, movie_id),
+             partial(cache.invalidate, "movie:{}".format(movie_id), "stats"))
      return db_movie
 
 
 
 
-def get_movies_by_range_year(db: Session, year_min: Optional[int] = None, year_max: Optional[int] = None):
+def _year_range(query, column, year_min: Optional[int], year_max: Optional[int]):
+    """ plain comparisons on the year column: indexable and prunable by decade partitions """
+    if year_min is not None:
+        query = query.filter(column >= year_min)
+    if year_max is not None:
+        query = query.filter(column <= year_max)
+    return query
+
+def get_movies_by_range_year(db: Session, year_min: Optional[int] = None, year_max: Optional[int] = None,
+        as_rows: bool = False):
     if year_min is None and year_max is None:
         return None
-    elif year_min is None:
-        return db.query(models.Movie).filter(models.Movie.year <= year_max).all()
-    elif year_max is None:
-        return db.query(models.Movie).filter(models.Movie.year >= year_min).all()
-    else:
-        return db.query(models.Movie) \
-                .filter(
-                    models.Movie.year >= year_min,
-                    models.Movie.year <= year_max) \
-                .all()
+    return _year_range(_movie_query(db, as_rows), models.Movie.year, year_min, year_max).all()
+
+MOVIE_FILTER_MAX_LIMIT = 1000
+
+def filter_movies(db: Session, title: Optional[str] = None,
+        year_min: Optional[int] = None, year_max: Optional[int] = None,
+        duration_min: Optional[int] = None, duration_max: Optional[int] = None,
+        director_id: Optional[int] = None, director: Optional[str] = None,
+        actor_id: Optional[int] = None, actor: Optional[str] = None,
+        sort: str = "id", skip: int = 0, limit: int = 100, fields: Optional[List[str]] = None):
+    """ every given filter combined in one SELECT (AND), directors and actors as EXISTS subqueries
+        fields: subset of schemas.Movie fields to select, all when None
+        return list of dict
+    """
+    names = [name for name in schemas.Movie.__fields__ if fields is None or name in fields]
+    query = _year_range(db.query(*[getattr(models.Movie, name) for name in names]),
+            models.Movie.year, year_min, year_max)
+    if title is not None:
+        query = query.filter(models.Movie.title.like(f'%{title}%'))
+    if duration_min is not None:
+        query = query.filter(models.Movie.duration >= duration_min)
+    if duration_max is not None:
+        query = query.filter(models.Movie.duration <= duration_max)
+    if director_id is not None:
+        query = query.filter(models.Movie.id_director == director_id)
+    if director is not None:
+        query = query.filter(models.Movie.director.has(models.Star.name.like(f'%{director}%')))
+    if actor_id is not None:
+        query = query.filter(models.Movie.actors.any(models.Star.id == actor_id))
+    if actor is not None:
+        query = query.filter(models.Movie.actors.any(models.Star.name.like(f'%{actor}%')))
+    column = getattr(models.Movie, sort.lstrip("-"))
+    query = query.order_by(desc(column) if sort.startswith("-") else column, models.Movie.id)
+    rows = query.offset(skip).limit(min(limit, MOVIE_FILTER_MAX_LIMIT)).all()
+    return [dict(zip(names, row)) for row in rows]
 
 #movie's stat
 
-def get_movies_count_by_year(db: Session):
-    result_query = db.query(models.Movie.year,func.count().label("countMovies")) \
+def get_movies_count_by_year(db: Session, year_min: Optional[int] = None, year_max: Optional[int] = None):
+    if stats.is_built(db):
+        result_query = _year_range(db.query(models.StatYear.year, models.StatYear.count_movies),
+                models.StatYear.year, year_min, year_max) \
+        .order_by(models.StatYear.year) \
+        .all()
+        return [{'year' : year,'countMovies':countMovies} for year,countMovies in result_query]
+
+    result_query = _year_range(db.query(models.Movie.year,func.count().label("countMovies")),
+            models.Movie.year, year_min, year_max) \
     .group_by(models.Movie.year)\
     .order_by(models.Movie.year)\
     .all()
@@ -117,9 +268,21 @@ def get_movies_count_by_year(db: Session):
     return [{'year' : year,'countMovies':countMovies} for year,countMovies in result_query]
 
 def get_movies_stat_duration(db: Session):
+    if stats.is_built(db):
+        result_query = db.query(models.StatYear.year,
+            models.StatYear.min_duration,
+            models.StatYear.max_duration,
+            models.StatYear.sum_duration,
+            models.StatYear.count_duration) \
+        .order_by(models.StatYear.year) \
+        .all()
+        return [{'year' : year,'min_duration':minduration, 'max_duration' : maxduration,
+                 'mean_duration' : sumduration / countduration if countduration else None}
+                for year,minduration,maxduration,sumduration,countduration in result_query]
+
     result_query =  db.query(models.Movie.year,
-        func.max(models.Movie.duration).label("max_duration"),
         func.min(models.Movie.duration).label("min_duration"),
+        func.max(models.Movie.duration).label("max_duration"),
         func.avg(models.Movie.duration).label("mean_duration")) \
     .group_by(models.Movie.year)\
     .order_by(models.Movie.year)\
@@ -134,8 +297,20 @@ def get_star(db: Session, star_id: int):
     return db.query(models.Star).filter(models.Star.id == star_id).first()
 
 
-def get_stars(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Star).offset(skip).limit(limit).all()
+def get_stars_by_ids(db: Session, ids: List[int]):
+    return _by_ids(db.query(models.Star), models.Star, ids)
+
+
+def _star_query(db: Session, as_rows: bool = False):
+    """ as_rows: column tuples in schemas.Star field order instead of entities (fastjson) """
+    if as_rows:
+        return db.query(*fastjson.columns_of(models.Star, schemas.Star))
+    return db.query(models.Star)
+
+def get_stars(db: Session, skip: int = 0, limit: int = 100, sort: str = "id", after: Optional[str] = None,
+        as_rows: bool = False):
+    query = _keyset_query(_star_query(db, as_rows), models.Star, STAR_SORT_KEYS, sort, after)
+    return query.offset(skip).limit(limit).all()
 
 
 def get_stars_by_name(db: Session, name: str):
@@ -144,12 +319,15 @@ def get_stars_by_name(db: Session, name: str):
 def get_stars_by_partname(db: Session, name: str):
     return db.query(models.Star).filter(models.Star.name.like(f'%{name}%')).all()
 
+def search_stars(db: Session, q: str, limit: int = 20, prefix: bool = True):
+    return search.search(db, "stars", q, limit=limit, prefix=prefix)
+
 
 def create_star(db: Session, star: schemas.StarCreate):
     db_star = models.Star(name=star.name, birthdate=star.birthdate)
     db.add(db_star)
-    db.commit()
-    db.refresh(db_star)
+    _commit(db, db_star)
+    _after_commit(db, partial(search.index_changed, "stars", db_star.id, db_star.name))
     return db_star
 
 
@@ -158,7 +336,10 @@ def update_star(db: Session, star: schemas.Star):
     if db_star is not None:
         db_star.name = star.name
         db_star.birthdate = star.birthdate
-        db.commit()
+        _commit(db)
+        _after_commit(db,
+            partial(search.index_changed, "stars", db_star.id, db_star.name),
+            partial(cache.invalidate, "star:{}".format(db_star.id), "stats"))
     return db_star
 
 
@@ -166,19 +347,42 @@ def delete_star(db: Session, star_id: int):
      db_star = db.query(models.Star).filter(models.Star.id == star_id).first()
      if db_star is not None:
          db.delete(db_star)
-         db.commit()
+         db.flush()
+         stats.movies_changed(db, directors=[star_id], actors=[star_id])
+         _commit(db)
+         _after_commit(db,
+             partial(search.index_removed, "stars", star_id),
+             partial(graph.star_removed, star_id),
+             partial(analytics.star_removed, star_id),
+             partial(cache.invalidate, "star:{}".format(star_id), "stats"))
      return db_star
 
 
 def get_star_by_birthyear(db: Session, year: int):
-    return db.query(models.Star).filter(extract('year', models.Star.birthdate) == year).all()
+    # date range instead of extract(year) so that ix_stars_birthdate can be used
+    if not 1 <= year < 9999:
+        return []
+    return db.query(models.Star) \
+            .filter(models.Star.birthdate >= date(year, 1, 1), models.Star.birthdate < date(year + 1, 1, 1)) \
+            .all()
 
 
 
 # Stars's stat
 
+def _stat_actor_query(db: Session, min_count: int, *columns):
+    return db.query(models.Star, *columns) \
+    .join(models.StatActor, models.StatActor.id_actor == models.Star.id) \
+    .filter(models.StatActor.count_movies >= min_count)
+
 def get_movie_stat_director(db: Session, min_count: int ):
-    
+    if stats.is_built(db):
+        return db.query(models.Star, models.StatDirector.count_movies.label("count_movies")) \
+        .join(models.StatDirector, models.StatDirector.id_director == models.Star.id) \
+        .filter(models.StatDirector.count_movies >= min_count) \
+        .order_by(desc("count_movies")) \
+        .all()
+
     result_query =  db.query(models.Star,
         func.count(models.Movie.id).label("count_movies"))\
     .join(models.Movie.director)\
@@ -191,7 +395,11 @@ def get_movie_stat_director(db: Session, min_count: int ):
 
 
 def get_count_movie_by_actor(db: Session, min_count: int ):
-    
+    if stats.is_built(db):
+        return _stat_actor_query(db, min_count, models.StatActor.count_movies.label("count_movies")) \
+        .order_by(desc("count_movies")) \
+        .all()
+
     result_query =  db.query(models.Star,
         func.count(models.Movie.id).label("count_movies"))\
     .join(models.Movie.actors)\
@@ -203,7 +411,9 @@ def get_count_movie_by_actor(db: Session, min_count: int ):
     return result_query
 
 def get_first_movie_by_actor(db: Session, min_count: int ):
-    
+    if stats.is_built(db):
+        return _stat_actor_query(db, min_count, models.StatActor.first_year.label("first_year")).all()
+
     result_query =  db.query(models.Star,
         func.min(models.Movie.year).label("first_year"))\
     .join(models.Movie.actors)\
@@ -214,7 +424,9 @@ def get_first_movie_by_actor(db: Session, min_count: int ):
     return result_query
 
 def get_last_movie_by_actor(db: Session, min_count: int ):
-    
+    if stats.is_built(db):
+        return _stat_actor_query(db, min_count, models.StatActor.last_year.label("last_year")).all()
+
     result_query =  db.query(models.Star,
         func.max(models.Movie.year).label("last_year"))\
     .join(models.Movie.actors)\
@@ -225,9 +437,14 @@ def get_last_movie_by_actor(db: Session, min_count: int ):
     return result_query
 
 def get_stat_movie_by_actor(db: Session,min_count: int):
-    
+    if stats.is_built(db):
+        return _stat_actor_query(db, min_count,
+            models.StatActor.first_year, models.StatActor.last_year, models.StatActor.count_movies).all()
+
     result_query =  db.query(models.Star,
-        func.min(models.Movie.year),func.max(models.Movie.year), func.count(models.Movie.id))\
+        func.min(models.Movie.year).label("first_year"),
+        func.max(models.Movie.year).label("last_year"),
+        func.count(models.Movie.id).label("count_movies"))\
     .join(models.Movie.actors)\
     .group_by(models.Star)\
     .having(func.count(models.Movie.id) >= min_count)\
@@ -243,8 +460,14 @@ def update_movie_director(db: Session, movie_id: int, director_id: int):
     db_star =  get_star(db=db, star_id=director_id)
     if db_movie is None or db_star is None:
         return None
+    old_director_id = db_movie.id_director
     db_movie.director = db_star
-    db.commit()
+    db.flush()
+    stats.movies_changed(db, directors=[old_director_id, director_id])
+    _commit(db)
+    _after_commit(db,
+        partial(analytics.movie_changed, movie_id, db_movie.year, db_movie.duration, director_id),
+        partial(cache.invalidate, "movie:{}".format(movie_id), "stats"))
     return db_movie
 
 def add_movie_actor(db: Session, movie_id: int, actor_id: int):
@@ -253,21 +476,119 @@ def add_movie_actor(db: Session, movie_id: int, actor_id: int):
     if db_movie is None or db_star is None:
         return None
     db_movie.actors.append(db_star)
-    db.commit()
+    db.flush()
+    stats.movies_changed(db, actors=[actor_id])
+    _commit(db)
+    actors_id = [actor.id for actor in db_movie.actors]
+    _after_commit(db,
+        partial(graph.cast_changed, movie_id, actors_id),
+        partial(analytics.cast_changed, movie_id, actors_id),
+        partial(cache.invalidate, "movie:{}".format(movie_id), "stats"))
     return db_movie
 
 
 def update_movie_actor(db: Session, movie_id: int, actors_id: List[int]):
-    db_movie = get_movie(db=db, movie_id=movie_id)
-    db_stars =  [] 
-    for actor_id in actors_id:
-        actor = get_star(db=db, star_id=actor_id)
-        if actor is None:
-            return None
-        db_stars.append(actor)
-
-    if db_movie is None :
+    db_movies = update_movies_actors(db, {movie_id: actors_id})
+    return db_movies[0] if db_movies is not None else None
+
+
+def update_movies_actors(db: Session, casts: Dict[int, List[int]]):
+    """ replace the actors of several movies in one transaction
+        casts: movie id -> list of star id
+        only the play rows that change are deleted / inserted
+        return the movies (in casts order) or None if a movie or a star doesn't exist
+    """
+    movies_id = list(casts)
+    casts = {movie_id: set(actors_id) for movie_id, actors_id in casts.items()}
+    wanted_id = set().union(*casts.values())
+    if db.query(func.count(models.Movie.id)).filter(models.Movie.id.in_(movies_id)).scalar() != len(movies_id):
         return None
-    db_movie.actors = db_stars
-    db.commit()
-    return db_movie
\ No newline at end of file
+    if wanted_id and db.query(func.count(models.Star.id)).filter(models.Star.id.in_(wanted_id)).scalar() != len(wanted_id):
+        return None
+
+    current = {movie_id: set() for movie_id in movies_id}
+    for id_movie, id_actor in db.query(models.play_table.c.id_movie, models.play_table.c.id_actor) \
+            .filter(models.play_table.c.id_movie.in_(movies_id)):
+        current[id_movie].add(id_actor)
+    removed = [(movie_id, actor_id) for movie_id in movies_id for actor_id in current[movie_id] - casts[movie_id]]
+    added = [(movie_id, actor_id) for movie_id in movies_id for actor_id in casts[movie_id] - current[movie_id]]
+    if removed:
+        db.execute(models.play_table.delete().where(
+            tuple_(models.play_table.c.id_movie, models.play_table.c.id_actor).in_(removed)))
+    if added:
+        db.execute(models.play_table.insert(), [{"id_movie": movie_id, "id_actor": actor_id} for movie_id, actor_id in added])
+    stats.movies_changed(db, actors={actor_id for _, actor_id in removed + added})
+    _commit(db)
+    _after_commit(db,
+        *[partial(graph.cast_changed, movie_id, casts[movie_id]) for movie_id in movies_id],
+        *[partial(analytics.cast_changed, movie_id, casts[movie_id]) for movie_id in movies_id],
+        partial(cache.invalidate, *["movie:{}".format(movie_id) for movie_id in movies_id], "stats"))
+
+    db_movies = {db_movie.id: db_movie for db_movie in db.query(models.Movie)
+            .options(*MOVIE_DETAIL_OPTIONS)
+            .filter(models.Movie.id.in_(movies_id))}
+    return [db_movies[movie_id] for movie_id in movies_id]
+
+
+# collaboration graph (see graph.py), ids resolved to entities with one IN query
+
+def _by_id(db: Session, model, ids):
+    return {entity.id: entity for entity in db.query(model).filter(model.id.in_(set(ids)))} if ids else {}
+
+def get_costars(db: Session, star_id: int, limit: int = 20):
+    """ None if the star doesn't exist """
+    if get_star(db, star_id) is None:
+        return None
+    costars = graph.get_graph(db).costars(star_id, limit)
+    db_stars = _by_id(db, models.Star, [costar_id for costar_id, _ in costars])
+    return [{"star": db_stars[costar_id], "movies": count} for costar_id, count in costars]
+
+def get_separation(db: Session, from_id: int, to_id: int):
+    """ shortest chain of co-stars between 2 stars, None if they are not connected """
+    path = graph.get_graph(db).path(from_id, to_id)
+    if path is None:
+        return None
+    stars_id, movies_id = path
+    db_stars = _by_id(db, models.Star, stars_id)
+    db_movies = _by_id(db, models.Movie, movies_id)
+    return {
+        "degrees": len(movies_id),
+        "stars": [db_stars[star_id] for star_id in stars_id],
+        "movies": [db_movies[movie_id] for movie_id in movies_id],
+    }
+
+def get_most_connected(db: Session, limit: int = 20):
+    connected = graph.get_graph(db).most_connected(limit)
+    db_stars = _by_id(db, models.Star, [star_id for star_id, _ in connected])
+    return [{"star": db_stars[star_id], "costars": count} for star_id, count in connected]
+
+
+# in-memory analytics (see analytics.py), None when numpy is not installed
+
+def get_analytics_years(db: Session, year_min: Optional[int] = None, year_max: Optional[int] = None):
+    if not analytics.available():
+        return None
+    return analytics.query(db, "by_year", year_min=year_min, year_max=year_max)
+
+def get_analytics_durations(db: Session, bins: int = 20, year_min: Optional[int] = None, year_max: Optional[int] = None):
+    if not analytics.available():
+        return None
+    return analytics.query(db, "durations", bins=bins, year_min=year_min, year_max=year_max)
+
+def get_analytics_directors(db: Session, min_count: int = 1, limit: int = 100):
+    if not analytics.available():
+        return None
+    directors = analytics.query(db, "by_director", min_count=min_count, limit=limit)
+    db_stars = _by_id(db, models.Star, [row["id_director"] for row in directors])
+    for row in directors:
+        row["name"] = db_stars[row["id_director"]].name if row["id_director"] in db_stars else None
+    return directors
+
+def get_analytics_careers(db: Session, min_count: int = 1, limit: int = 20, sort: str = "span"):
+    if not analytics.available():
+        return None
+    careers = analytics.query(db, "careers", min_count=min_count, limit=limit, sort=sort)
+    db_stars = _by_id(db, models.Star, [row["id_actor"] for row in careers["top"]])
+    for row in careers["top"]:
+        row["name"] = db_stars[row["id_actor"]].name if row["id_actor"] in db_stars else None
+    return careers
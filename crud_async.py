@@ -0,0 +1,129 @@
+"""
+file crud_async.py
+async versions of the crud functions for main_async.py
+
+Each function runs the matching crud function through AsyncSession.run_sync:
+the queries are the same, but every database call awaits the asyncio
+driver instead of blocking a thread. Results are converted to schemas
+inside run_sync so that no lazy load is left to happen outside of it.
+
+Except the search on sqlite: its in-memory index is built under a thread
+lock held while the rows are read, which in run_sync would block the event
+loop that the read waits for. It runs in the threadpool on a sync session.
+"""
+
+from typing import Callable, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+import crud, schemas
+from database import SessionLocal
+
+
+def _to_schema(result, schema):
+    if result is None or schema is None:
+        return result
+    if isinstance(result, list):
+        return [_to_schema(item, schema) for item in result]
+    return schema.from_orm(result)
+
+
+async def _run(db: AsyncSession, fn: Callable, schema=None, **kwargs):
+    return await db.run_sync(lambda session: _to_schema(fn(session, **kwargs), schema))
+
+
+async def _search(db: AsyncSession, fn: Callable, schema, **kwargs):
+    if db.bind.dialect.name != "sqlite":
+        return await _run(db, fn, schema, **kwargs)
+    def search():
+        with SessionLocal() as session:
+            return _to_schema(fn(session, **kwargs), schema)
+    return await run_in_threadpool(search)
+
+
+# Movies's query
+
+async def get_movie(db: AsyncSession, movie_id: int) -> Optional[schemas.MovieDetail]:
+    return await _run(db, crud.get_movie, schemas.MovieDetail, movie_id=movie_id)
+
+async def get_movies(db: AsyncSession, skip: int = 0, limit: int = 100, sort: str = "id", after: Optional[str] = None) -> List[schemas.Movie]:
+    return await _run(db, crud.get_movies, schemas.Movie, skip=skip, limit=limit, sort=sort, after=after)
+
+async def get_movies_by_title(db: AsyncSession, title: str) -> List[schemas.Movie]:
+    return await _run(db, crud.get_movies_by_title, schemas.Movie, title=title)
+
+async def get_movies_by_parttitle(db: AsyncSession, title: str) -> List[schemas.Movie]:
+    return await _run(db, crud.get_movies_by_parttitle, schemas.Movie, title=title)
+
+async def search_movies(db: AsyncSession, q: str, limit: int = 20, prefix: bool = True) -> List[schemas.Movie]:
+    return await _search(db, crud.search_movies, schemas.Movie, q=q, limit=limit, prefix=prefix)
+
+async def get_movies_by_title_year(db: AsyncSession, title: str, year: int) -> List[schemas.Movie]:
+    return await _run(db, crud.get_movies_by_title_year, schemas.Movie, title=title, year=year)
+
+async def get_movies_by_director_endname(db: AsyncSession, endname: str) -> List[schemas.Movie]:
+    return await _run(db, crud.get_movies_by_director_endname, schemas.Movie, endname=endname)
+
+async def get_movies_by_actor_endname(db: AsyncSession, endname: str) -> List[schemas.Movie]:
+    return await _run(db, crud.get_movies_by_actor_endname, schemas.Movie, endname=endname)
+
+async def get_movies_by_range_year(db: AsyncSession, year_min: Optional[int] = None, year_max: Optional[int] = None) -> Optional[List[schemas.Movie]]:
+    return await _run(db, crud.get_movies_by_range_year, schemas.Movie, year_min=year_min, year_max=year_max)
+
+async def get_director_by_movie(db: AsyncSession, idMovie: int) -> Optional[schemas.Star]:
+    return await _run(db, crud.get_director_by_movie, schemas.Star, idMovie=idMovie)
+
+async def get_actor_by_movie_title(db: AsyncSession, movieTitle: str) -> List[List[schemas.Star]]:
+    return await _run(db, lambda session, **kwargs: [
+            [schemas.Star.from_orm(actor) for actor in actors]
+            for actors in crud.get_actor_by_movie_title(session, **kwargs)],
+        movieTitle=movieTitle)
+
+async def create_movie(db: AsyncSession, movie: schemas.MovieCreate) -> schemas.Movie:
+    return await _run(db, crud.create_movie, schemas.Movie, movie=movie)
+
+async def update_movie(db: AsyncSession, movie: schemas.Movie) -> Optional[schemas.Movie]:
+    return await _run(db, crud.update_movie, schemas.Movie, movie=movie)
+
+async def delete_movie(db: AsyncSession, movie_id: int) -> Optional[schemas.Movie]:
+    return await _run(db, crud.delete_movie, schemas.Movie, movie_id=movie_id)
+
+
+# Stars's query
+
+async def get_star(db: AsyncSession, star_id: int) -> Optional[schemas.Star]:
+    return await _run(db, crud.get_star, schemas.Star, star_id=star_id)
+
+async def get_stars(db: AsyncSession, skip: int = 0, limit: int = 100, sort: str = "id", after: Optional[str] = None) -> List[schemas.Star]:
+    return await _run(db, crud.get_stars, schemas.Star, skip=skip, limit=limit, sort=sort, after=after)
+
+async def get_stars_by_partname(db: AsyncSession, name: str) -> List[schemas.Star]:
+    return await _run(db, crud.get_stars_by_partname, schemas.Star, name=name)
+
+async def search_stars(db: AsyncSession, q: str, limit: int = 20, prefix: bool = True) -> List[schemas.Star]:
+    return await _search(db, crud.search_stars, schemas.Star, q=q, limit=limit, prefix=prefix)
+
+async def get_star_by_birthyear(db: AsyncSession, year: int) -> List[schemas.Star]:
+    return await _run(db, crud.get_star_by_birthyear, schemas.Star, year=year)
+
+async def create_star(db: AsyncSession, star: schemas.StarCreate) -> schemas.Star:
+    return await _run(db, crud.create_star, schemas.Star, star=star)
+
+async def update_star(db: AsyncSession, star: schemas.Star) -> Optional[schemas.Star]:
+    return await _run(db, crud.update_star, schemas.Star, star=star)
+
+async def delete_star(db: AsyncSession, star_id: int) -> Optional[schemas.Star]:
+    return await _run(db, crud.delete_star, schemas.Star, star_id=star_id)
+
+
+#query with join
+
+async def update_movie_director(db: AsyncSession, movie_id: int, director_id: int) -> Optional[schemas.MovieDetail]:
+    return await _run(db, crud.update_movie_director, schemas.MovieDetail, movie_id=movie_id, director_id=director_id)
+
+async def add_movie_actor(db: AsyncSession, movie_id: int, actor_id: int) -> Optional[schemas.MovieDetail]:
+    return await _run(db, crud.add_movie_actor, schemas.MovieDetail, movie_id=movie_id, actor_id=actor_id)
+
+async def update_movie_actor(db: AsyncSession, movie_id: int, actors_id: List[int]) -> Optional[schemas.MovieDetail]:
+    return await _run(db, crud.update_movie_actor, schemas.MovieDetail, movie_id=movie_id, actors_id=actors_id)
@@ -0,0 +1,77 @@
+"""
+export.py : streaming export of whole tables
+
+Rows are read with a server side cursor (stream_results) in fixed size
+batches straight from a Core connection: no ORM objects, no identity map,
+no pydantic model per row. Each batch is encoded and handed to the
+StreamingResponse before the next one is fetched, so memory stays flat
+whatever the size of the table.
+"""
+import csv
+import io
+import json
+from typing import Iterator, List, Sequence
+
+from sqlalchemy import select
+
+import models
+
+BATCH_SIZE = 1000
+
+EXPORT_TABLES = {
+    "movies": models.Movie.__table__,
+    "stars": models.Star.__table__,
+    "play": models.play_table,
+}
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def iter_batches(engine, columns: Sequence, batch_size: int = BATCH_SIZE) -> Iterator[List]:
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(select(columns))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+
+def ndjson_chunks(batches: Iterator[List], names: List[str]) -> Iterator[str]:
+    for rows in batches:
+        yield "".join(json.dumps(dict(zip(names, row)), default=str) + "\n" for row in rows)
+
+
+def csv_chunks(batches: Iterator[List], names: List[str]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def json_array_chunks(batches: Iterator[List], names: List[str]) -> Iterator[str]:
+    """ same output as a json list of objects, built one batch at a time """
+    separator = "["
+    for rows in batches:
+        yield separator + ",".join(json.dumps(dict(zip(names, row)), default=str) for row in rows)
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+
+def export_table(engine, table_name: str, fmt: str, batch_size: int = BATCH_SIZE) -> Iterator[str]:
+    table = EXPORT_TABLES[table_name]
+    columns = list(table.columns)
+    names = [column.name for column in columns]
+    batches = iter_batches(engine, columns, batch_size)
+    if fmt == "csv":
+        return csv_chunks(batches, names)
+    return ndjson_chunks(batches, names)
@@ -0,0 +1,39 @@
+"""
+fastjson.py : optional fast serialization of list responses
+
+With FAST_SERIALIZATION=1 the big list routes fetch plain column tuples
+instead of ORM entities and encode them here in one pass (orjson when it
+is installed, json otherwise): no ORM object, no pydantic model, no
+jsonable_encoder per row. The routes keep their response_model, so the
+OpenAPI schema is unchanged; the fields are taken from the schema, in the
+same order.
+"""
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:  # optional, falls back to json
+    orjson = None
+
+FAST_SERIALIZATION = os.environ.get("FAST_SERIALIZATION", "0") == "1"
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=str, separators=(",", ":")).encode()
+
+
+def columns_of(model, schema) -> List:
+    """ model columns matching the fields of a flat schema, in schema order """
+    return [getattr(model, name) for name in schema.__fields__]
+
+
+def rows_response(rows: Iterable, schema, headers: Optional[Dict[str, str]] = None) -> Response:
+    names = list(schema.__fields__)
+    content = dumps([dict(zip(names, row)) for row in rows])
+    return Response(content=content, media_type="application/json", headers=headers)
@@ -0,0 +1,216 @@
+"""
+graph.py : actor / movie collaboration graph built from play
+
+The bipartite graph is kept in CSR form: for each star index, its movies
+are star_adj[star_ptr[i]:star_ptr[i + 1]], and the same for each movie
+with movie_ptr / movie_adj. All of them are flat array('i') of indexes, ids
+are translated only at the edges of a query.
+
+Built on first use from the play table. crud calls cast_changed() after
+each cast mutation: the rows of the movie and of the stars joining or
+leaving its cast are patched in place, a patched row replaces its CSR
+slice (movie_rows / star_rows) and new movies or stars get an index
+appended after the others. Writes of other workers or processes move the
+catalog version (versions.py): the graph is then rebuilt from the database.
+"""
+import heapq
+import threading
+from array import array
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import models, versions
+
+
+class Graph:
+
+    def __init__(self, casts: Dict[int, array]):
+        self.movie_ids = array('i', sorted(movie_id for movie_id, cast in casts.items() if cast))
+        star_ids = set()
+        for cast in casts.values():
+            star_ids.update(cast)
+        self.star_ids = array('i', sorted(star_ids))
+        self.movie_index = {movie_id: i for i, movie_id in enumerate(self.movie_ids)}
+        self.star_index = {star_id: i for i, star_id in enumerate(self.star_ids)}
+
+        # movie -> stars
+        self.movie_ptr = array('i', [0])
+        self.movie_adj = array('i')
+        for movie_id in self.movie_ids:
+            self.movie_adj.extend(self.star_index[star_id] for star_id in casts[movie_id])
+            self.movie_ptr.append(len(self.movie_adj))
+
+        # star -> movies, by counting sort of the edges on the star index
+        counts = array('i', bytes(4 * (len(self.star_ids) + 1)))
+        for star in self.movie_adj:
+            counts[star + 1] += 1
+        for i in range(len(self.star_ids)):
+            counts[i + 1] += counts[i]
+        self.star_ptr = array('i', counts)
+        self.star_adj = array('i', bytes(4 * len(self.movie_adj)))
+        for movie in range(len(self.movie_ids)):
+            for k in range(self.movie_ptr[movie], self.movie_ptr[movie + 1]):
+                star = self.movie_adj[k]
+                self.star_adj[counts[star]] = movie
+                counts[star] += 1
+        # rows patched since the build, instead of their CSR slice
+        self.movie_rows: Dict[int, array] = {}
+        self.star_rows: Dict[int, array] = {}
+        self._connections: Optional[array] = None
+
+    def movies_of(self, star: int):
+        row = self.star_rows.get(star)
+        if row is not None:
+            return row
+        if star + 1 >= len(self.star_ptr):
+            return array('i')
+        return self.star_adj[self.star_ptr[star]:self.star_ptr[star + 1]]
+
+    def stars_of(self, movie: int):
+        row = self.movie_rows.get(movie)
+        if row is not None:
+            return row
+        if movie + 1 >= len(self.movie_ptr):
+            return array('i')
+        return self.movie_adj[self.movie_ptr[movie]:self.movie_ptr[movie + 1]]
+
+    def _star(self, star_id: int) -> int:
+        star = self.star_index.get(star_id)
+        if star is None:
+            # star_ids then the connections grow before the index is visible to the queries
+            self.star_ids.append(star_id)
+            if self._connections is not None:
+                self._connections.append(0)
+            star = self.star_index[star_id] = len(self.star_ids) - 1
+        return star
+
+    def set_cast(self, movie_id: int, actors_id: Iterable[int]):
+        """ patch the rows of the movie and of the stars joining or leaving its cast """
+        movie = self.movie_index.get(movie_id)
+        if movie is None:
+            self.movie_ids.append(movie_id)
+            movie = self.movie_index[movie_id] = len(self.movie_ids) - 1
+        before = set(self.stars_of(movie))
+        after = {self._star(star_id) for star_id in actors_id}
+        self.movie_rows[movie] = array('i', sorted(after))
+        for star in before - after:
+            self.star_rows[star] = array('i', (other for other in self.movies_of(star) if other != movie))
+        for star in after - before:
+            self.star_rows[star] = array('i', sorted([*self.movies_of(star), movie]))
+        if self._connections is not None:
+            for star in before | after:
+                self._connections[star] = self._count_connections(star)
+
+    def remove_star(self, star_id: int):
+        star = self.star_index.get(star_id)
+        if star is None:
+            return
+        for movie in self.movies_of(star):
+            self.set_cast(self.movie_ids[movie], (self.star_ids[other] for other in self.stars_of(movie) if other != star))
+
+    def costars(self, star_id: int, limit: int) -> List[Tuple[int, int]]:
+        """ (co-star id, number of shared movies), most shared first """
+        star = self.star_index.get(star_id)
+        if star is None:
+            return []
+        shared: Dict[int, int] = {}
+        for movie in self.movies_of(star):
+            for other in self.stars_of(movie):
+                if other != star:
+                    shared[other] = shared.get(other, 0) + 1
+        best = heapq.nsmallest(limit, shared.items(), key=lambda item: (-item[1], self.star_ids[item[0]]))
+        return [(self.star_ids[other], count) for other, count in best]
+
+    def path(self, from_id: int, to_id: int) -> Optional[Tuple[List[int], List[int]]]:
+        """ shortest chain (star ids, movie ids) from a star to another, stars[i] and
+            stars[i + 1] both play in movies[i]; None when they are not connected
+        """
+        start, goal = self.star_index.get(from_id), self.star_index.get(to_id)
+        if start is None or goal is None:
+            return None
+        # sized at the start of the search: rows patched meanwhile may hold larger indexes
+        stars, movies = len(self.star_ids), len(self.movie_ids)
+        if start >= stars or goal >= stars or not self.movies_of(start) or not self.movies_of(goal):
+            return None
+        parent_star = array('i', [-1]) * stars
+        parent_movie = array('i', [-1]) * stars
+        seen_movie = bytearray(movies)
+        parent_star[start] = start
+        queue = deque([start])
+        while queue and parent_star[goal] == -1:
+            star = queue.popleft()
+            for movie in self.movies_of(star):
+                if movie >= movies or seen_movie[movie]:
+                    continue
+                seen_movie[movie] = 1
+                for other in self.stars_of(movie):
+                    if other < stars and parent_star[other] == -1:
+                        parent_star[other] = star
+                        parent_movie[other] = movie
+                        queue.append(other)
+        if parent_star[goal] == -1:
+            return None
+        stars, movies = [goal], []
+        while stars[-1] != start:
+            movies.append(parent_movie[stars[-1]])
+            stars.append(parent_star[stars[-1]])
+        return ([self.star_ids[star] for star in reversed(stars)],
+                [self.movie_ids[movie] for movie in reversed(movies)])
+
+    def most_connected(self, limit: int) -> List[Tuple[int, int]]:
+        """ (star id, number of distinct co-stars), most first """
+        if self._connections is None:
+            self._connections = array('i', (self._count_connections(star) for star in range(len(self.star_ids))))
+        connections = self._connections
+        best = heapq.nlargest(limit, range(len(connections)), key=connections.__getitem__)
+        return [(self.star_ids[star], connections[star]) for star in best if connections[star] >= 0]
+
+    def _count_connections(self, star: int) -> int:
+        """ -1 for a star left without movies by the edits, out of the graph """
+        others = set()
+        for movie in self.movies_of(star):
+            others.update(self.stars_of(movie))
+        return len(others) - 1
+
+
+_graph: Optional[Graph] = None
+_version = versions.Tracker()
+_lock = threading.Lock()
+
+
+def get_graph(db: Session) -> Graph:
+    global _graph
+    with _lock:
+        if _graph is not None and _version.stale(db):
+            _graph = None
+        if _graph is None:
+            _version.load(db)
+            casts: Dict[int, array] = {}
+            play = models.play_table
+            for id_movie, id_actor in db.query(play.c.id_movie, play.c.id_actor).distinct():
+                casts.setdefault(id_movie, array('i')).append(id_actor)
+            _graph = Graph(casts)
+        return _graph
+
+
+def cast_changed(movie_id: int, actors_id: Iterable[int]):
+    """ called by crud after a cast is replaced, no-op while the graph is not built """
+    with _lock:
+        if _graph is not None:
+            _graph.set_cast(movie_id, set(actors_id))
+
+
+def star_removed(star_id: int):
+    with _lock:
+        if _graph is not None:
+            _graph.remove_star(star_id)
+
+
+def reset():
+    """ drop the graph after writes that bypassed crud, it is rebuilt on next query """
+    global _graph
+    with _lock:
+        _graph = None
+        _version.reset()
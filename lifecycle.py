@@ -0,0 +1,272 @@
+"""
+lifecycle.py : schema migration, warm-up and readiness of a worker
+
+Importing the app has no side effect: nothing connects to the database
+until the first request, the warm-up or an explicit step below.
+
+    python lifecycle.py migrate     create the missing tables (was done by
+                                    every import of main.py before), then
+                                    apply the pending MIGRATIONS
+    python lifecycle.py check       exit code 1 if tables or migrations are
+                                    missing
+
+MIGRATIONS bring a database created by an older version to models.py, each
+step checks the schema first so migrate can be run any number of times:
+    - indexes: the indexes of models.py missing on existing tables
+      (create_all only creates whole tables)
+    - play_primary_key: play without pk_play is copied without its
+      duplicate and NULL rows into a new table with the key, which then
+      takes the name play (the old one is dropped): mysql commits every ddl
+      statement, so until the rename play is left as it was, and a step
+      that failed half way is started over by the next migrate
+sql/*_cine_indexes.sql are the same steps as plain sql.
+
+On startup each worker runs the warm-up in a background thread, so it
+accepts connections (GET /health) right away:
+    - the schema check (tables of models.py exist), or migrate with
+      MIGRATE_ON_STARTUP=1
+    - WARMUP_CONNECTIONS (DB_POOL_SIZE) pool connections opened, on the
+      primary and on every replica
+    - the hot read queries run once, so their sql is compiled and cached
+      by sqlalchemy before the first request
+GET /ready answers 503 until it is done and while the primary doesn't
+answer SELECT 1. A failed warm-up is retried every WARMUP_RETRY seconds
+(2, doubled up to 30). WARMUP=0 skips the connections and queries.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import MetaData, inspect, text
+
+import crud, fastjson, models
+from database import POOL_SIZE, SessionLocal, get_engine, get_replicas
+
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+WARMUP_CONNECTIONS = int(os.environ.get("WARMUP_CONNECTIONS", str(POOL_SIZE)))
+MIGRATE_ON_STARTUP = os.environ.get("MIGRATE_ON_STARTUP", "0") == "1"
+WARMUP_RETRY = float(os.environ.get("WARMUP_RETRY", "2"))
+
+logger = logging.getLogger("uvicorn")
+
+# the read queries of the hot routes, on ids / titles that match nothing
+HOT_QUERIES = (
+    lambda db: crud.get_movie(db, movie_id=0),
+    lambda db: crud.get_star(db, star_id=0),
+    lambda db: crud.get_movies(db, limit=1, as_rows=fastjson.FAST_SERIALIZATION),
+    lambda db: crud.get_movies(db, limit=1, sort="year", as_rows=fastjson.FAST_SERIALIZATION),
+    lambda db: crud.get_stars(db, limit=1, as_rows=fastjson.FAST_SERIALIZATION),
+    lambda db: crud.get_stars(db, limit=1, sort="name", as_rows=fastjson.FAST_SERIALIZATION),
+    lambda db: crud.get_movies_by_ids(db, ids=[0]),
+    lambda db: crud.get_movies_by_ids(db, ids=[0], detail=True),
+    lambda db: crud.get_stars_by_ids(db, ids=[0]),
+    lambda db: crud.get_movies_by_title(db, title=""),
+    lambda db: crud.get_director_by_movie(db, idMovie=0),
+)
+
+
+def missing_tables(engine=None) -> List[str]:
+    existing = set(inspect(engine or get_engine()).get_table_names())
+    return sorted(name for name in models.Base.metadata.tables if name not in existing)
+
+
+# migrations: (name, needed(inspector) -> bool, apply(connection))
+
+def _missing_indexes(inspector) -> list:
+    existing = set(inspector.get_table_names())
+    indexes = []
+    for table in models.Base.metadata.sorted_tables:
+        if table.name in existing:
+            names = {index["name"] for index in inspector.get_indexes(table.name)}
+            indexes.extend(index for index in table.indexes if index.name not in names)
+    return indexes
+
+
+def _create_indexes(connection):
+    for index in _missing_indexes(inspect(connection)):
+        index.create(bind=connection)
+
+
+# the copy of play with the key, and the old play once replaced by it
+PLAY_COPY = "play_migration"
+PLAY_REPLACED = "play_without_key"
+
+
+def _play_has_key(inspector) -> bool:
+    return bool(inspector.get_pk_constraint("play")["constrained_columns"])
+
+
+def _play_without_key(inspector) -> bool:
+    tables = inspector.get_table_names()
+    return PLAY_REPLACED in tables or "play" in tables and not _play_has_key(inspector)
+
+
+def _keyed_play(name: str):
+    """ play of models.py (columns, pk_play, foreign keys) named name, without its
+        indexes: their names are taken by the old play until it is dropped
+    """
+    metadata = MetaData()
+    for table in (models.Movie.__table__, models.Star.__table__):
+        table.to_metadata(metadata)
+    play = models.play_table.to_metadata(metadata, name=name)
+    play.indexes.clear()
+    return play
+
+
+def _add_play_key(connection):
+    inspector = inspect(connection)
+    tables = inspector.get_table_names()
+    if not _play_has_key(inspector):
+        if PLAY_COPY in tables:
+            # copy of a step that failed before the rename
+            connection.execute(text("DROP TABLE " + PLAY_COPY))
+        _keyed_play(PLAY_COPY).create(bind=connection)
+        connection.execute(text("INSERT INTO {} (id_movie, id_actor) SELECT DISTINCT id_movie, id_actor FROM play"
+                                " WHERE id_movie IS NOT NULL AND id_actor IS NOT NULL".format(PLAY_COPY)))
+        if connection.dialect.name == "mysql":
+            # both names swapped in one statement
+            connection.execute(text("RENAME TABLE play TO {}, {} TO play".format(PLAY_REPLACED, PLAY_COPY)))
+        else:
+            # transactional ddl: both renames or none
+            connection.execute(text("ALTER TABLE play RENAME TO " + PLAY_REPLACED))
+            connection.execute(text("ALTER TABLE {} RENAME TO play".format(PLAY_COPY)))
+    if PLAY_REPLACED in inspect(connection).get_table_names():
+        connection.execute(text("DROP TABLE " + PLAY_REPLACED))
+
+
+MIGRATIONS = (
+    ("play_primary_key", _play_without_key, _add_play_key),
+    ("indexes", lambda inspector: bool(_missing_indexes(inspector)), _create_indexes),
+)
+
+
+def pending_migrations(engine=None) -> List[str]:
+    inspector = inspect(engine or get_engine())
+    return [name for name, needed, _ in MIGRATIONS if needed(inspector)]
+
+
+def migrate(engine=None) -> List[str]:
+    """ create the missing tables and apply the pending migrations, return what was done """
+    engine = engine or get_engine()
+    done = ["table " + name for name in missing_tables(engine)]
+    models.Base.metadata.create_all(bind=engine)
+    for name, needed, apply in MIGRATIONS:
+        # one transaction per step (mysql commits its ddl anyway)
+        with engine.begin() as connection:
+            if connection.dialect.name == "sqlite":
+                # pysqlite runs ddl outside of its transactions
+                connection.execute(text("BEGIN"))
+            if needed(inspect(connection)):
+                apply(connection)
+                done.append(name)
+    return done
+
+
+def check_schema():
+    missing = missing_tables()
+    if missing:
+        raise RuntimeError("missing tables {}, run python lifecycle.py migrate".format(", ".join(missing)))
+    pending = pending_migrations()
+    if pending:
+        logger.warning("pending migrations %s, run python lifecycle.py migrate", ", ".join(pending))
+
+
+def open_connections(engine, count: int):
+    """ check out count connections at once and give them back: the pool keeps them open """
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+class Readiness:
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ready_after: Optional[float] = None
+        self.error: Optional[str] = None
+        self.steps: Dict[str, float] = {}
+        self._thread = None
+
+    def start(self):
+        """ warm-up in the background, once per worker """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.warm_up, name="warm-up", daemon=True)
+            self._thread.start()
+
+    def _step(self, name: str, fn):
+        start = time.perf_counter()
+        fn()
+        self.steps[name] = round(time.perf_counter() - start, 3)
+
+    def warm_up(self):
+        delay = WARMUP_RETRY
+        while True:
+            try:
+                if MIGRATE_ON_STARTUP:
+                    self._step("migrate", migrate)
+                else:
+                    self._step("schema", check_schema)
+                if WARMUP:
+                    engine = get_engine()
+                    self._step("connections", lambda: [open_connections(e, WARMUP_CONNECTIONS)
+                                                       for e in [engine] + get_replicas().engines])
+                    self._step("queries", self.run_hot_queries)
+            except Exception as e:
+                self.error = "{}: {}".format(type(e).__name__, e)
+                logger.warning("worker %s not ready, retry in %.0f s: %s", os.getpid(), delay, self.error)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            self.error = None
+            self.ready_after = round(time.monotonic() - self.started, 3)
+            logger.info("worker %s ready in %.3f s %s", os.getpid(), self.ready_after, self.steps)
+            return
+
+    @staticmethod
+    def run_hot_queries():
+        db = SessionLocal()
+        try:
+            for query in HOT_QUERIES:
+                query(db)
+        finally:
+            db.close()
+
+    def status(self) -> dict:
+        """ ready when warmed up and the primary answers """
+        status = {"pid": os.getpid(), "ready": False, "steps": self.steps}
+        if self.error is not None:
+            status["error"] = self.error
+        elif self.ready_after is None:
+            status["error"] = "warming up"
+        else:
+            try:
+                with get_engine().connect() as connection:
+                    connection.execute(text("SELECT 1"))
+                status.update(ready=True, ready_after=self.ready_after)
+            except Exception as e:
+                status["error"] = "{}: {}".format(type(e).__name__, e)
+        return status
+
+
+readiness = Readiness()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args == ["migrate"]:
+        done = migrate()
+        print("migrated:", ", ".join(done) if done else "nothing to do")
+    elif args == ["check"]:
+        missing, pending = missing_tables(), pending_migrations()
+        print("missing tables:", ", ".join(missing) if missing else "none")
+        print("pending migrations:", ", ".join(pending) if pending else "none")
+        sys.exit(1 if missing or pending else 0)
+    else:
+        sys.exit("usage: python lifecycle.py migrate|check")
@@ -1,23 +1,35 @@
-from typing import List, Optional, Tuple, Dict
+from typing import Any, List, Optional, Tuple, Dict
+import io
 import logging
+import os
+import time
 
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from fastapi.logger import logger as fastapi_logger
 from sqlalchemy.orm import Session
 
-import crud, models, schemas
-from database import SessionLocal, engine
+import crud, models, schemas, pagination, export, stats, bulk, fastjson, metrics, writebatch, lifecycle
+from cache import cache, cached_response, coalesced_response, movie_tags
+from singleflight import flights
+from database import READ_YOUR_WRITES, ReadSessionLocal, SessionLocal, get_engine, get_replicas, pool_metrics
 
-models.Base.metadata.create_all(bind=engine)
-app = FastAPI()
+# routes of the api, served by the app of create_app (bottom of this file)
+router = APIRouter(route_class=metrics.TimedRoute)
 
 logger = logging.getLogger("uvicorn")
 fastapi_logger.handlers = logger.handlers
 fastapi_logger.setLevel(logger.level)
-logger.error("API Started")
 
 # Dependency
-def get_db():
+LAST_WRITE_COOKIE = "last_write"
+
+def get_db(response: Response):
+    """ primary session, for the routes that write """
+    if READ_YOUR_WRITES:
+        response.set_cookie(LAST_WRITE_COOKIE, "{:.3f}".format(time.time()), max_age=int(READ_YOUR_WRITES) + 1)
     db = SessionLocal()
     try:
         yield db
@@ -25,212 +37,578 @@ def get_db():
         db.close()
 
 
-@app.get("/movies/", response_model=List[schemas.Movie])
-def read_movies(skip: Optional[int] = 0, limit: Optional[int] = 100, db: Session = Depends(get_db)):
-    movies = crud.get_movies(db, skip=skip, limit=limit)
-    return movies
+def get_read_db(request: Request):
+    """ replica session for the GET routes, the primary during the read-your-writes
+        window following a write of the client (last_write cookie)
+        request.state tells the response cache: no cache in the window, store
+        only what was read on the primary (a lagging replica would be cached)
+    """
+    last_write = request.cookies.get(LAST_WRITE_COOKIE)
+    try:
+        recent = bool(READ_YOUR_WRITES) and time.time() - float(last_write) < READ_YOUR_WRITES
+    except (TypeError, ValueError):
+        recent = False
+    db = SessionLocal() if recent else ReadSessionLocal()
+    request.state.recent_write = recent
+    request.state.read_primary = db.get_bind() is get_engine()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def set_next_cursor(response: Response, sort: str, attrs, rows, limit: int):
+    cursor = pagination.next_cursor(sort, attrs, rows, limit)
+    if cursor is not None:
+        response.headers["X-Next-Cursor"] = cursor
 
-@app.get("/movies/all", response_model=List[schemas.Movie])
-def read_allMovies( db: Session = Depends(get_db)):
-    movies = crud.get_allMovies(db)
+
+def write(db: Session, mutation, schema):
+    """ mutation(session) committed on db, or with WRITE_BATCH=1 queued in the group commit
+        of writebatch and converted to schema (or a list of schema) in the batch session
+    """
+    if not writebatch.WRITE_BATCH:
+        return mutation(db)
+    def batched(session: Session):
+        result = mutation(session)
+        if isinstance(result, list):
+            return [schema.from_orm(item) for item in result]
+        return schema.from_orm(result) if result is not None else None
+    return writebatch.writes.submit(batched)
+
+
+@router.get("/movies/", response_model=List[schemas.Movie])
+def read_movies(response: Response, skip: Optional[int] = 0, limit: Optional[int] = 100,
+        sort: schemas.MovieSort = schemas.MovieSort.id, after: Optional[str] = None,
+        db: Session = Depends(get_read_db)):
+    """ page of movies
+        sort (query param): keyset used for ordering, id or year
+        after (query param): cursor from the X-Next-Cursor header of the previous page
+    """
+    try:
+        movies = crud.get_movies(db, skip=skip, limit=limit, sort=sort.value, after=after,
+            as_rows=fastjson.FAST_SERIALIZATION)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    set_next_cursor(response, sort.value, crud.MOVIE_SORT_KEYS[sort.value], movies, limit)
+    if fastjson.FAST_SERIALIZATION:
+        return fastjson.rows_response(movies, schemas.Movie, headers=response.headers)
     return movies
 
-@app.get("/movies/by_id/{movie_id}", response_model=schemas.MovieDetail)
-def read_movie(movie_id: int, db: Session = Depends(get_db)):
-    db_movie = crud.get_movie(db, movie_id=movie_id)
-    if db_movie is None:
-        raise HTTPException(status_code=404, detail="Movie to read not found")
-    return db_movie
+@router.get("/movies/all", response_model=List[schemas.Movie])
+def read_allMovies():
+    """ all movies as a json list, streamed from the db cursor batch by batch """
+    columns = [models.Movie.title, models.Movie.year, models.Movie.duration, models.Movie.id]
+    batches = export.iter_batches(get_replicas().engine(), columns)
+    return StreamingResponse(
+        export.json_array_chunks(batches, [column.key for column in columns]),
+        media_type="application/json")
+
+@router.get("/export/{table}")
+def export_table(table: schemas.ExportTable, format: schemas.ExportFormat = schemas.ExportFormat.ndjson):
+    """ stream a whole table (movies, stars or play) as ndjson or csv
+        format (query param): ndjson (one json object per line) or csv (with header)
+    """
+    return StreamingResponse(
+        export.export_table(get_replicas().engine(), table.value, format.value),
+        media_type=export.MEDIA_TYPES[format.value],
+        headers={"Content-Disposition": 'attachment; filename="{}.{}"'.format(table.value, format.value)})
+
+@router.get("/movies/by_id/{movie_id}", response_model=schemas.MovieDetail)
+def read_movie(movie_id: int, request: Request, db: Session = Depends(get_read_db)):
+    def load():
+        db_movie = crud.get_movie(db, movie_id=movie_id)
+        if db_movie is None:
+            raise HTTPException(status_code=404, detail="Movie to read not found")
+        return schemas.MovieDetail.from_orm(db_movie), movie_tags(db_movie)
+    return cached_response(request, load, coalesce=True)
+
+
+def check_batch_size(ids: List[int]):
+    if len(ids) > crud.BY_IDS_MAX:
+        raise HTTPException(status_code=413, detail="At most {} ids per request".format(crud.BY_IDS_MAX))
+
+@router.post("/movies/by_ids", response_model=schemas.MoviesByIds)
+def read_movies_by_ids(ids: List[int], db: Session = Depends(get_read_db)):
+    """ several movies in one query
+        ids (body param): list of movie id, at most crud.BY_IDS_MAX
+    """
+    check_batch_size(ids)
+    found, missing = crud.get_movies_by_ids(db, ids=ids)
+    return {"found": found, "missing": missing}
+
+@router.post("/movies/by_ids/detail", response_model=schemas.MovieDetailsByIds)
+def read_movie_details_by_ids(ids: List[int], db: Session = Depends(get_read_db)):
+    """ several movies with director and actors in two queries
+        ids (body param): list of movie id, at most crud.BY_IDS_MAX
+    """
+    check_batch_size(ids)
+    found, missing = crud.get_movies_by_ids(db, ids=ids, detail=True)
+    return {"found": found, "missing": missing}
 
 
-@app.get("/movie/by_title", response_model=List[schemas.Movie])
-def read_movie_by_title(searchTitle: Optional[str] = None, db: Session = Depends(get_db)):
+@router.get("/movie/by_title", response_model=List[schemas.Movie])
+def read_movie_by_title(searchTitle: Optional[str] = None, db: Session = Depends(get_read_db)):
     movie = crud.get_movies_by_title(db=db, title=searchTitle)
     return movie
 
 
-@app.get("/movie/by_partTitle", response_model=List[schemas.Movie])
-def read_movie_by_partTitle(searchTitle: Optional[str] = None, db: Session = Depends(get_db)):
+@router.get("/movie/by_partTitle", response_model=List[schemas.Movie])
+def read_movie_by_partTitle(searchTitle: Optional[str] = None, db: Session = Depends(get_read_db)):
     movie = crud.get_movies_by_parttitle(db=db, title=searchTitle)
     return movie
 
 
-@app.get("/movies/by_title_year", response_model=List[schemas.Movie])
-def read_movies_by_title_year(t: str, y: int, db: Session = Depends(get_db)):
+@router.get("/search/movies", response_model=List[schemas.Movie])
+def search_movies(q: str, limit: Optional[int] = 20, prefix: Optional[bool] = True, db: Session = Depends(get_read_db)):
+    """ ranked title search, served by the fulltext/trigram index
+        q (query param): words, each one matching the start of a word of the title
+        prefix (query param): false to match whole words only
+    """
+    return crud.search_movies(db=db, q=q, limit=limit, prefix=prefix)
+
+
+@router.get("/movies/search", response_model=List[Dict[str, Any]])
+def filter_movies(title: Optional[str] = None, year_min: Optional[int] = None, year_max: Optional[int] = None,
+        duration_min: Optional[int] = None, duration_max: Optional[int] = None,
+        director_id: Optional[int] = None, director: Optional[str] = None,
+        actor_id: Optional[int] = None, actor: Optional[str] = None,
+        sort: schemas.MovieFilterSort = schemas.MovieFilterSort.id, skip: int = Query(0, ge=0),
+        limit: int = Query(100, ge=1, le=crud.MOVIE_FILTER_MAX_LIMIT),
+        fields: Optional[str] = None, db: Session = Depends(get_read_db)):
+    """ movies matching all the given filters, in one query
+        title, director, actor (query params): part of the title / name
+        director_id, actor_id (query params): star id
+        sort (query param): id, year, -year, title, duration, -duration
+        skip (query param): >= 0, limit (query param): 1 to 1000, else 422
+        fields (query param): comma separated fields to return (title,year,duration,id), all by default
+    """
+    selected = None
+    if fields is not None:
+        selected = [name.strip() for name in fields.split(",")]
+        unknown = set(selected) - set(schemas.Movie.__fields__)
+        if unknown:
+            raise HTTPException(status_code=400, detail="unknown fields: {}".format(", ".join(sorted(unknown))))
+    return crud.filter_movies(db=db, title=title, year_min=year_min, year_max=year_max,
+        duration_min=duration_min, duration_max=duration_max,
+        director_id=director_id, director=director, actor_id=actor_id, actor=actor,
+        sort=sort.value, skip=skip, limit=limit, fields=selected)
+
+
+@router.get("/movies/by_title_year", response_model=List[schemas.Movie])
+def read_movies_by_title_year(t: str, y: int, db: Session = Depends(get_read_db)):
     return crud.get_movies_by_title_year(db=db, title=t, year=y)
 
 
-@app.get("/movies/by_director", response_model=List[schemas.Movie])
-def read_movies_by_director(n: str, db: Session = Depends(get_db)):
+@router.get("/movies/by_director", response_model=List[schemas.Movie])
+def read_movies_by_director(n: str, db: Session = Depends(get_read_db)):
     return crud.get_movies_by_director_endname(db=db, endname=n)
 
 
-@app.get("/movies/by_actor", response_model=List[schemas.Movie])
-def read_movies_by_actor(n: str, db: Session = Depends(get_db)):
+@router.get("/movies/by_actor", response_model=List[schemas.Movie])
+def read_movies_by_actor(n: str, db: Session = Depends(get_read_db)):
     return crud.get_movies_by_actor_endname(db=db, endname=n)
 
 
-@app.get("/director/by_id_movie/{idMovie}", response_model=schemas.Star)
-def read_director_by_movie(idMovie: int, db: Session = Depends(get_db)):
-    director = crud.get_director_by_movie(db=db, idMovie=idMovie)
-    if director is None:
-        raise HTTPException(status_code=404, detail="Star to read not found")
-    return director
+@router.get("/director/by_id_movie/{idMovie}", response_model=schemas.Star)
+def read_director_by_movie(idMovie: int, request: Request, db: Session = Depends(get_read_db)):
+    def load():
+        director = crud.get_director_by_movie(db=db, idMovie=idMovie)
+        if director is None:
+            raise HTTPException(status_code=404, detail="Star to read not found")
+        return schemas.Star.from_orm(director), {"movie:{}".format(idMovie), "star:{}".format(director.id)}
+    return cached_response(request, load, coalesce=True)
 
 
-@app.get("/actor/by_movie_title", response_model=List[List[schemas.Star]])
-def read_actor_by_movie_title(movieTitle: str, db: Session = Depends(get_db)):
-    actors = crud.get_actor_by_movie_title(db=db, movieTitle=movieTitle)
-    if actors is None:
-        raise HTTPException(status_code=404, detail="Star to read not found")
-    return actors
+@router.get("/actor/by_movie_title", response_model=List[List[schemas.Star]])
+def read_actor_by_movie_title(movieTitle: str, request: Request, db: Session = Depends(get_read_db)):
+    def load():
+        actors = crud.get_actor_by_movie_title(db=db, movieTitle=movieTitle)
+        if actors is None:
+            raise HTTPException(status_code=404, detail="Star to read not found")
+        return [[schemas.Star.from_orm(actor) for actor in movie_actors] for movie_actors in actors]
+    return coalesced_response(request, load)
 
 
-@app.post("/movie/", response_model=schemas.Movie)
+@router.post("/movie/", response_model=schemas.Movie)
 def create_movie(movie: schemas.MovieCreate, db: Session = Depends(get_db)):
-    return crud.create_movie(db=db, movie=movie)
+    return write(db, lambda session: crud.create_movie(db=session, movie=movie), schemas.Movie)
 
 
-@app.put("/movie/", response_model=schemas.Movie)
+@router.put("/movie/", response_model=schemas.Movie)
 def update_movie(movie: schemas.Movie, db: Session = Depends(get_db)):
-    db_movie = crud.update_movie(db, movie=movie)
+    db_movie = write(db, lambda session: crud.update_movie(session, movie=movie), schemas.Movie)
     if db_movie is None:
         raise HTTPException(status_code=404, detail="Movie to update not found")
     return db_movie
 
 
-@app.delete("/movie/{movie_id}", response_model=schemas.Movie)
+@router.delete("/movie/{movie_id}", response_model=schemas.Movie)
 def delete_movie(movie_id: int, db: Session = Depends(get_db)):
-    db_movie = crud.delete_movie(db, movie_id=movie_id)
+    db_movie = write(db, lambda session: crud.delete_movie(session, movie_id=movie_id), schemas.Movie)
     if db_movie is None:
         raise HTTPException(status_code=404, detail="Movie to delete not found")
     return db_movie
 
 
-@app.get("/movies/by_range_year", response_model=List[schemas.Movie])
-def get_movie_by_range_year(year_min: Optional[int] = None, year_max: Optional[int] = None, db: Session = Depends(get_db)):
-    movie = crud.get_movies_by_range_year(db = db, year_min = year_min, year_max = year_max)
+@router.get("/movies/by_range_year", response_model=List[schemas.Movie])
+def get_movie_by_range_year(year_min: Optional[int] = None, year_max: Optional[int] = None, db: Session = Depends(get_read_db)):
+    movie = crud.get_movies_by_range_year(db = db, year_min = year_min, year_max = year_max,
+        as_rows=fastjson.FAST_SERIALIZATION)
+    if fastjson.FAST_SERIALIZATION and movie is not None:
+        return fastjson.rows_response(movie, schemas.Movie)
     return movie
 
 #movie's route stat
 
-@app.get("/movies/count_by_year/")
-def count_movie_by_year(db: Session = Depends(get_db)) -> List[Tuple[int,int]]:
-    return crud.get_movies_count_by_year(db=db)
+@router.get("/movies/count_by_year/")
+def count_movie_by_year(request: Request, year_min: Optional[int] = None, year_max: Optional[int] = None,
+        db: Session = Depends(get_read_db)) -> List[Tuple[int,int]]:
+    return cached_response(request, lambda: (
+        crud.get_movies_count_by_year(db=db, year_min=year_min, year_max=year_max), {"stats"}), coalesce=True)
 
-@app.get("/movies/stat_duration/")
-def read_movie_stat_duration(db: Session = Depends(get_db)) -> Dict:
-    return crud.get_movies_stat_duration(db=db)
+@router.get("/movies/stat_duration/")
+def read_movie_stat_duration(request: Request, db: Session = Depends(get_read_db)) -> Dict:
+    return cached_response(request, lambda: (crud.get_movies_stat_duration(db=db), {"stats"}), coalesce=True)
 
 
 #routes Star
 
-@app.get("/stars", response_model=List[schemas.Star])
-def read_stars(skip: Optional[int] = 0, limit: Optional[int] = 100, db: Session = Depends(get_db)):
-    stars = crud.get_stars(db, skip=skip, limit=limit)
+@router.get("/stars", response_model=List[schemas.Star])
+def read_stars(response: Response, skip: Optional[int] = 0, limit: Optional[int] = 100,
+        sort: schemas.StarSort = schemas.StarSort.id, after: Optional[str] = None,
+        db: Session = Depends(get_read_db)):
+    """ page of stars
+        sort (query param): keyset used for ordering, id or name
+        after (query param): cursor from the X-Next-Cursor header of the previous page
+    """
+    try:
+        stars = crud.get_stars(db, skip=skip, limit=limit, sort=sort.value, after=after,
+            as_rows=fastjson.FAST_SERIALIZATION)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    set_next_cursor(response, sort.value, crud.STAR_SORT_KEYS[sort.value], stars, limit)
+    if fastjson.FAST_SERIALIZATION:
+        return fastjson.rows_response(stars, schemas.Star, headers=response.headers)
     return stars
 
 
-@app.get("/stars/by_id/{star_id}", response_model=schemas.Star)
-def read_star(star_id: int, db: Session = Depends(get_db)):
-    db_star = crud.get_star(db, star_id=star_id)
-    if db_star is None:
-        raise HTTPException(status_code=404, detail="Star to read not found")
-    return db_star
+@router.get("/stars/by_id/{star_id}", response_model=schemas.Star)
+def read_star(star_id: int, request: Request, db: Session = Depends(get_read_db)):
+    def load():
+        db_star = crud.get_star(db, star_id=star_id)
+        if db_star is None:
+            raise HTTPException(status_code=404, detail="Star to read not found")
+        return schemas.Star.from_orm(db_star), {"star:{}".format(star_id)}
+    return cached_response(request, load, coalesce=True)
+
+
+@router.post("/stars/by_ids", response_model=schemas.StarsByIds)
+def read_stars_by_ids(ids: List[int], db: Session = Depends(get_read_db)):
+    """ several stars in one query
+        ids (body param): list of star id, at most crud.BY_IDS_MAX
+    """
+    check_batch_size(ids)
+    found, missing = crud.get_stars_by_ids(db, ids=ids)
+    return {"found": found, "missing": missing}
 
 
-@app.get("/stars/by_name")
-def read_star_by_name(starName: Optional[str] = None, db: Session = Depends(get_db)):
+@router.get("/stars/by_name")
+def read_star_by_name(starName: Optional[str] = None, db: Session = Depends(get_read_db)):
     star = crud.get_stars_by_name(db=db, name=starName)
     return star
 
 
-@app.get("/stars/by_partname", response_model=List[schemas.Star])
-def read_movie_by_partname(starName: Optional[str] = None, db: Session = Depends(get_db)):
+@router.get("/stars/by_partname", response_model=List[schemas.Star])
+def read_movie_by_partname(starName: Optional[str] = None, db: Session = Depends(get_read_db)):
     star = crud.get_stars_by_partname(db=db, name=starName)
     return star
 
 
-@app.post("/star/", response_model=schemas.Star)
+@router.get("/search/stars", response_model=List[schemas.Star])
+def search_stars(q: str, limit: Optional[int] = 20, prefix: Optional[bool] = True, db: Session = Depends(get_read_db)):
+    """ ranked name search, served by the fulltext/trigram index
+        q (query param): words, each one matching the start of a word of the name
+        prefix (query param): false to match whole words only
+    """
+    return crud.search_stars(db=db, q=q, limit=limit, prefix=prefix)
+
+
+@router.post("/star/", response_model=schemas.Star)
 def create_star(star: schemas.StarCreate, db: Session = Depends(get_db)):
-    return crud.create_star(db=db, star=star)
+    return write(db, lambda session: crud.create_star(db=session, star=star), schemas.Star)
 
 
-@app.put("/star/", response_model=schemas.Star)
+@router.put("/star/", response_model=schemas.Star)
 def update_star(star: schemas.Star, db: Session = Depends(get_db)):
-    db_star = crud.update_star(db, star=star)
+    db_star = write(db, lambda session: crud.update_star(session, star=star), schemas.Star)
     if db_star is None:
         raise HTTPException(status_code=404, detail="Star to update not found")
     return db_star
 
 
-@app.delete("/star/{star_id}", response_model=schemas.Star)
+@router.delete("/star/{star_id}", response_model=schemas.Star)
 def delete_star(star_id: int, db: Session = Depends(get_db)):
-    db_star = crud.delete_star(db, star_id=star_id)
+    db_star = write(db, lambda session: crud.delete_star(session, star_id=star_id), schemas.Star)
     if db_star is None:
         raise HTTPException(status_code=404, detail="Star to delete not found")
     return db_star
 
 
-@app.get("/stars/by_birthyear/{year}", response_model=List[schemas.Star])
-def get_star_by_birthyear(year: int, db: Session = Depends(get_db)):
+@router.get("/stars/by_birthyear/{year}", response_model=List[schemas.Star])
+def get_star_by_birthyear(year: int, db: Session = Depends(get_read_db)):
     star = crud.get_star_by_birthyear(db = db, year = year)
     return star
 
 
 # Stars's route stat
 
-@app.get("/stars/stat_movie_by_director/")
-def read_movie_stat_director(min_count: Optional[int] = 10, db: Session = Depends(get_db)):
-    return crud.get_movie_stat_director(min_count = min_count,db=db)
+@router.get("/stars/stat_movie_by_director/")
+def read_movie_stat_director(request: Request, min_count: Optional[int] = 10, db: Session = Depends(get_read_db)):
+    return cached_response(request, lambda: (crud.get_movie_stat_director(min_count = min_count,db=db), {"stats"}), coalesce=True)
 
 
-@app.get("/stars/stat_count_movie_by_actor/")
-def get_count_movie_by_actor(min_count: Optional[int] = 10, db: Session = Depends(get_db)):
-    return crud.get_count_movie_by_actor(min_count = min_count,db=db)
+@router.get("/stars/stat_count_movie_by_actor/")
+def get_count_movie_by_actor(request: Request, min_count: Optional[int] = 10, db: Session = Depends(get_read_db)):
+    return cached_response(request, lambda: (crud.get_count_movie_by_actor(min_count = min_count,db=db), {"stats"}), coalesce=True)
 
 
-@app.get("/stars/stat_first_movie_by_actor/")
-def get_first_movie_by_actor(min_count: Optional[int] = 10, db: Session = Depends(get_db)):
-    return crud.get_first_movie_by_actor(min_count = min_count,db=db)
+@router.get("/stars/stat_first_movie_by_actor/")
+def get_first_movie_by_actor(request: Request, min_count: Optional[int] = 10, db: Session = Depends(get_read_db)):
+    return cached_response(request, lambda: (crud.get_first_movie_by_actor(min_count = min_count,db=db), {"stats"}), coalesce=True)
 
 
-@app.get("/stars/stat_last_movie_by_actor/")
-def get_last_movie_by_actor(min_count: Optional[int] = 10, db: Session = Depends(get_db)):
-    return crud.get_last_movie_by_actor(min_count = min_count,db=db)
+@router.get("/stars/stat_last_movie_by_actor/")
+def get_last_movie_by_actor(request: Request, min_count: Optional[int] = 10, db: Session = Depends(get_read_db)):
+    return cached_response(request, lambda: (crud.get_last_movie_by_actor(min_count = min_count,db=db), {"stats"}), coalesce=True)
 
 
-@app.get("/stars/stat_movies")
-def get_stat_movie_by_actor(min_count: Optional[int] = 10,db: Session = Depends(get_db)):
-    return crud.get_stat_movie_by_actor(db=db, min_count=min_count)
+@router.get("/stars/stat_movies")
+def get_stat_movie_by_actor(request: Request, min_count: Optional[int] = 10,db: Session = Depends(get_read_db)):
+    return cached_response(request, lambda: (crud.get_stat_movie_by_actor(db=db, min_count=min_count), {"stats"}), coalesce=True)
 
 # routes with join
 
-@app.put("/movies/director/", response_model=schemas.MovieDetail)
+@router.put("/movies/director/", response_model=schemas.MovieDetail)
 def update_movie_director(mid: int, sid: int, db: Session = Depends(get_db)):
-    db_movie = crud.update_movie_director(db=db, movie_id=mid, director_id=sid)
+    db_movie = write(db, lambda session: crud.update_movie_director(db=session, movie_id=mid, director_id=sid),
+        schemas.MovieDetail)
     if db_movie is None:
         raise HTTPException(status_code=404, detail="Movie or Star not found")
     return db_movie
 
-@app.post("/movies/actor/", response_model=schemas.MovieDetail)
+@router.post("/movies/actor/", response_model=schemas.MovieDetail)
 def add_movie_actor(mid: int, sid: int, db: Session = Depends(get_db)):
     """ add one actor to a movie
         mid (query param): movie id
         sid (query param): star id to add in movie.actors
     """
-    db_movie = crud.add_movie_actor(db=db, movie_id=mid, actor_id=sid)
+    db_movie = write(db, lambda session: crud.add_movie_actor(db=session, movie_id=mid, actor_id=sid),
+        schemas.MovieDetail)
     if db_movie is None:
         raise HTTPException(status_code=404, detail="Movie or Star not found or star already in actors")
     return db_movie
 
-@app.put("/movies/actors/", response_model=schemas.MovieDetail)
+@router.put("/movies/actors/", response_model=schemas.MovieDetail)
 def update_movie_actors(mid: int, sids: List[int], db: Session = Depends(get_db)):
     """ replace actors from a movie
         mid (query param): movie id
         sids (body param): list of star id to replace movie.actors
     """
-    db_movie = crud.update_movie_actor(db=db, movie_id=mid, actors_id=sids)
+    db_movie = write(db, lambda session: crud.update_movie_actor(db=session, movie_id=mid, actors_id=sids),
+        schemas.MovieDetail)
     if db_movie is None:
         raise HTTPException(status_code=404, detail="Movie or Star not found or star already in actors")
-    return db_movie
\ No newline at end of file
+    return db_movie
+
+@router.put("/movies/actors/batch", response_model=List[schemas.MovieDetail])
+def update_movies_actors(casts: List[schemas.MovieCast], db: Session = Depends(get_db)):
+    """ replace actors of several movies in one transaction
+        casts (body param): list of {mid: movie id, sids: list of star id}
+    """
+    db_movies = write(db, lambda session: crud.update_movies_actors(db=session, casts={cast.mid: cast.sids for cast in casts}),
+        schemas.MovieDetail)
+    if db_movies is None:
+        raise HTTPException(status_code=404, detail="Movie or Star not found")
+    return db_movies
+
+
+# bulk import
+
+@router.post("/bulk/{table}")
+async def bulk_load(table: schemas.ExportTable, request: Request,
+        format: schemas.ExportFormat = schemas.ExportFormat.ndjson, db: Session = Depends(get_db)):
+    """ upsert the rows of the request body (ndjson lines or csv with header) into a table
+        rows are written in batches, existing ids are updated
+    """
+    body = (await request.body()).decode("utf-8")
+    try:
+        return await run_in_threadpool(bulk.load, db, table.value, format.value, io.StringIO(body))
+    except bulk.BulkError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# stats aggregates
+
+@router.get("/stats/freshness")
+def read_stats_freshness(db: Session = Depends(get_read_db)):
+    """ built: aggregate tables in use (else live GROUP BY), rebuilt_at / updated_at: utc timestamps """
+    return stats.freshness(db)
+
+
+@router.post("/stats/rebuild")
+def rebuild_stats(db: Session = Depends(get_db)):
+    stats.rebuild(db)
+    cache.invalidate("stats")
+    return stats.freshness(db)
+
+
+# probes
+
+@router.get("/health")
+def read_health():
+    """ liveness: the worker answers, no database access """
+    return {"status": "ok", "pid": os.getpid()}
+
+
+@router.get("/ready")
+def read_ready():
+    """ readiness: 200 once this worker is warmed up (see lifecycle.py) and the database answers, 503 before """
+    status = lifecycle.readiness.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+# database pool
+
+@router.get("/db/pool")
+def read_pool_metrics():
+    """ connection pool state (size, checkedout, overflow) and checkout wait times in seconds,
+        of the primary and of each replica
+    """
+    return dict(pool_metrics(get_engine()), replicas=get_replicas().status())
+
+
+# write batching
+
+@router.get("/writes/stats")
+def read_write_stats():
+    """ group commit of the write routes (WRITE_BATCH=1): writes, batches, errors, batch sizes,
+        flush latency percentiles in ms (first write queued -> commit) and writes per second
+    """
+    return writebatch.writes.stats.as_dict()
+
+
+# instrumentation
+
+@router.get("/metrics")
+def read_metrics():
+    """ per route latency histogram, sql queries / time / rows and serialization time, then the
+        connection pools by engine (pool="primary", "replica0", ...), prometheus text format
+    """
+    content = metrics.registry.exposition() + metrics.pool_exposition(get_replicas().pools())
+    return Response(content=content, media_type="text/plain; version=0.0.4")
+
+
+# cache
+
+@router.get("/cache/stats")
+def read_cache_stats():
+    """ hit / miss / eviction / invalidation counters of the response cache
+        singleflight: loads run (leaders), requests served by another one's load (coalesced), waits given up (timeouts)
+    """
+    return dict(cache.stats.as_dict(), singleflight=flights.stats.as_dict())
+
+
+# collaboration graph
+
+@router.get("/graph/costars/{star_id}", response_model=List[schemas.CoStar])
+def read_costars(star_id: int, limit: Optional[int] = 20, db: Session = Depends(get_read_db)):
+    """ stars who played with a star, most shared movies first
+        limit (query param): max number of co-stars
+    """
+    costars = crud.get_costars(db=db, star_id=star_id, limit=limit)
+    if costars is None:
+        raise HTTPException(status_code=404, detail="Star to read not found")
+    return costars
+
+
+@router.get("/graph/separation", response_model=schemas.Separation)
+def read_separation(from_id: int, to_id: int, db: Session = Depends(get_read_db)):
+    """ degrees of separation between 2 stars through shared movies
+        from_id, to_id (query params): star ids
+    """
+    separation = crud.get_separation(db=db, from_id=from_id, to_id=to_id)
+    if separation is None:
+        raise HTTPException(status_code=404, detail="Stars not found or not connected")
+    return separation
+
+
+@router.get("/graph/most_connected", response_model=List[schemas.ConnectedStar])
+def read_most_connected(limit: Optional[int] = 20, db: Session = Depends(get_read_db)):
+    """ stars with the most distinct co-stars """
+    return crud.get_most_connected(db=db, limit=limit)
+
+
+# in-memory analytics (numpy)
+
+def analytics_result(result):
+    if result is None:
+        raise HTTPException(status_code=503, detail="Analytics need numpy")
+    return result
+
+
+@router.get("/analytics/years")
+def read_analytics_years(year_min: Optional[int] = None, year_max: Optional[int] = None, db: Session = Depends(get_read_db)):
+    """ per year: movie count, duration min / max / mean and p50 / p90 / p99 """
+    return analytics_result(crud.get_analytics_years(db=db, year_min=year_min, year_max=year_max))
+
+
+@router.get("/analytics/durations")
+def read_analytics_durations(bins: int = 20, year_min: Optional[int] = None, year_max: Optional[int] = None,
+        db: Session = Depends(get_read_db)):
+    """ histogram (edges, counts) and percentiles of the movie durations
+        bins (query param): number of histogram bins
+    """
+    if not 1 <= bins <= 1000:
+        raise HTTPException(status_code=400, detail="bins must be between 1 and 1000")
+    return analytics_result(crud.get_analytics_durations(db=db, bins=bins, year_min=year_min, year_max=year_max))
+
+
+@router.get("/analytics/directors")
+def read_analytics_directors(min_count: int = 1, limit: int = 100, db: Session = Depends(get_read_db)):
+    """ per director: movie count, first / last year and duration stats, most movies first """
+    return analytics_result(crud.get_analytics_directors(db=db, min_count=min_count, limit=limit))
+
+
+@router.get("/analytics/careers")
+def read_analytics_careers(min_count: int = 1, limit: int = 20, sort: schemas.CareerSort = schemas.CareerSort.span,
+        db: Session = Depends(get_read_db)):
+    """ career spans of the actors (first / last year of play) with at least min_count movies
+        summary (mean, max, percentiles of the span) and top actors by span or count
+    """
+    return analytics_result(crud.get_analytics_careers(db=db, min_count=min_count, limit=limit, sort=sort.value))
+
+
+# app
+
+def on_startup():
+    logger.info("API started, worker %s", os.getpid())
+    lifecycle.readiness.start()
+
+
+def create_app(overrides: Optional[APIRouter] = None) -> FastAPI:
+    """ the api: routes of overrides first, then the routes of router they don't define
+        no database access here, see lifecycle.py for the schema step and the warm-up
+    """
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.add_event_handler("startup", on_startup)
+    routes = list(overrides.routes) if overrides is not None else []
+    defined = {(route.path, frozenset(route.methods)) for route in routes if isinstance(route, APIRoute)}
+    app.router.routes.extend(routes)
+    app.router.routes.extend(route for route in router.routes
+                             if not isinstance(route, APIRoute) or (route.path, frozenset(route.methods)) not in defined)
+    return app
+
+
+app = create_app()
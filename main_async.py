@@ -0,0 +1,211 @@
+"""
+main_async.py : same api as main.py on the async database path
+
+    uvicorn main_async:app      (async mode: AsyncEngine + async routes)
+    uvicorn main:app            (sync mode, unchanged)
+
+The movie and star routes are async and use crud_async on an AsyncSession,
+on the primary (DATABASE_REPLICA_URLS is not used by them). The other
+routes of main.py (stats, export, cache, ...) are mounted unchanged and
+keep running in the threadpool on the sync engine, replicas included.
+"""
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import crud, crud_async, metrics, schemas
+import main
+from cache import cached_response_async, coalesced_response_async, movie_tags
+from database import AsyncSessionLocal
+
+router = APIRouter(route_class=metrics.TimedRoute)
+
+# Dependency
+async def get_db():
+    """ session on the primary for every route, reads included: the async path has no
+        replica engines, so it reads its own writes and fills the cache from the primary
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+@router.get("/movies/", response_model=List[schemas.Movie])
+async def read_movies(response: Response, skip: Optional[int] = 0, limit: Optional[int] = 100,
+        sort: schemas.MovieSort = schemas.MovieSort.id, after: Optional[str] = None,
+        db: AsyncSession = Depends(get_db)):
+    try:
+        movies = await crud_async.get_movies(db, skip=skip, limit=limit, sort=sort.value, after=after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    main.set_next_cursor(response, sort.value, crud.MOVIE_SORT_KEYS[sort.value], movies, limit)
+    return movies
+
+@router.get("/movies/by_id/{movie_id}", response_model=schemas.MovieDetail)
+async def read_movie(movie_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    async def load():
+        movie = await crud_async.get_movie(db, movie_id=movie_id)
+        if movie is None:
+            raise HTTPException(status_code=404, detail="Movie to read not found")
+        return movie, movie_tags(movie)
+    return await cached_response_async(request, load, coalesce=True)
+
+
+@router.get("/movie/by_title", response_model=List[schemas.Movie])
+async def read_movie_by_title(searchTitle: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    return await crud_async.get_movies_by_title(db=db, title=searchTitle)
+
+
+@router.get("/movie/by_partTitle", response_model=List[schemas.Movie])
+async def read_movie_by_partTitle(searchTitle: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    return await crud_async.get_movies_by_parttitle(db=db, title=searchTitle)
+
+
+@router.get("/search/movies", response_model=List[schemas.Movie])
+async def search_movies(q: str, limit: Optional[int] = 20, prefix: Optional[bool] = True, db: AsyncSession = Depends(get_db)):
+    return await crud_async.search_movies(db=db, q=q, limit=limit, prefix=prefix)
+
+
+@router.get("/movies/by_title_year", response_model=List[schemas.Movie])
+async def read_movies_by_title_year(t: str, y: int, db: AsyncSession = Depends(get_db)):
+    return await crud_async.get_movies_by_title_year(db=db, title=t, year=y)
+
+
+@router.get("/movies/by_director", response_model=List[schemas.Movie])
+async def read_movies_by_director(n: str, db: AsyncSession = Depends(get_db)):
+    return await crud_async.get_movies_by_director_endname(db=db, endname=n)
+
+
+@router.get("/movies/by_actor", response_model=List[schemas.Movie])
+async def read_movies_by_actor(n: str, db: AsyncSession = Depends(get_db)):
+    return await crud_async.get_movies_by_actor_endname(db=db, endname=n)
+
+
+@router.get("/director/by_id_movie/{idMovie}", response_model=schemas.Star)
+async def read_director_by_movie(idMovie: int, request: Request, db: AsyncSession = Depends(get_db)):
+    async def load():
+        director = await crud_async.get_director_by_movie(db=db, idMovie=idMovie)
+        if director is None:
+            raise HTTPException(status_code=404, detail="Star to read not found")
+        return director, {"movie:{}".format(idMovie), "star:{}".format(director.id)}
+    return await cached_response_async(request, load, coalesce=True)
+
+
+@router.get("/actor/by_movie_title", response_model=List[List[schemas.Star]])
+async def read_actor_by_movie_title(movieTitle: str, request: Request, db: AsyncSession = Depends(get_db)):
+    return await coalesced_response_async(request,
+        lambda: crud_async.get_actor_by_movie_title(db=db, movieTitle=movieTitle))
+
+
+@router.post("/movie/", response_model=schemas.Movie)
+async def create_movie(movie: schemas.MovieCreate, db: AsyncSession = Depends(get_db)):
+    return await crud_async.create_movie(db=db, movie=movie)
+
+
+@router.put("/movie/", response_model=schemas.Movie)
+async def update_movie(movie: schemas.Movie, db: AsyncSession = Depends(get_db)):
+    db_movie = await crud_async.update_movie(db, movie=movie)
+    if db_movie is None:
+        raise HTTPException(status_code=404, detail="Movie to update not found")
+    return db_movie
+
+
+@router.delete("/movie/{movie_id}", response_model=schemas.Movie)
+async def delete_movie(movie_id: int, db: AsyncSession = Depends(get_db)):
+    db_movie = await crud_async.delete_movie(db, movie_id=movie_id)
+    if db_movie is None:
+        raise HTTPException(status_code=404, detail="Movie to delete not found")
+    return db_movie
+
+
+@router.get("/movies/by_range_year", response_model=List[schemas.Movie])
+async def get_movie_by_range_year(year_min: Optional[int] = None, year_max: Optional[int] = None, db: AsyncSession = Depends(get_db)):
+    return await crud_async.get_movies_by_range_year(db=db, year_min=year_min, year_max=year_max)
+
+
+#routes Star
+
+@router.get("/stars", response_model=List[schemas.Star])
+async def read_stars(response: Response, skip: Optional[int] = 0, limit: Optional[int] = 100,
+        sort: schemas.StarSort = schemas.StarSort.id, after: Optional[str] = None,
+        db: AsyncSession = Depends(get_db)):
+    try:
+        stars = await crud_async.get_stars(db, skip=skip, limit=limit, sort=sort.value, after=after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    main.set_next_cursor(response, sort.value, crud.STAR_SORT_KEYS[sort.value], stars, limit)
+    return stars
+
+
+@router.get("/stars/by_id/{star_id}", response_model=schemas.Star)
+async def read_star(star_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    async def load():
+        star = await crud_async.get_star(db, star_id=star_id)
+        if star is None:
+            raise HTTPException(status_code=404, detail="Star to read not found")
+        return star, {"star:{}".format(star_id)}
+    return await cached_response_async(request, load, coalesce=True)
+
+
+@router.get("/stars/by_partname", response_model=List[schemas.Star])
+async def read_movie_by_partname(starName: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    return await crud_async.get_stars_by_partname(db=db, name=starName)
+
+
+@router.get("/search/stars", response_model=List[schemas.Star])
+async def search_stars(q: str, limit: Optional[int] = 20, prefix: Optional[bool] = True, db: AsyncSession = Depends(get_db)):
+    return await crud_async.search_stars(db=db, q=q, limit=limit, prefix=prefix)
+
+
+@router.post("/star/", response_model=schemas.Star)
+async def create_star(star: schemas.StarCreate, db: AsyncSession = Depends(get_db)):
+    return await crud_async.create_star(db=db, star=star)
+
+
+@router.put("/star/", response_model=schemas.Star)
+async def update_star(star: schemas.Star, db: AsyncSession = Depends(get_db)):
+    db_star = await crud_async.update_star(db, star=star)
+    if db_star is None:
+        raise HTTPException(status_code=404, detail="Star to update not found")
+    return db_star
+
+
+@router.delete("/star/{star_id}", response_model=schemas.Star)
+async def delete_star(star_id: int, db: AsyncSession = Depends(get_db)):
+    db_star = await crud_async.delete_star(db, star_id=star_id)
+    if db_star is None:
+        raise HTTPException(status_code=404, detail="Star to delete not found")
+    return db_star
+
+
+@router.get("/stars/by_birthyear/{year}", response_model=List[schemas.Star])
+async def get_star_by_birthyear(year: int, db: AsyncSession = Depends(get_db)):
+    return await crud_async.get_star_by_birthyear(db=db, year=year)
+
+
+# routes with join
+
+@router.put("/movies/director/", response_model=schemas.MovieDetail)
+async def update_movie_director(mid: int, sid: int, db: AsyncSession = Depends(get_db)):
+    db_movie = await crud_async.update_movie_director(db=db, movie_id=mid, director_id=sid)
+    if db_movie is None:
+        raise HTTPException(status_code=404, detail="Movie or Star not found")
+    return db_movie
+
+@router.post("/movies/actor/", response_model=schemas.MovieDetail)
+async def add_movie_actor(mid: int, sid: int, db: AsyncSession = Depends(get_db)):
+    db_movie = await crud_async.add_movie_actor(db=db, movie_id=mid, actor_id=sid)
+    if db_movie is None:
+        raise HTTPException(status_code=404, detail="Movie or Star not found or star already in actors")
+    return db_movie
+
+@router.put("/movies/actors/", response_model=schemas.MovieDetail)
+async def update_movie_actors(mid: int, sids: List[int], db: AsyncSession = Depends(get_db)):
+    db_movie = await crud_async.update_movie_actor(db=db, movie_id=mid, actors_id=sids)
+    if db_movie is None:
+        raise HTTPException(status_code=404, detail="Movie or Star not found or star already in actors")
+    return db_movie
+
+
+# with every other route of main.py, still sync
+app = main.create_app(router)
@@ -0,0 +1,225 @@
+"""
+main_snapshot.py : same api as main.py, catalog reads served from a snapshot file
+
+    python snapshot.py build catalog.snap
+    SNAPSHOT_PATH=catalog.snap uvicorn main_snapshot:app --workers 4
+
+The movie and star read routes answer from the mmap'd snapshot (see
+snapshot.py), no database session: the workers share the file pages.
+Writes and every other route of main.py are mounted unchanged and use the
+database, the snapshot only changes on POST /snapshot/rebuild (or when the
+file is replaced by `python snapshot.py build`), so reads are as fresh as
+the last build.
+"""
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+
+import crud, fastjson, metrics, pagination, schemas, snapshot
+import main
+from database import SessionLocal
+
+router = APIRouter(route_class=metrics.TimedRoute)
+
+
+def json_response(value, headers=None) -> Response:
+    return Response(content=fastjson.dumps(value), media_type="application/json", headers=headers)
+
+
+def movies_response(snap: snapshot.Snapshot, indexes: List[int], headers=None) -> Response:
+    return fastjson.rows_response([snap.movie(i) for i in indexes], schemas.Movie, headers=headers)
+
+
+def stars_response(snap: snapshot.Snapshot, indexes: List[int], headers=None) -> Response:
+    return fastjson.rows_response([snap.star(i) for i in indexes], schemas.Star, headers=headers)
+
+
+def decode_after(after: Optional[str], sort: str, attrs, schema) -> Optional[list]:
+    """ cursor values, of the types of the schema fields attrs: compared with the
+        snapshot columns, a value of another type would raise a TypeError (500)
+    """
+    if after is None:
+        return None
+    try:
+        return pagination.decode_cursor(after, sort, len(attrs), [schema.__fields__[attr].type_ for attr in attrs])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/movies/", response_model=List[schemas.Movie])
+def read_movies(response: Response, skip: Optional[int] = 0, limit: Optional[int] = 100,
+        sort: schemas.MovieSort = schemas.MovieSort.id, after: Optional[str] = None):
+    snap = snapshot.current()
+    attrs = crud.MOVIE_SORT_KEYS[sort.value]
+    movies = [snap.movie(i) for i in snap.movies_page(sort.value, decode_after(after, sort.value, attrs, schemas.Movie), skip, limit)]
+    main.set_next_cursor(response, sort.value, attrs, movies, limit)
+    return fastjson.rows_response(movies, schemas.Movie, headers=response.headers)
+
+@router.get("/movies/by_id/{movie_id}", response_model=schemas.MovieDetail)
+def read_movie(movie_id: int):
+    snap = snapshot.current()
+    i = snap.movie_index(movie_id)
+    if i is None:
+        raise HTTPException(status_code=404, detail="Movie to read not found")
+    return json_response(snap.movie_detail(i))
+
+
+def by_ids(ids: List[int], index, row) -> Response:
+    main.check_batch_size(ids)
+    found, missing = [], []
+    for id in dict.fromkeys(ids):
+        i = index(id)
+        if i is None:
+            missing.append(id)
+        else:
+            found.append(row(i))
+    return json_response({"found": found, "missing": missing})
+
+@router.post("/movies/by_ids", response_model=schemas.MoviesByIds)
+def read_movies_by_ids(ids: List[int]):
+    snap = snapshot.current()
+    return by_ids(ids, snap.movie_index, lambda i: snap.movie(i)._asdict())
+
+@router.post("/movies/by_ids/detail", response_model=schemas.MovieDetailsByIds)
+def read_movie_details_by_ids(ids: List[int]):
+    snap = snapshot.current()
+    return by_ids(ids, snap.movie_index, snap.movie_detail)
+
+
+@router.get("/movie/by_title", response_model=List[schemas.Movie])
+def read_movie_by_title(searchTitle: Optional[str] = None):
+    snap = snapshot.current()
+    return movies_response(snap, snap.movies_by_title(searchTitle) if searchTitle is not None else [])
+
+
+@router.get("/movie/by_partTitle", response_model=List[schemas.Movie])
+def read_movie_by_partTitle(searchTitle: Optional[str] = None):
+    snap = snapshot.current()
+    return movies_response(snap, snap.movies_by_parttitle(searchTitle) if searchTitle is not None else [])
+
+
+@router.get("/movies/by_title_year", response_model=List[schemas.Movie])
+def read_movies_by_title_year(t: str, y: int):
+    snap = snapshot.current()
+    return movies_response(snap, snap.movies_by_title(t, year=y))
+
+
+def by_year_desc(snap: snapshot.Snapshot, indexes) -> List[int]:
+    return sorted(set(indexes), key=lambda i: (-snap.movie_year[i], snap.movie_id[i]))
+
+@router.get("/movies/by_director", response_model=List[schemas.Movie])
+def read_movies_by_director(n: str):
+    snap = snapshot.current()
+    directors = set(snap.stars_by_endname(n))
+    return movies_response(snap, by_year_desc(snap, (
+        i for i, director in enumerate(snap.movie_director) if director in directors)))
+
+
+@router.get("/movies/by_actor", response_model=List[schemas.Movie])
+def read_movies_by_actor(n: str):
+    snap = snapshot.current()
+    return movies_response(snap, by_year_desc(snap, (
+        i for star in snap.stars_by_endname(n) for i in snap.movies_of(star))))
+
+
+@router.get("/director/by_id_movie/{idMovie}", response_model=schemas.Star)
+def read_director_by_movie(idMovie: int):
+    snap = snapshot.current()
+    i = snap.movie_index(idMovie)
+    director = snap.movie_director[i] if i is not None else snapshot.NULL
+    if director == snapshot.NULL:
+        raise HTTPException(status_code=404, detail="Star to read not found")
+    return json_response(snap.star(director)._asdict())
+
+
+@router.get("/actor/by_movie_title", response_model=List[List[schemas.Star]])
+def read_actor_by_movie_title(movieTitle: str):
+    snap = snapshot.current()
+    return json_response([[snap.star(star)._asdict() for star in snap.actors(i)]
+                          for i in snap.movies_by_parttitle(movieTitle) if snap.actors(i)])
+
+
+@router.get("/movies/by_range_year", response_model=List[schemas.Movie])
+def get_movie_by_range_year(year_min: Optional[int] = None, year_max: Optional[int] = None):
+    if year_min is None and year_max is None:
+        return None
+    snap = snapshot.current()
+    return movies_response(snap, snap.movies_by_year(year_min, year_max))
+
+
+#routes Star
+
+@router.get("/stars", response_model=List[schemas.Star])
+def read_stars(response: Response, skip: Optional[int] = 0, limit: Optional[int] = 100,
+        sort: schemas.StarSort = schemas.StarSort.id, after: Optional[str] = None):
+    snap = snapshot.current()
+    attrs = crud.STAR_SORT_KEYS[sort.value]
+    stars = [snap.star(i) for i in snap.stars_page(sort.value, decode_after(after, sort.value, attrs, schemas.Star), skip, limit)]
+    main.set_next_cursor(response, sort.value, attrs, stars, limit)
+    return fastjson.rows_response(stars, schemas.Star, headers=response.headers)
+
+
+@router.get("/stars/by_id/{star_id}", response_model=schemas.Star)
+def read_star(star_id: int):
+    snap = snapshot.current()
+    i = snap.star_index(star_id)
+    if i is None:
+        raise HTTPException(status_code=404, detail="Star to read not found")
+    return json_response(snap.star(i)._asdict())
+
+
+@router.post("/stars/by_ids", response_model=schemas.StarsByIds)
+def read_stars_by_ids(ids: List[int]):
+    snap = snapshot.current()
+    return by_ids(ids, snap.star_index, lambda i: snap.star(i)._asdict())
+
+
+@router.get("/stars/by_name")
+def read_star_by_name(starName: Optional[str] = None):
+    snap = snapshot.current()
+    return stars_response(snap, snap.stars_by_name(starName) if starName is not None else [])
+
+
+@router.get("/stars/by_partname", response_model=List[schemas.Star])
+def read_movie_by_partname(starName: Optional[str] = None):
+    snap = snapshot.current()
+    return stars_response(snap, snap.stars_by_partname(starName) if starName is not None else [])
+
+
+@router.get("/stars/by_birthyear/{year}", response_model=List[schemas.Star])
+def get_star_by_birthyear(year: int):
+    snap = snapshot.current()
+    return stars_response(snap, snap.stars_by_birthyear(year))
+
+
+# snapshot
+
+@router.get("/snapshot/info")
+def read_snapshot_info():
+    """ snapshot served by this worker, its map time and the worker memory (kB),
+        the snapshot pages are counted in RssFile and shared with the other workers
+    """
+    snap = snapshot.current()
+    return dict(snap.meta, path=snap.path, load_ms=round(snap.load_seconds * 1000, 3),
+                memory=snapshot.memory_usage())
+
+
+@router.post("/snapshot/rebuild")
+async def rebuild_snapshot():
+    """ export the database into a new snapshot file, swapped atomically:
+        requests in flight finish on the old one
+    """
+    def build():
+        db = SessionLocal()
+        try:
+            return snapshot.build(db)
+        finally:
+            db.close()
+    return await run_in_threadpool(build)
+
+
+# with every other route of main.py, on the database
+app = main.create_app(router)
+# a worker without snapshot can't serve: fail at startup, not on the first read
+app.add_event_handler("startup", snapshot.current)
@@ -0,0 +1,270 @@
+"""
+metrics.py : per request instrumentation
+
+For every request, by route:
+    - queries, db time and rows, from the sqlalchemy cursor events of every engine
+    - endpoint time (the route function) and serialization time: the rest of
+      the request handler of the route once the function returned (response
+      model validation, jsonable_encoder and the json encoding of the response
+      class); the routes returning a Response of their own (fastjson) encode
+      in the endpoint time
+    - total latency
+They come back in the Server-Timing header of the response and are summed
+per route in the Prometheus text exposition of /metrics (latency as a
+histogram), followed by the connection pool of each engine (pool label).
+
+Queries slower than SLOW_QUERY_MS (500, 0 to disable) are logged as warnings.
+rows: cursor.rowcount of every statement, the rows affected by the writes
+and the rows of the selects where the driver buffers them (psycopg2,
+pymysql); the sqlite drivers report none for selects (-1, not counted).
+Only the routes of the apps (TimedRoute) and the engines' cursor events are
+instrumented, nothing of fastapi is replaced.
+"""
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "500"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger("uvicorn")
+
+
+class RequestTimings:
+    """ what one request spent, seconds """
+    __slots__ = ("queries", "db_time", "rows", "endpoint_time", "serialize_time", "returned_at")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.endpoint_time = 0.0
+        self.serialize_time = 0.0
+        # when the route function returned, serialization starts there
+        self.returned_at = None
+
+    def server_timing(self, total: float) -> str:
+        return ", ".join([
+            'db;dur={:.2f};desc="{} queries, {} rows"'.format(self.db_time * 1000, self.queries, self.rows),
+            "app;dur={:.2f}".format(max(self.endpoint_time - self.db_time, 0) * 1000),
+            "serialize;dur={:.2f}".format(self.serialize_time * 1000),
+            "total;dur={:.2f}".format(total * 1000),
+        ])
+
+
+_current: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    timings = _current.get()
+    if timings is not None:
+        timings.queries += 1
+        timings.db_time += elapsed
+        timings.rows += max(cursor.rowcount or 0, 0)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        logger.warning("slow query %.1f ms: %s", elapsed * 1000, " ".join(statement.split())[:1000])
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    starts = exception_context.connection.info.get("query_start") if exception_context.connection else None
+    if starts:
+        starts.pop()
+
+
+class RouteMetrics:
+
+    def __init__(self):
+        self.requests: Dict[int, int] = {}
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.serialize_time = 0.0
+
+    def observe(self, status: int, timings: RequestTimings, latency: float):
+        self.requests[status] = self.requests.get(status, 0) + 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+        self.latency += latency
+        self.queries += timings.queries
+        self.db_time += timings.db_time
+        self.rows += timings.rows
+        self.serialize_time += timings.serialize_time
+
+
+def _labels(**labels) -> str:
+    return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                    for name, value in labels.items())
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes: Dict[Tuple[str, str], RouteMetrics] = {}
+
+    def observe(self, method: str, route: str, status: int, timings: RequestTimings, latency: float):
+        with self._lock:
+            self.routes.setdefault((method, route), RouteMetrics()).observe(status, timings, latency)
+
+    def exposition(self) -> str:
+        """ prometheus text format """
+        lines = []
+        def family(name, kind, help_text):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+        with self._lock:
+            routes = sorted(self.routes.items())
+            family("http_requests_total", "counter", "Requests by route and status.")
+            for (method, route), m in routes:
+                for status, count in sorted(m.requests.items()):
+                    lines.append("http_requests_total{{{}}} {}".format(_labels(method=method, route=route, status=status), count))
+            family("http_request_duration_seconds", "histogram", "Request latency by route.")
+            for (method, route), m in routes:
+                labels = _labels(method=method, route=route)
+                for bound, count in zip(LATENCY_BUCKETS, m.buckets):
+                    lines.append("http_request_duration_seconds_bucket{{{},le=\"{}\"}} {}".format(labels, bound, count))
+                total = sum(m.requests.values())
+                lines.append("http_request_duration_seconds_bucket{{{},le=\"+Inf\"}} {}".format(labels, total))
+                lines.append("http_request_duration_seconds_sum{{{}}} {:.6f}".format(labels, m.latency))
+                lines.append("http_request_duration_seconds_count{{{}}} {}".format(labels, total))
+            for name, attr, help_text in (
+                    ("db_queries_total", "queries", "SQL statements executed by route."),
+                    ("db_query_duration_seconds_total", "db_time", "Time spent in SQL statements by route."),
+                    ("db_rows_total", "rows", "Rows fetched or affected (cursor.rowcount) by route."),
+                    ("serialization_duration_seconds_total", "serialize_time", "Time spent serializing responses by route.")):
+                family(name, "counter", help_text)
+                for (method, route), m in routes:
+                    value = getattr(m, attr)
+                    lines.append("{}{{{}}} {}".format(name, _labels(method=method, route=route),
+                                                      "{:.6f}".format(value) if isinstance(value, float) else value))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# (name, type, key of database.pool_metrics, help)
+POOL_FAMILIES = (
+    ("db_pool_checkouts_total", "counter", "checkouts", "Connections checked out by pool."),
+    ("db_pool_wait_seconds_total", "counter", "wait_time_total", "Time spent waiting for a connection by pool."),
+    ("db_pool_wait_seconds_max", "gauge", "wait_time_max", "Longest wait for a connection by pool."),
+    ("db_pool_size", "gauge", "size", "Connections kept open by pool."),
+    ("db_pool_checked_out", "gauge", "checkedout", "Connections in use by pool."),
+    ("db_pool_overflow", "gauge", "overflow", "Connections above the pool size by pool."),
+)
+
+
+def pool_exposition(pools: Dict[str, dict]) -> str:
+    """ prometheus text format of database.pool_metrics by pool label, the values a pool has """
+    lines = []
+    for name, kind, key, help_text in POOL_FAMILIES:
+        values = [(pool, metrics[key]) for pool, metrics in pools.items() if key in metrics]
+        if not values:
+            continue
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for pool, value in values:
+            lines.append("{}{{{}}} {}".format(name, _labels(pool=pool),
+                                              "{:.6f}".format(value) if isinstance(value, float) else value))
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def _timed(endpoint):
+    """ wrap a route function to record its own time, signature kept for fastapi """
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                _returned(start)
+    else:
+        @functools.wraps(endpoint)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                _returned(start)
+    return timed
+
+
+def _returned(start: float):
+    timings = _current.get()
+    if timings is not None:
+        timings.returned_at = time.perf_counter()
+        timings.endpoint_time += timings.returned_at - start
+
+
+class TimedRoute(APIRoute):
+    """ route_class of the apps: endpoint time around the route function,
+        serialization time from its return to the end of the request handler
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _timed(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            response = await handler(request)
+            timings = _current.get()
+            if timings is not None and timings.returned_at is not None:
+                timings.serialize_time += time.perf_counter() - timings.returned_at
+                timings.returned_at = None
+            return response
+        return timed_handler
+
+
+class MetricsMiddleware:
+    """ asgi middleware: Server-Timing header and registry update for every http request """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_timed(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message).append("Server-Timing", timings.server_timing(time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            latency = time.perf_counter() - start
+            _current.reset(token)
+            route = scope.get("route")
+            registry.observe(scope["method"], route.path if route is not None else "unmatched", status, timings, latency)
@@ -1,14 +1,20 @@
 """
 model.py : database row <-> objet python
 """
-from sqlalchemy import Boolean, Column, Integer, String, Numeric, SmallInteger, Date, ForeignKey, Table
+from sqlalchemy import Boolean, Column, Integer, String, Numeric, SmallInteger, Date, DateTime, ForeignKey, Table, Index, PrimaryKeyConstraint
 from sqlalchemy.orm import relationship
 
 from database import Base
 
+# indexes are also created on existing databases by python lifecycle.py migrate
+# (or sql/*_cine_indexes.sql)
+
 play_table = Table('play', Base.metadata,
-    Column('id_actor', Integer, ForeignKey('stars.id')),
-    Column('id_movie', Integer, ForeignKey('movies.id'))
+    Column('id_actor', Integer, ForeignKey('stars.id'), nullable=False),
+    Column('id_movie', Integer, ForeignKey('movies.id'), nullable=False),
+    # movie -> actors through the pk, actor -> movies through ix_play_id_actor
+    PrimaryKeyConstraint('id_movie', 'id_actor', name='pk_play'),
+    Index('ix_play_id_actor', 'id_actor'),
 )
 
 
@@ -19,12 +25,19 @@ class Movie(Base):
     title = Column(String(length=400), nullable=False)
     year = Column(SmallInteger, nullable=False)
     duration = Column(SmallInteger, nullable=True)
-    id_director = Column(Integer, ForeignKey('stars.id'))
+    id_director = Column(Integer, ForeignKey('stars.id'), index=True)
     #Many to one
     director = relationship("Star")
     #Many to Many
     actors = relationship("Star", secondary=play_table)
 
+    __table_args__ = (
+        # range / count by year and keyset pagination on (year, id)
+        Index('ix_movies_year_id', 'year', 'id'),
+        # title equality and title + year lookups
+        Index('ix_movies_title_year', 'title', 'year'),
+    )
+
 
 
 class Star(Base):
@@ -32,4 +45,53 @@ class Star(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(length=150), nullable=False)
-    birthdate = Column(Date, nullable=False)
+    birthdate = Column(Date, nullable=True, index=True)
+
+    __table_args__ = (
+        # name equality and keyset pagination on (name, id)
+        Index('ix_stars_name_id', 'name', 'id'),
+    )
+
+
+# aggregate tables for the stats routes, maintained by stats.py
+
+class StatYear(Base):
+    __tablename__ = "stat_year"
+
+    year = Column(SmallInteger, primary_key=True)
+    count_movies = Column(Integer, nullable=False)
+    min_duration = Column(SmallInteger, nullable=True)
+    max_duration = Column(SmallInteger, nullable=True)
+    sum_duration = Column(Integer, nullable=True)
+    count_duration = Column(Integer, nullable=False)
+
+
+class StatDirector(Base):
+    __tablename__ = "stat_director"
+
+    id_director = Column(Integer, ForeignKey('stars.id'), primary_key=True)
+    count_movies = Column(Integer, nullable=False, index=True)
+
+
+class StatActor(Base):
+    __tablename__ = "stat_actor"
+
+    id_actor = Column(Integer, ForeignKey('stars.id'), primary_key=True)
+    count_movies = Column(Integer, nullable=False, index=True)
+    first_year = Column(SmallInteger, nullable=False)
+    last_year = Column(SmallInteger, nullable=False)
+
+
+class StatMeta(Base):
+    __tablename__ = "stat_meta"
+
+    name = Column(String(length=50), primary_key=True)
+    rebuilt_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+
+
+class CatalogVersion(Base):
+    """ one row per catalog write, the highest is the catalog version (see versions.py) """
+    __tablename__ = "catalog_versions"
+
+    version = Column(Integer, primary_key=True)
@@ -0,0 +1,60 @@
+"""
+pagination.py : keyset (cursor) pagination helpers
+
+A cursor is an opaque url-safe token encoding the sort name and the values
+of the sort columns for the last row of a page. The next page starts
+strictly after those values, so the database seeks in the index instead of
+scanning and discarding `skip` rows like OFFSET does.
+"""
+import base64
+import json
+from typing import Any, List, Optional, Sequence
+
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(sort: str, values: Sequence[Any]) -> str:
+    payload = json.dumps([sort, *values], default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token: str, sort: str, size: int, types: Optional[Sequence[type]] = None) -> List[Any]:
+    """ decode a cursor built by encode_cursor
+        types: python type of each value (int, str), checked when given
+        raise ValueError if token is malformed, was made for another sort or holds values of other types
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(payload, list) or len(payload) != size + 1 or payload[0] != sort:
+        raise ValueError("cursor does not match sort '{}'".format(sort))
+    values = payload[1:]
+    # bool is an int for isinstance, never a sort value
+    if types is not None and any(isinstance(value, bool) or not isinstance(value, kind)
+                                 for value, kind in zip(values, types)):
+        raise ValueError("invalid cursor values for sort '{}'".format(sort))
+    return values
+
+
+def after_filter(columns: Sequence, values: Sequence[Any]):
+    """ row value comparison (c1, c2, ...) > (v1, v2, ...) expanded with OR/AND
+        so it works on every backend, with c1 >= v1 in front: planners don't
+        seek the index on the OR alone and would scan from the first row
+    """
+    clauses = []
+    for i, column in enumerate(columns):
+        equals = [columns[j] == values[j] for j in range(i)]
+        clauses.append(and_(*equals, column > values[i]))
+    if len(columns) == 1:
+        return clauses[0]
+    return and_(columns[0] >= values[0], or_(*clauses))
+
+
+def next_cursor(sort: str, attrs: Sequence[str], rows: List, limit: int) -> Optional[str]:
+    """ cursor pointing after the last row, None when the page is not full """
+    if not rows or len(rows) < limit:
+        return None
+    last = rows[-1]
+    return encode_cursor(sort, [getattr(last, attr) for attr in attrs])
@@ -0,0 +1,193 @@
+"""
+partitions.py : decade range partitioning of movies on year
+
+Generates the DDL turning movies into a table partitioned by decade
+(movies_1910 ... movies_2020 + a default partition), the native version of
+the vmoviesXXXX views of sql/pg_cine_views.sql. With it, queries filtering
+on year (by_range_year, count_by_year with a range) only scan the
+partitions of the decades they cover: crud keeps the year predicates plain
+column comparisons so the planner can prune.
+
+    python partitions.py pg [first_decade last_decade]     > sql/pg_cine_partitions.sql
+    python partitions.py mysql [first_decade last_decade]  > sql/my_cine_partitions.sql
+
+Run the script on a copy first: it recreates movies. The foreign keys
+referencing movies(id) can't exist on a partitioned table (its unique keys
+contain year), the scripts replace them with triggers doing the same
+checks. mysql can't partition a table with a FULLTEXT index: its script
+refuses to run while ft_movies_title (sql/my_cine_search.sql) exists.
+
+The effect on the range queries is measured by
+    python bench.py partitions      (before and after running the script)
+"""
+import sys
+from typing import List, Tuple
+
+FIRST_DECADE = 1880
+LAST_DECADE = 2020
+
+
+def decade_bounds(first: int = FIRST_DECADE, last: int = LAST_DECADE) -> List[Tuple[int, int]]:
+    """ (from year included, to year excluded) of each decade partition """
+    return [(start, start + 10) for start in range(first, last + 1, 10)]
+
+
+# decades of the vmoviesXXXX.movies views of sql/pg_cine_views.sql
+VIEW_DECADES = (1970, 2020)
+
+
+def pg_ddl(first: int = FIRST_DECADE, last: int = LAST_DECADE) -> str:
+    lines = [
+        "-- movies partitioned by decade on year (postgresql >= 11), in one transaction",
+        "-- the primary key must contain the partition key: (id, year), so no foreign key",
+        "-- can reference movies(id) any more: those of play and in_franchise become the",
+        "-- triggers at the end (same check on insert / update, restrict on delete)",
+        "-- the indexes of sql/pg_cine_indexes.sql and sql/pg_cine_search.sql, the views",
+        "-- of sql/pg_cine_views.sql and the id sequence are moved to the new table",
+        "begin;",
+        "alter table play drop constraint if exists fk_play_movie;",
+        "alter table if exists in_franchise drop constraint if exists fk_in_franchise_2;",
+        "alter table movies rename to movies_unpartitioned;",
+        "create table movies (like movies_unpartitioned including defaults including constraints)",
+        "    partition by range (year);",
+        "alter table movies add constraint pk_movies_part primary key (id, year);",
+    ]
+    for start, stop in decade_bounds(first, last):
+        lines.append("create table movies_{0} partition of movies for values from ({0}) to ({1});".format(start, stop))
+    lines += [
+        "create table movies_default partition of movies default;",
+        "insert into movies select * from movies_unpartitioned;",
+        "do $$",
+        "declare",
+        "    decade int;",
+        "begin",
+        "    for decade in {}..{} by 10 loop".format(*VIEW_DECADES),
+        "        if to_regclass(format('vmovies%s.movies', decade)) is not null then",
+        "            execute format('create or replace view vmovies%1$s.movies as"
+        " select * from movies where year between %1$s and %2$s', decade, decade + 9);",
+        "        end if;",
+        "    end loop;",
+        "end $$;",
+        "alter sequence if exists movies_id_seq owned by movies.id;",
+        "drop table movies_unpartitioned;",
+        "alter table movies add constraint fk_movies_director foreign key (id_director) references stars (id);",
+        "create index ix_movies_year_id on movies (year, id);",
+        "create index ix_movies_title_year on movies (title, year);",
+        "create index ix_movies_id_director on movies (id_director);",
+        "create extension if not exists pg_trgm;",
+        "create index trgm_movies_title on movies using gin (title gin_trgm_ops);",
+        "create or replace function movie_must_exist() returns trigger language plpgsql as $$",
+        "begin",
+        "    if not exists (select 1 from movies where id = new.id_movie) then",
+        "        raise foreign_key_violation using message = format('movie %s not found (%s.id_movie)',"
+        " new.id_movie, tg_table_name);",
+        "    end if;",
+        "    return new;",
+        "end $$;",
+        "create or replace function movie_not_referenced() returns trigger language plpgsql as $$",
+        "declare",
+        "    referenced boolean := exists (select 1 from play where id_movie = old.id);",
+        "begin",
+        "    if not referenced and to_regclass('in_franchise') is not null then",
+        "        execute 'select exists (select 1 from in_franchise where id_movie = $1)' into referenced using old.id;",
+        "    end if;",
+        "    if referenced then",
+        "        raise foreign_key_violation using message = format('movie %s still referenced', old.id);",
+        "    end if;",
+        "    return old;",
+        "end $$;",
+        "create trigger play_movie_exists after insert or update of id_movie on play",
+        "    for each row execute procedure movie_must_exist();",
+        "do $$",
+        "begin",
+        "    if to_regclass('in_franchise') is not null then",
+        "        create trigger in_franchise_movie_exists after insert or update of id_movie on in_franchise",
+        "            for each row execute procedure movie_must_exist();",
+        "    end if;",
+        "end $$;",
+        "create trigger movies_not_referenced after delete or update of id on movies",
+        "    for each row execute procedure movie_not_referenced();",
+        "commit;",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def mysql_ddl(first: int = FIRST_DECADE, last: int = LAST_DECADE) -> str:
+    partitions = ["    partition p{0} values less than ({1}),".format(start, stop)
+                  for start, stop in decade_bounds(first, last)]
+    partitions.append("    partition pmax values less than maxvalue")
+    return "\n".join([
+        "-- movies partitioned by decade on year (innodb), run with the mysql client",
+        "-- innodb partitioned tables can have neither foreign keys nor FULLTEXT indexes,",
+        "-- and every unique key must contain the partition key:",
+        "--   - the script stops before any change if movies has a FULLTEXT index:",
+        "--     ft_movies_title (sql/my_cine_search.sql) serves the MATCH ... AGAINST of",
+        "--     search.py, the mysql movie search and this partitioning are exclusive",
+        "--   - the foreign keys to / from movies become the triggers at the end",
+        "--   - the primary key becomes (id, year)",
+        "delimiter //",
+        "drop procedure if exists movies_partition_check //",
+        "create procedure movies_partition_check()",
+        "begin",
+        "    if exists (select 1 from information_schema.statistics where table_schema = database()",
+        "               and table_name = 'movies' and index_type = 'FULLTEXT') then",
+        "        signal sqlstate '45000' set message_text =",
+        "            'movies has a FULLTEXT index (search.py), innodb can not partition it: not partitioned';",
+        "    end if;",
+        "end //",
+        "delimiter ;",
+        "call movies_partition_check();",
+        "drop procedure movies_partition_check;",
+        "alter table play drop foreign key fk_play_movie;",
+        "alter table movies drop foreign key fk_movie_director;",
+        "alter table movies drop primary key, add primary key (id, year);",
+        "alter table movies partition by range (year) (",
+        *partitions,
+        ");",
+        "delimiter //",
+        "create trigger play_movie_insert before insert on play for each row",
+        "begin",
+        "    if not exists (select 1 from movies where id = new.id_movie) then",
+        "        signal sqlstate '23000' set message_text = 'play.id_movie: movie not found';",
+        "    end if;",
+        "end //",
+        "create trigger play_movie_update before update on play for each row",
+        "begin",
+        "    if not exists (select 1 from movies where id = new.id_movie) then",
+        "        signal sqlstate '23000' set message_text = 'play.id_movie: movie not found';",
+        "    end if;",
+        "end //",
+        "create trigger movies_delete before delete on movies for each row",
+        "begin",
+        "    if exists (select 1 from play where id_movie = old.id) then",
+        "        signal sqlstate '23000' set message_text = 'movie still referenced by play';",
+        "    end if;",
+        "end //",
+        "create trigger movies_director_insert before insert on movies for each row",
+        "begin",
+        "    if new.id_director is not null and not exists (select 1 from stars where id = new.id_director) then",
+        "        signal sqlstate '23000' set message_text = 'movies.id_director: star not found';",
+        "    end if;",
+        "end //",
+        "create trigger movies_director_update before update on movies for each row",
+        "begin",
+        "    if new.id_director is not null and not exists (select 1 from stars where id = new.id_director) then",
+        "        signal sqlstate '23000' set message_text = 'movies.id_director: star not found';",
+        "    end if;",
+        "end //",
+        "create trigger stars_director_delete before delete on stars for each row",
+        "begin",
+        "    if exists (select 1 from movies where id_director = old.id) then",
+        "        signal sqlstate '23000' set message_text = 'star still director of a movie';",
+        "    end if;",
+        "end //",
+        "delimiter ;",
+    ]) + "\n"
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if not args or args[0] not in ("pg", "mysql") or len(args) not in (1, 3):
+        sys.exit("usage: python partitions.py pg|mysql [first_decade last_decade]")
+    bounds = [int(value) for value in args[1:]]
+    print((pg_ddl if args[0] == "pg" else mysql_ddl)(*bounds), end="")
@@ -3,9 +3,43 @@ schema.py : model to be converted in json by fastapi
 """
 from typing import Optional, List
 from datetime import date
+from enum import Enum
 
 from pydantic import BaseModel
 
+# sort keys available for cursor pagination
+class MovieSort(str, Enum):
+    id = "id"
+    year = "year"
+
+class StarSort(str, Enum):
+    id = "id"
+    name = "name"
+
+# sort of /movies/search, "-" for descending
+class MovieFilterSort(str, Enum):
+    id = "id"
+    year = "year"
+    year_desc = "-year"
+    title = "title"
+    duration = "duration"
+    duration_desc = "-duration"
+
+# ranking of /analytics/careers
+class CareerSort(str, Enum):
+    span = "span"
+    count = "count"
+
+# streaming export
+class ExportTable(str, Enum):
+    movies = "movies"
+    stars = "stars"
+    play = "play"
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
 # common Base Class for Stars (abstract class)
 class StarBase(BaseModel):
     name: str
@@ -39,10 +73,43 @@ class Movie(MovieBase):
     class Config:
         orm_mode = True
 
+# actors of one movie, for batch cast assignment
+class MovieCast(BaseModel):
+    mid: int
+    sids: List[int]
+
 # movies from database with director
 class MovieDetail(Movie):
     director: Optional[Star] = None
     actors: List[Star] = []
+
+# batch lookups: rows found in request order, ids not found
+class MoviesByIds(BaseModel):
+    found: List[Movie]
+    missing: List[int]
+
+class MovieDetailsByIds(BaseModel):
+    found: List[MovieDetail]
+    missing: List[int]
+
+class StarsByIds(BaseModel):
+    found: List[Star]
+    missing: List[int]
+
+# collaboration graph
+class CoStar(BaseModel):
+    star: Star
+    movies: int
+
+class ConnectedStar(BaseModel):
+    star: Star
+    costars: int
+
+# stars[i] and stars[i+1] play together in movies[i]
+class Separation(BaseModel):
+    degrees: int
+    stars: List[Star]
+    movies: List[Movie]
     
     
     
@@ -0,0 +1,202 @@
+"""
+search.py : ranked prefix search on movie titles and star names
+
+LIKE '%x%' can't use a b-tree index, so each backend gets its own index:
+    - mysql: FULLTEXT index (sql/my_cine_search.sql), MATCH ... AGAINST in
+      boolean mode with word* prefixes, ranked by relevance
+    - postgresql: pg_trgm gin index (sql/pg_cine_search.sql), :q <% text
+      (word similarity, :q <<% text strict word similarity when not prefix),
+      ranked by the same similarity
+    - other (sqlite, ...): in-process trigram index built on first use,
+      kept up to date by the crud mutations of the worker and rebuilt when
+      the catalog version moved (versions.py)
+
+Every word of the query must be the prefix of a word of the text
+("hitch" finds "Alfred Hitchcock"), the whole word when not prefix: the
+index of mysql and postgresql selects the candidates, a regular expression
+per word on word boundaries applies the rule as the sqlite index does.
+What the backends still don't share: mysql ignores the words shorter than
+innodb_ft_min_token_size (3) and its stopwords, postgresql the candidates
+under pg_trgm.word_similarity_threshold (0.6, strict 0.5), which drops
+queries made of one or two letter words.
+"""
+import heapq
+import re
+import threading
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from sqlalchemy import desc, func, text
+from sqlalchemy.orm import Session
+
+import models, versions
+
+# kind -> (model, searched column name)
+SEARCHABLE = {
+    "movies": (models.Movie, "title"),
+    "stars": (models.Star, "name"),
+}
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def words(value: str) -> List[str]:
+    return _WORD_RE.findall(value.lower())
+
+
+def trigrams(value: str, prefix: bool = False) -> FrozenSet[str]:
+    """ pg_trgm style trigrams: each word padded with 2 spaces before, 1 after
+        prefix=True drops the trigram closing each word so it can match longer words
+    """
+    grams = set()
+    for word in words(value):
+        padded = "  " + word + (" " if not prefix else "")
+        grams.update(padded[j:j + 3] for j in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+class NgramIndex:
+    """ inverted trigram index: gram -> positions of the documents containing it
+        the postings only select candidates, their words are checked before ranking
+    """
+
+    def __init__(self):
+        self.ids: List[int] = []
+        self.words: List[Optional[Tuple[str, ...]]] = []
+        self.sizes: List[int] = []
+        self.positions: Dict[int, int] = {}
+        self.postings: Dict[str, List[int]] = {}
+
+    def add(self, doc_id: int, value: str):
+        self.remove(doc_id)
+        position = len(self.ids)
+        doc_grams = trigrams(value)
+        self.ids.append(doc_id)
+        self.words.append(tuple(words(value)))
+        self.sizes.append(len(doc_grams))
+        self.positions[doc_id] = position
+        for gram in doc_grams:
+            self.postings.setdefault(gram, []).append(position)
+
+    def remove(self, doc_id: int):
+        position = self.positions.pop(doc_id, None)
+        if position is not None:
+            # postings are cleaned lazily: a dead position has no words
+            self.words[position] = None
+
+    @staticmethod
+    def matches(query_words: List[str], doc_words: Tuple[str, ...], prefix: bool) -> bool:
+        """ every query word is the prefix of a document word (the whole word if not prefix) """
+        if prefix:
+            return all(any(word.startswith(term) for word in doc_words) for term in query_words)
+        return all(term in doc_words for term in query_words)
+
+    def search(self, query: str, limit: int, prefix: bool = True) -> List[Tuple[int, float]]:
+        """ (id, score) best first, score is the jaccard similarity of the trigrams """
+        query_grams = trigrams(query, prefix=prefix)
+        if not query_grams:
+            return []
+        lists = [self.postings.get(gram) for gram in query_grams]
+        if any(posting is None for posting in lists):
+            return []
+        shortest = min(lists, key=len)
+        query_words = words(query)
+        size = len(query_grams)
+        hits = [(-size / self.sizes[position], self.ids[position])
+                for position in shortest
+                if self.words[position] is not None and self.matches(query_words, self.words[position], prefix)]
+        # the query grams are a subset of the document grams: jaccard = |query| / |document|
+        return [(doc_id, -score) for score, doc_id in heapq.nsmallest(limit, hits)]
+
+
+_indexes: Dict[str, NgramIndex] = {}
+_versions = {kind: versions.Tracker() for kind in SEARCHABLE}
+_lock = threading.Lock()
+
+
+def get_index(db: Session, kind: str) -> NgramIndex:
+    """ built on first use, rebuilt when the catalog changed elsewhere (see versions.py) """
+    index = _indexes.get(kind)
+    if index is None or _versions[kind].stale(db):
+        with _lock:
+            if _indexes.get(kind) is index:
+                model, column = SEARCHABLE[kind]
+                _versions[kind].load(db)
+                index = NgramIndex()
+                for doc_id, value in db.query(model.id, getattr(model, column)):
+                    index.add(doc_id, value)
+                _indexes[kind] = index
+            index = _indexes[kind]
+    return index
+
+
+def index_changed(kind: str, doc_id: int, value: str):
+    """ called by crud after a create/update, no-op while the index is not built """
+    with _lock:
+        index = _indexes.get(kind)
+        if index is not None:
+            index.add(doc_id, value)
+
+
+def index_removed(kind: str, doc_id: int):
+    with _lock:
+        index = _indexes.get(kind)
+        if index is not None:
+            index.remove(doc_id)
+
+
+def reset_index(kind: str):
+    """ drop an index after writes that bypassed crud, it is rebuilt on next search """
+    with _lock:
+        if _indexes.pop(kind, None) is not None:
+            _versions[kind].reset()
+
+
+def _boolean_query(query: str, prefix: bool) -> str:
+    """ 'alfred hitch' -> '+alfred* +hitch*' (mysql boolean mode) """
+    terms = words(query)
+    return " ".join("+" + term + ("*" if prefix else "") for term in terms)
+
+
+def _word_patterns(query: str, prefix: bool, start: str, end: str) -> List[str]:
+    """ one regular expression per word of the query: the start of a word of the
+        text (the whole word if not prefix), start / end: word boundaries of the backend
+    """
+    return [start + re.escape(term) + ("" if prefix else end) for term in words(query)]
+
+
+def sql_search(dialect: str, kind: str, query: str, prefix: bool = True):
+    """ (filters, order by) of the search on the index of mysql or postgresql """
+    model, column_name = SEARCHABLE[kind]
+    column = getattr(model, column_name)
+    if dialect == "mysql":
+        match = text("MATCH ({}) AGAINST (:q IN BOOLEAN MODE)".format(column_name)) \
+                .bindparams(q=_boolean_query(query, prefix))
+        # icu regular expressions (mysql 8), case insensitive with the collation of the column
+        patterns = _word_patterns(query, prefix, r"\b", r"\b")
+        return [match] + [column.op("REGEXP", is_comparison=True)(pattern) for pattern in patterns], \
+               [desc(match), model.id]
+    if prefix:
+        # :q <% column, the word similarity of the query to a part of the column
+        candidates = column.op("%>", is_comparison=True)(query)
+        similarity = func.word_similarity(query, column)
+    else:
+        candidates = column.op("%>>", is_comparison=True)(query)
+        similarity = func.strict_word_similarity(query, column)
+    patterns = _word_patterns(query, prefix, r"\m", r"\M")
+    return [candidates] + [column.op("~*", is_comparison=True)(pattern) for pattern in patterns], \
+           [similarity.desc(), model.id]
+
+
+def search(db: Session, kind: str, query: str, limit: int = 20, prefix: bool = True) -> List:
+    model, _ = SEARCHABLE[kind]
+    dialect = db.get_bind().dialect.name
+    if not words(query):
+        return []
+    if dialect in ("mysql", "postgresql"):
+        filters, order_by = sql_search(dialect, kind, query, prefix)
+        return db.query(model).filter(*filters).order_by(*order_by).limit(limit).all()
+    ranked = get_index(db, kind).search(query, limit, prefix=prefix)
+    if not ranked:
+        return []
+    rows = {row.id: row for row in db.query(model).filter(model.id.in_([doc_id for doc_id, _ in ranked]))}
+    return [rows[doc_id] for doc_id, _ in ranked if doc_id in rows]
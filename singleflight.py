@@ -0,0 +1,109 @@
+"""
+singleflight.py : request coalescing for identical concurrent reads
+
+The first request for a key (the leader) runs the load; identical requests
+arriving while it is in flight wait for its result instead of opening a
+session and running the same queries. Followers wait at most
+SINGLEFLIGHT_WAIT seconds (5), then run the load themselves. Exceptions of
+the leader (404 included) are raised to its followers too.
+
+Routes opt in through cache.cached_response(..., coalesce=True) or
+cache.coalesced_response; the shared value is the serialized body, never
+orm objects of the leader session.
+"""
+import asyncio
+import os
+import threading
+from typing import Any, Awaitable, Callable, Dict
+
+SINGLEFLIGHT_WAIT = float(os.environ.get("SINGLEFLIGHT_WAIT", "5"))
+
+
+class FlightStats:
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(vars(self))
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self, wait: float = SINGLEFLIGHT_WAIT):
+        self.wait = wait
+        self.stats = FlightStats()
+        self._calls: Dict[str, _Call] = {}
+        self._futures: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any]):
+        """ fn() once for concurrent callers of the same key (threads) """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats.leaders += 1
+        if not leader:
+            if not call.done.wait(self.wait):
+                self.stats.timeouts += 1
+                return fn()
+            self.stats.coalesced += 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[Any]]):
+        """ await fn() once for concurrent callers of the same key (one event loop) """
+        future = self._futures.get(key)
+        if future is not None:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), self.wait)
+            except asyncio.TimeoutError:
+                self.stats.timeouts += 1
+                return await fn()
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the leader was cancelled, not this request
+                return await fn()
+            self.stats.coalesced += 1
+            return result
+        future = self._futures[key] = asyncio.get_running_loop().create_future()
+        self.stats.leaders += 1
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved, no warning when nobody waited
+            raise
+        finally:
+            del self._futures[key]
+            if not future.done():
+                future.cancel()
+
+
+flights = SingleFlight()
@@ -0,0 +1,383 @@
+"""
+snapshot.py : read-only catalog snapshot served through mmap
+
+The builder exports movies, stars and play from the database into one
+binary file of fixed-width columns (array typecodes, native byte order):
+    movie_id, movie_year, movie_duration, movie_director (star index)
+    star_id, star_birthdate (date ordinal)
+    *_text + *_text_off: utf-8 titles / names and their offsets
+    *_folded + *_folded_off: casefolded titles / names separated by \\0,
+        scanned with mmap.find for the LIKE routes
+    movie_by_year, movie_by_title, star_by_name, star_by_birthdate:
+        sorted permutations used as indexes
+    cast_ptr / cast, filmography_ptr / filmography: play in CSR form
+Ids are sorted, so the id index is a binary search on the id column.
+
+The reader maps the file read-only: every uvicorn worker shares the same
+page cache pages and nothing is copied at startup. The builder writes a
+temporary file of its own (mkstemp, next to the snapshot) then
+os.replace()s it: concurrent builds each install a whole file, the last
+one wins. Readers notice the new inode and switch to it (old maps stay
+valid until their last request is done).
+
+    python snapshot.py build [path]     (DATABASE_URL, default path catalog.snap)
+    python snapshot.py info [path]
+"""
+import bisect
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import namedtuple
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import models
+
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "catalog.snap")
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get("SNAPSHOT_CHECK_INTERVAL", "5"))
+
+MAGIC = b"CINESNP1"
+HEADER = struct.Struct("<8sII")
+SECTION = struct.Struct("<32sc7xQQ")
+NULL = -1
+
+# rows in schemas.Movie / schemas.Star field order, attributes for pagination.next_cursor
+MovieRow = namedtuple("MovieRow", "title year duration id")
+StarRow = namedtuple("StarRow", "name birthdate id")
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+# build
+
+def _text_sections(prefix: str, values: List[str]) -> Dict[str, array]:
+    text, offsets = bytearray(), array("I", [0])
+    folded, folded_offsets = bytearray(), array("I")
+    for value in values:
+        text += value.encode()
+        offsets.append(len(text))
+        folded_offsets.append(len(folded))
+        folded += value.casefold().replace("\0", "").encode() + b"\0"
+    return {
+        prefix + "_text": array("B", text), prefix + "_text_off": offsets,
+        prefix + "_folded": array("B", folded), prefix + "_folded_off": folded_offsets,
+    }
+
+
+def _csr(groups: int, pairs: List[Tuple[int, int]]) -> Tuple[array, array]:
+    """ (ptr, values) of pairs (group index, value) """
+    pairs.sort()
+    ptr, values = array("I", [0] * (groups + 1)), array("i", (value for _, value in pairs))
+    for group, _ in pairs:
+        ptr[group + 1] += 1
+    for i in range(groups):
+        ptr[i + 1] += ptr[i]
+    return ptr, values
+
+
+def build_sections(db: Session) -> Dict[str, array]:
+    movies_table, stars_table, play = models.Movie.__table__, models.Star.__table__, models.play_table
+    stars = db.execute(select([stars_table.c.id, stars_table.c.name, stars_table.c.birthdate])
+                       .order_by(stars_table.c.id)).fetchall()
+    movies = db.execute(select([movies_table.c.id, movies_table.c.title, movies_table.c.year,
+                                movies_table.c.duration, movies_table.c.id_director])
+                        .order_by(movies_table.c.id)).fetchall()
+    star_index = {row.id: i for i, row in enumerate(stars)}
+    movie_index = {row.id: i for i, row in enumerate(movies)}
+    edges = [(movie_index[id_movie], star_index[id_actor])
+             for id_movie, id_actor in db.execute(select([play.c.id_movie, play.c.id_actor]))
+             if id_movie in movie_index and id_actor in star_index]
+
+    sections = {
+        "movie_id": array("i", (row.id for row in movies)),
+        "movie_year": array("i", (row.year for row in movies)),
+        "movie_duration": array("i", (NULL if row.duration is None else row.duration for row in movies)),
+        "movie_director": array("i", (star_index.get(row.id_director, NULL) for row in movies)),
+        "movie_by_year": array("i", sorted(range(len(movies)), key=lambda i: (movies[i].year, movies[i].id))),
+        "movie_by_title": array("i", sorted(range(len(movies)), key=lambda i: (movies[i].title, movies[i].id))),
+        "star_id": array("i", (row.id for row in stars)),
+        "star_birthdate": array("i", (NULL if row.birthdate is None else row.birthdate.toordinal() for row in stars)),
+        "star_by_name": array("i", sorted(range(len(stars)), key=lambda i: (stars[i].name, stars[i].id))),
+        "star_by_birthdate": array("i", sorted((i for i, row in enumerate(stars) if row.birthdate is not None),
+                                               key=lambda i: (stars[i].birthdate, stars[i].id))),
+    }
+    sections.update(_text_sections("movie", [row.title for row in movies]))
+    sections.update(_text_sections("star", [row.name for row in stars]))
+    sections["cast_ptr"], sections["cast"] = _csr(len(movies), edges)
+    sections["filmography_ptr"], sections["filmography"] = _csr(len(stars), [(s, m) for m, s in edges])
+    meta = {
+        "built_at": datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
+        "movies": len(movies), "stars": len(stars), "play": len(edges), "byteorder": sys.byteorder,
+    }
+    sections["meta"] = array("B", json.dumps(meta).encode())
+    return sections
+
+
+def write(path: str, sections: Dict[str, array]):
+    """ write to a temporary file of this build then replace path atomically """
+    names = list(sections)
+    offset = HEADER.size + SECTION.size * len(names)
+    table = []
+    for name in names:
+        offset += -offset % 8
+        length = len(sections[name]) * sections[name].itemsize
+        table.append((name, offset, length))
+        offset += length
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                               dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, 1, len(names)))
+            for name, offset, length in table:
+                f.write(SECTION.pack(name.encode(), sections[name].typecode.encode(), offset, length))
+            for name, offset, length in table:
+                f.write(b"\0" * (offset - f.tell()))
+                sections[name].tofile(f)
+            f.flush()
+            # mkstemp creates it 0600
+            os.fchmod(f.fileno(), 0o644)
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def build(db: Session, path: str = SNAPSHOT_PATH) -> dict:
+    global _checked_at
+    start = time.perf_counter()
+    sections = build_sections(db)
+    write(path, sections)
+    _checked_at = 0.0  # this worker switches on its next request
+    return dict(json.loads(sections["meta"].tobytes()), path=path, size=os.path.getsize(path),
+                seconds=round(time.perf_counter() - start, 3))
+
+
+# read
+
+def _lower_bound(size: int, key_at: Callable[[int], tuple], value: tuple) -> int:
+    """ first position whose key is >= value, keys sorted """
+    low, high = 0, size
+    while low < high:
+        middle = (low + high) // 2
+        if key_at(middle) < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class Snapshot:
+
+    def __init__(self, path: str):
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+        self.path = path
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+        magic, version, count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != 1:
+            raise SnapshotError("{} is not a catalog snapshot".format(path))
+        view = memoryview(self._mmap)
+        self.sections = {}
+        for i in range(count):
+            name, typecode, offset, length = SECTION.unpack_from(self._mmap, HEADER.size + i * SECTION.size)
+            self.sections[name.rstrip(b"\0").decode()] = (view[offset:offset + length].cast(typecode.decode()), offset)
+        for name, (section, _) in self.sections.items():
+            setattr(self, name, section)
+        self.meta = json.loads(bytes(self.sections["meta"][0]))
+        if self.meta["byteorder"] != sys.byteorder:
+            raise SnapshotError("{} was built on a {} endian machine".format(path, self.meta["byteorder"]))
+        self.load_seconds = time.perf_counter() - start
+
+    # rows
+
+    def _text(self, prefix: str, i: int) -> str:
+        offsets = getattr(self, prefix + "_text_off")
+        return bytes(getattr(self, prefix + "_text")[offsets[i]:offsets[i + 1]]).decode()
+
+    def title(self, i: int) -> str:
+        return self._text("movie", i)
+
+    def name(self, i: int) -> str:
+        return self._text("star", i)
+
+    def movie(self, i: int) -> MovieRow:
+        duration = self.movie_duration[i]
+        return MovieRow(self.title(i), self.movie_year[i], None if duration == NULL else duration, self.movie_id[i])
+
+    def star(self, i: int) -> StarRow:
+        birthdate = self.star_birthdate[i]
+        return StarRow(self.name(i), None if birthdate == NULL else datetime.date.fromordinal(birthdate),
+                       self.star_id[i])
+
+    def actors(self, i: int) -> List[int]:
+        return list(self.cast[self.cast_ptr[i]:self.cast_ptr[i + 1]])
+
+    def movies_of(self, star: int) -> List[int]:
+        return list(self.filmography[self.filmography_ptr[star]:self.filmography_ptr[star + 1]])
+
+    def movie_detail(self, i: int) -> dict:
+        director = self.movie_director[i]
+        return dict(self.movie(i)._asdict(),
+                    director=self.star(director)._asdict() if director != NULL else None,
+                    actors=[self.star(star)._asdict() for star in self.actors(i)])
+
+    # indexes
+
+    def movie_index(self, movie_id: int) -> Optional[int]:
+        i = bisect.bisect_left(self.movie_id, movie_id)
+        return i if i < len(self.movie_id) and self.movie_id[i] == movie_id else None
+
+    def star_index(self, star_id: int) -> Optional[int]:
+        i = bisect.bisect_left(self.star_id, star_id)
+        return i if i < len(self.star_id) and self.star_id[i] == star_id else None
+
+    def movies_page(self, sort: str, after: Optional[list], skip: int, limit: int) -> List[int]:
+        """ movie indexes of a page sorted by id or (year, id), strictly after the cursor values """
+        if sort == "year":
+            order = self.movie_by_year
+            start = 0 if after is None else _lower_bound(
+                len(order), lambda k: (self.movie_year[order[k]], self.movie_id[order[k]]), (after[0], after[1] + 1))
+            return list(order[start + skip:start + skip + limit])
+        start = 0 if after is None else bisect.bisect_right(self.movie_id, after[0])
+        return list(range(len(self.movie_id))[start + skip:start + skip + limit])
+
+    def stars_page(self, sort: str, after: Optional[list], skip: int, limit: int) -> List[int]:
+        if sort == "name":
+            order = self.star_by_name
+            start = 0 if after is None else _lower_bound(
+                len(order), lambda k: (self.name(order[k]), self.star_id[order[k]]), (after[0], after[1] + 1))
+            return list(order[start + skip:start + skip + limit])
+        start = 0 if after is None else bisect.bisect_right(self.star_id, after[0])
+        return list(range(len(self.star_id))[start + skip:start + skip + limit])
+
+    def movies_by_title(self, title: str, year: Optional[int] = None) -> List[int]:
+        order = self.movie_by_title
+        k = _lower_bound(len(order), lambda k: (self.title(order[k]),), (title,))
+        found = []
+        while k < len(order) and self.title(order[k]) == title:
+            if year is None or self.movie_year[order[k]] == year:
+                found.append(order[k])
+            k += 1
+        return found
+
+    def stars_by_name(self, name: str) -> List[int]:
+        order = self.star_by_name
+        k = _lower_bound(len(order), lambda k: (self.name(order[k]),), (name,))
+        found = []
+        while k < len(order) and self.name(order[k]) == name:
+            found.append(order[k])
+            k += 1
+        return found
+
+    def movies_by_year(self, year_min: Optional[int], year_max: Optional[int]) -> List[int]:
+        order = self.movie_by_year
+        year_at = lambda k: (self.movie_year[order[k]],)
+        start = 0 if year_min is None else _lower_bound(len(order), year_at, (year_min,))
+        stop = len(order) if year_max is None else _lower_bound(len(order), year_at, (year_max + 1,))
+        return list(order[start:stop])
+
+    def stars_by_birthyear(self, year: int) -> List[int]:
+        if not 1 <= year < 9999:
+            return []
+        order = self.star_by_birthdate
+        date_at = lambda k: (self.star_birthdate[order[k]],)
+        start = _lower_bound(len(order), date_at, (datetime.date(year, 1, 1).toordinal(),))
+        stop = _lower_bound(len(order), date_at, (datetime.date(year + 1, 1, 1).toordinal(),))
+        return list(order[start:stop])
+
+    def _find(self, prefix: str, pattern: str, suffix: bool = False) -> List[int]:
+        """ indexes of the rows whose casefolded text contains pattern (ends with it if suffix),
+            mmap.find on the folded section, no decoding
+        """
+        pattern = pattern.casefold().replace("\0", "").encode() + (b"\0" if suffix else b"")
+        if not pattern:
+            return list(range(len(getattr(self, prefix + "_folded_off"))))
+        section, base = self.sections[prefix + "_folded"]
+        offsets = getattr(self, prefix + "_folded_off")
+        found, position, end = [], base, base + len(section)
+        while True:
+            position = self._mmap.find(pattern, position, end)
+            if position < 0:
+                return found
+            row = bisect.bisect_right(offsets, position - base) - 1
+            found.append(row)
+            # next row
+            position = base + (offsets[row + 1] if row + 1 < len(offsets) else len(section))
+
+    def movies_by_parttitle(self, part: str) -> List[int]:
+        return self._find("movie", part)
+
+    def stars_by_partname(self, part: str) -> List[int]:
+        return self._find("star", part)
+
+    def stars_by_endname(self, end: str) -> List[int]:
+        return self._find("star", end, suffix=True)
+
+
+_snapshot: Optional[Snapshot] = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def current(path: str = SNAPSHOT_PATH) -> Snapshot:
+    """ the mapped snapshot, reopened when the file was replaced (checked every SNAPSHOT_CHECK_INTERVAL s) """
+    global _snapshot, _checked_at
+    with _lock:
+        now = time.monotonic()
+        if _snapshot is None or now - _checked_at >= SNAPSHOT_CHECK_INTERVAL:
+            _checked_at = now
+            stat = os.stat(path)
+            if _snapshot is None or _snapshot.identity != (stat.st_ino, stat.st_mtime_ns):
+                # the old map is released with its last reference
+                _snapshot = Snapshot(path)
+        return _snapshot
+
+
+def memory_usage(pid="self") -> Dict[str, Optional[int]]:
+    """ VmRSS / RssAnon / RssFile of a process in kB (linux), shared file pages are in RssFile """
+    usage = {"VmRSS": None, "RssAnon": None, "RssFile": None}
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in usage:
+                    usage[name] = int(value.split()[0])
+    except OSError:
+        if pid != "self":
+            return usage
+        import resource
+        usage["VmRSS"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if not args or args[0] not in ("build", "info") or len(args) > 2:
+        sys.exit("usage: python snapshot.py build|info [path]")
+    path = args[1] if len(args) == 2 else SNAPSHOT_PATH
+    if args[0] == "info":
+        snapshot = Snapshot(path)
+        print(dict(snapshot.meta, path=path, size=os.path.getsize(path),
+                   load_ms=round(snapshot.load_seconds * 1000, 3)))
+        sys.exit(0)
+    from database import SessionLocal
+    session = SessionLocal()
+    try:
+        print(build(session, path))
+    finally:
+        session.close()
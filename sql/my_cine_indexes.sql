@@ -0,0 +1,20 @@
+-- indexes declared in models.py, for databases created before them
+-- (python lifecycle.py migrate applies the same steps from models.py)
+-- (play primary key pk_play(id_movie, id_actor) is already in my_cine_ddl.sql)
+create index ix_play_id_actor on play(id_actor);
+create index ix_movies_id_director on movies(id_director);
+create index ix_movies_year_id on movies(year, id);
+create index ix_movies_title_year on movies(title, year);
+create index ix_stars_name_id on stars(name, id);
+create index ix_stars_birthdate on stars(birthdate);
+
+-- play created by models.py before pk_play existed: copy it without duplicates into
+-- a table with the key, then swap the names (mysql commits every ddl statement: until
+-- the rename play is untouched, drop play_migration and start over if a step fails)
+-- create table play_migration (id_actor integer not null references stars(id),
+--     id_movie integer not null references movies(id),
+--     constraint pk_play primary key (id_movie, id_actor));
+-- insert into play_migration (id_movie, id_actor) select distinct id_movie, id_actor from play
+--     where id_movie is not null and id_actor is not null;
+-- rename table play to play_without_key, play_migration to play;
+-- drop table play_without_key;
@@ -0,0 +1,77 @@
+-- movies partitioned by decade on year (innodb), run with the mysql client
+-- innodb partitioned tables can have neither foreign keys nor FULLTEXT indexes,
+-- and every unique key must contain the partition key:
+--   - the script stops before any change if movies has a FULLTEXT index:
+--     ft_movies_title (sql/my_cine_search.sql) serves the MATCH ... AGAINST of
+--     search.py, the mysql movie search and this partitioning are exclusive
+--   - the foreign keys to / from movies become the triggers at the end
+--   - the primary key becomes (id, year)
+delimiter //
+drop procedure if exists movies_partition_check //
+create procedure movies_partition_check()
+begin
+    if exists (select 1 from information_schema.statistics where table_schema = database()
+               and table_name = 'movies' and index_type = 'FULLTEXT') then
+        signal sqlstate '45000' set message_text =
+            'movies has a FULLTEXT index (search.py), innodb can not partition it: not partitioned';
+    end if;
+end //
+delimiter ;
+call movies_partition_check();
+drop procedure movies_partition_check;
+alter table play drop foreign key fk_play_movie;
+alter table movies drop foreign key fk_movie_director;
+alter table movies drop primary key, add primary key (id, year);
+alter table movies partition by range (year) (
+    partition p1910 values less than (1920),
+    partition p1920 values less than (1930),
+    partition p1930 values less than (1940),
+    partition p1940 values less than (1950),
+    partition p1950 values less than (1960),
+    partition p1960 values less than (1970),
+    partition p1970 values less than (1980),
+    partition p1980 values less than (1990),
+    partition p1990 values less than (2000),
+    partition p2000 values less than (2010),
+    partition p2010 values less than (2020),
+    partition p2020 values less than (2030),
+    partition pmax values less than maxvalue
+);
+delimiter //
+create trigger play_movie_insert before insert on play for each row
+begin
+    if not exists (select 1 from movies where id = new.id_movie) then
+        signal sqlstate '23000' set message_text = 'play.id_movie: movie not found';
+    end if;
+end //
+create trigger play_movie_update before update on play for each row
+begin
+    if not exists (select 1 from movies where id = new.id_movie) then
+        signal sqlstate '23000' set message_text = 'play.id_movie: movie not found';
+    end if;
+end //
+create trigger movies_delete before delete on movies for each row
+begin
+    if exists (select 1 from play where id_movie = old.id) then
+        signal sqlstate '23000' set message_text = 'movie still referenced by play';
+    end if;
+end //
+create trigger movies_director_insert before insert on movies for each row
+begin
+    if new.id_director is not null and not exists (select 1 from stars where id = new.id_director) then
+        signal sqlstate '23000' set message_text = 'movies.id_director: star not found';
+    end if;
+end //
+create trigger movies_director_update before update on movies for each row
+begin
+    if new.id_director is not null and not exists (select 1 from stars where id = new.id_director) then
+        signal sqlstate '23000' set message_text = 'movies.id_director: star not found';
+    end if;
+end //
+create trigger stars_director_delete before delete on stars for each row
+begin
+    if exists (select 1 from movies where id_director = old.id) then
+        signal sqlstate '23000' set message_text = 'star still director of a movie';
+    end if;
+end //
+delimiter ;
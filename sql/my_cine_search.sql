@@ -0,0 +1,4 @@
+-- fulltext indexes for search.py (mysql backend)
+-- prefix search (word*) needs words of at least innodb_ft_min_token_size (3) chars
+create fulltext index ft_movies_title on movies(title);
+create fulltext index ft_stars_name on stars(name);
@@ -0,0 +1,15 @@
+-- indexes declared in models.py, for databases created before them
+-- (python lifecycle.py migrate applies the same steps from models.py)
+-- (play primary key pk_play(id_movie, id_actor) is already in pg_cine_ddl.sql)
+create index if not exists ix_play_id_actor on play(id_actor);
+create index if not exists ix_movies_id_director on movies(id_director);
+create index if not exists ix_movies_year_id on movies(year, id);
+create index if not exists ix_movies_title_year on movies(title, year);
+create index if not exists ix_stars_name_id on stars(name, id);
+create index if not exists ix_stars_birthdate on stars(birthdate);
+
+-- play created by models.py before pk_play existed: remove duplicates, add the key
+-- delete from play a using play b
+--     where a.ctid < b.ctid and a.id_movie = b.id_movie and a.id_actor = b.id_actor;
+-- alter table play alter id_movie set not null, alter id_actor set not null,
+--     add constraint pk_play primary key (id_movie, id_actor);
@@ -0,0 +1,76 @@
+-- movies partitioned by decade on year (postgresql >= 11), in one transaction
+-- the primary key must contain the partition key: (id, year), so no foreign key
+-- can reference movies(id) any more: those of play and in_franchise become the
+-- triggers at the end (same check on insert / update, restrict on delete)
+-- the indexes of sql/pg_cine_indexes.sql and sql/pg_cine_search.sql, the views
+-- of sql/pg_cine_views.sql and the id sequence are moved to the new table
+begin;
+alter table play drop constraint if exists fk_play_movie;
+alter table if exists in_franchise drop constraint if exists fk_in_franchise_2;
+alter table movies rename to movies_unpartitioned;
+create table movies (like movies_unpartitioned including defaults including constraints)
+    partition by range (year);
+alter table movies add constraint pk_movies_part primary key (id, year);
+create table movies_1910 partition of movies for values from (1910) to (1920);
+create table movies_1920 partition of movies for values from (1920) to (1930);
+create table movies_1930 partition of movies for values from (1930) to (1940);
+create table movies_1940 partition of movies for values from (1940) to (1950);
+create table movies_1950 partition of movies for values from (1950) to (1960);
+create table movies_1960 partition of movies for values from (1960) to (1970);
+create table movies_1970 partition of movies for values from (1970) to (1980);
+create table movies_1980 partition of movies for values from (1980) to (1990);
+create table movies_1990 partition of movies for values from (1990) to (2000);
+create table movies_2000 partition of movies for values from (2000) to (2010);
+create table movies_2010 partition of movies for values from (2010) to (2020);
+create table movies_2020 partition of movies for values from (2020) to (2030);
+create table movies_default partition of movies default;
+insert into movies select * from movies_unpartitioned;
+do $$
+declare
+    decade int;
+begin
+    for decade in 1970..2020 by 10 loop
+        if to_regclass(format('vmovies%s.movies', decade)) is not null then
+            execute format('create or replace view vmovies%1$s.movies as select * from movies where year between %1$s and %2$s', decade, decade + 9);
+        end if;
+    end loop;
+end $$;
+alter sequence if exists movies_id_seq owned by movies.id;
+drop table movies_unpartitioned;
+alter table movies add constraint fk_movies_director foreign key (id_director) references stars (id);
+create index ix_movies_year_id on movies (year, id);
+create index ix_movies_title_year on movies (title, year);
+create index ix_movies_id_director on movies (id_director);
+create extension if not exists pg_trgm;
+create index trgm_movies_title on movies using gin (title gin_trgm_ops);
+create or replace function movie_must_exist() returns trigger language plpgsql as $$
+begin
+    if not exists (select 1 from movies where id = new.id_movie) then
+        raise foreign_key_violation using message = format('movie %s not found (%s.id_movie)', new.id_movie, tg_table_name);
+    end if;
+    return new;
+end $$;
+create or replace function movie_not_referenced() returns trigger language plpgsql as $$
+declare
+    referenced boolean := exists (select 1 from play where id_movie = old.id);
+begin
+    if not referenced and to_regclass('in_franchise') is not null then
+        execute 'select exists (select 1 from in_franchise where id_movie = $1)' into referenced using old.id;
+    end if;
+    if referenced then
+        raise foreign_key_violation using message = format('movie %s still referenced', old.id);
+    end if;
+    return old;
+end $$;
+create trigger play_movie_exists after insert or update of id_movie on play
+    for each row execute procedure movie_must_exist();
+do $$
+begin
+    if to_regclass('in_franchise') is not null then
+        create trigger in_franchise_movie_exists after insert or update of id_movie on in_franchise
+            for each row execute procedure movie_must_exist();
+    end if;
+end $$;
+create trigger movies_not_referenced after delete or update of id on movies
+    for each row execute procedure movie_not_referenced();
+commit;
@@ -0,0 +1,4 @@
+-- trigram indexes for search.py (postgresql backend)
+create extension if not exists pg_trgm;
+create index trgm_movies_title on movies using gin (title gin_trgm_ops);
+create index trgm_stars_name on stars using gin (name gin_trgm_ops);
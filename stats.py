@@ -0,0 +1,124 @@
+"""
+stats.py : aggregate tables behind the stats routes
+
+stat_year, stat_director and stat_actor hold the result of the GROUP BY
+queries of the stats routes. The crud mutations call movies_changed()
+with the years, directors and actors they touched, before their commit,
+so only those aggregate rows are recomputed in the same transaction.
+
+Until a first rebuild has been done the tables are ignored and crud falls
+back to the live GROUP BY queries. Rebuild with:
+    python stats.py rebuild
+"""
+import datetime
+import sys
+from typing import Iterable, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import models
+
+STATS_NAME = "stats"
+
+movies = models.Movie.__table__
+play = models.play_table
+
+
+def _year_source():
+    return select([movies.c.year, func.count(movies.c.id), func.min(movies.c.duration),
+                   func.max(movies.c.duration), func.sum(movies.c.duration), func.count(movies.c.duration)]) \
+            .group_by(movies.c.year), movies.c.year
+
+
+def _director_source():
+    return select([movies.c.id_director, func.count(movies.c.id)]) \
+            .where(movies.c.id_director.isnot(None)) \
+            .group_by(movies.c.id_director), movies.c.id_director
+
+
+def _actor_source():
+    return select([play.c.id_actor, func.count(movies.c.id), func.min(movies.c.year), func.max(movies.c.year)]) \
+            .select_from(play.join(movies, play.c.id_movie == movies.c.id)) \
+            .group_by(play.c.id_actor), play.c.id_actor
+
+
+AGGREGATES = (
+    (models.StatYear.__table__, _year_source),
+    (models.StatDirector.__table__, _director_source),
+    (models.StatActor.__table__, _actor_source),
+)
+
+
+def _refresh(db: Session, table, make_source, keys: Optional[Iterable] = None):
+    """ recompute the aggregate rows of keys (all rows when keys is None) """
+    source, source_key = make_source()
+    key = list(table.primary_key.columns)[0]
+    if keys is None:
+        db.execute(table.delete())
+    else:
+        keys = {k for k in keys if k is not None}
+        if not keys:
+            return
+        db.execute(table.delete().where(key.in_(keys)))
+        source = source.where(source_key.in_(keys))
+    db.execute(table.insert().from_select([column.name for column in table.columns], source))
+
+
+def get_meta(db: Session) -> Optional[models.StatMeta]:
+    return db.query(models.StatMeta).filter(models.StatMeta.name == STATS_NAME).first()
+
+
+def is_built(db: Session) -> bool:
+    meta = get_meta(db)
+    return meta is not None and meta.rebuilt_at is not None
+
+
+def freshness(db: Session) -> dict:
+    meta = get_meta(db)
+    return {
+        "built": meta is not None and meta.rebuilt_at is not None,
+        "rebuilt_at": meta.rebuilt_at if meta is not None else None,
+        "updated_at": meta.updated_at if meta is not None else None,
+    }
+
+
+def _touch(db: Session, rebuilt: bool = False):
+    now = datetime.datetime.utcnow()
+    meta = get_meta(db)
+    if meta is None:
+        meta = models.StatMeta(name=STATS_NAME)
+        db.add(meta)
+    meta.updated_at = now
+    if rebuilt:
+        meta.rebuilt_at = now
+
+
+def movies_changed(db: Session, years: Iterable = (), directors: Iterable = (), actors: Iterable = ()):
+    """ recompute the aggregates of the given keys, pending changes must be flushed """
+    if not is_built(db):
+        return
+    _refresh(db, models.StatYear.__table__, _year_source, years)
+    _refresh(db, models.StatDirector.__table__, _director_source, directors)
+    _refresh(db, models.StatActor.__table__, _actor_source, actors)
+    _touch(db)
+
+
+def rebuild(db: Session):
+    for table, make_source in AGGREGATES:
+        _refresh(db, table, make_source)
+    _touch(db, rebuilt=True)
+    db.commit()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python stats.py rebuild")
+    from database import SessionLocal, get_engine
+    models.Base.metadata.create_all(bind=get_engine())
+    db = SessionLocal()
+    try:
+        rebuild(db)
+        print("stats rebuilt:", freshness(db))
+    finally:
+        db.close()
@@ -0,0 +1,75 @@
+"""
+tests/conftest.py : the api on a throwaway sqlite database
+
+The shipped dataset (sql/cine_data_*.sql) is loaded once by bench.seed into
+a temporary file, DATABASE_URL (and SNAPSHOT_PATH) are set before the app
+modules are imported.
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_DIR = tempfile.mkdtemp(prefix="cine-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(DB_DIR, "cine.db")
+os.environ.setdefault("DATABASE_REPLICA_URLS", "")
+os.environ["SNAPSHOT_PATH"] = os.path.join(DB_DIR, "catalog.snap")
+sys.path.insert(0, ROOT)
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+import bench, cache, main
+from database import SessionLocal, get_engine
+
+
+@pytest.fixture(scope="session")
+def seeded():
+    db = SessionLocal()
+    try:
+        bench.seed(db, sql_dir=os.path.join(ROOT, "sql"))
+    finally:
+        db.close()
+    return get_engine()
+
+
+@pytest.fixture
+def client(seeded):
+    # without the with block: no startup event, so no warm-up thread
+    cache.cache.clear()
+    return TestClient(main.app)
+
+
+class StatementCounter:
+    """ sql statements sent by an engine, from its before_cursor_execute event """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.executed = []
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self.executed.append((statement, parameters))
+
+    @contextmanager
+    def counting(self):
+        self.executed = []
+        event.listen(self.engine, "before_cursor_execute", self._count)
+        try:
+            yield self
+        finally:
+            event.remove(self.engine, "before_cursor_execute", self._count)
+
+    @property
+    def statements(self):
+        return [statement for statement, _ in self.executed]
+
+    @property
+    def count(self) -> int:
+        return len(self.executed)
+
+
+@pytest.fixture
+def sql(seeded):
+    return StatementCounter(seeded)
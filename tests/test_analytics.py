@@ -0,0 +1,22 @@
+"""
+the analytics queries on an empty catalog or without any director answer
+empty, with every column.
+"""
+import pytest
+
+import analytics
+
+if not analytics.available():
+    pytest.skip("numpy not installed", allow_module_level=True)
+
+from analytics import Columns
+
+
+@pytest.mark.parametrize("movies", [[], [(1, 1990, 100, None), (2, 1991, None, None)]])
+def test_no_director(movies):
+    columns = Columns(movies, [])
+    assert columns.by_director() == []
+    groups = columns._grouped_durations(columns.director[:0], columns.duration[:0], columns.year[:0])
+    assert set(groups) == {"key", "count_movies", "min_duration", "max_duration", "mean_duration",
+                           "p50_duration", "p90_duration", "p99_duration", "first_year", "last_year"}
+    assert all(len(column) == 0 for column in groups.values())
@@ -0,0 +1,33 @@
+"""
+async routes (main_async.py) on the asyncio driver: concurrent searches
+while the sqlite index is built don't block the event loop.
+"""
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+import search
+
+pytest.importorskip("aiosqlite")
+
+
+def test_concurrent_search(seeded):
+    import main_async
+    search.reset_index("movies")
+    search.reset_index("stars")
+
+    async def run():
+        async with httpx.AsyncClient(app=main_async.app, base_url="http://test") as client:
+            requests = [client.get(path, params={"q": q}) for path, q in
+                        [("/search/movies", "the"), ("/search/stars", "tom")] * 4]
+            responses.extend(await asyncio.gather(*requests))
+    responses = []
+    # a blocked event loop never times out on its own
+    thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+    thread.start()
+    thread.join(20)
+    assert not thread.is_alive(), "event loop blocked"
+    assert [response.status_code for response in responses] == [200] * 8
+    assert all(response.json() for response in responses)
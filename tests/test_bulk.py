@@ -0,0 +1,47 @@
+"""
+POST /bulk/{table}: optional columns may be left out (an existing row keeps
+them), a row without a required column is a 400, not a 500.
+"""
+import json
+
+from database import SessionLocal
+import models
+
+
+def ndjson(*rows) -> str:
+    return "\n".join(json.dumps(row) for row in rows)
+
+
+def test_optional_column_missing_in_a_row(client):
+    body = ndjson({"id": 990001, "name": "Bulk One", "birthdate": "1950-02-03"},
+                  {"id": 990002, "name": "Bulk Two"})
+    response = client.post("/bulk/stars", data=body)
+    assert response.status_code == 200, response.text
+    assert response.json()["rows"] == 2
+    db = SessionLocal()
+    try:
+        birthdates = dict(db.query(models.Star.id, models.Star.birthdate).filter(models.Star.id.in_([990001, 990002])))
+    finally:
+        db.close()
+    assert str(birthdates[990001]) == "1950-02-03" and birthdates[990002] is None
+
+
+def test_required_column_missing(client):
+    response = client.post("/bulk/movies", data=ndjson({"id": 990001, "title": "No year"}))
+    assert response.status_code == 400
+    assert "year required" in response.json()["detail"]
+
+
+
+def test_upsert_keeps_missing_columns(client):
+    assert client.post("/bulk/stars", data=ndjson({"id": 990003, "name": "Bulk Three", "birthdate": "1960-04-05"})).status_code == 200
+    response = client.post("/bulk/stars", data=ndjson({"id": 990003, "name": "Bulk Three Renamed"},
+                                                      {"id": 990004, "name": "Bulk Four", "birthdate": None}))
+    assert response.status_code == 200, response.text
+    db = SessionLocal()
+    try:
+        rows = {row.id: row for row in db.query(models.Star).filter(models.Star.id.in_([990003, 990004]))}
+    finally:
+        db.close()
+    assert rows[990003].name == "Bulk Three Renamed" and str(rows[990003].birthdate) == "1960-04-05"
+    assert rows[990004].birthdate is None
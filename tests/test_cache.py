@@ -0,0 +1,141 @@
+"""
+response cache: every kind of mutation invalidates what it changed, a load
+racing a write is not stored, the writes of another worker clear the cache.
+Read-your-writes: a client reading after its write doesn't use the cache,
+and what a replica returned is cached for a short time only.
+"""
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+
+import cache, main, versions
+from database import SQLALCHEMY_DATABASE_URL, SessionLocal
+
+
+@pytest.fixture
+def movie_id(seeded):
+    db = SessionLocal()
+    try:
+        return db.execute(text("SELECT min(id) FROM movies")).scalar()
+    finally:
+        db.close()
+
+
+def cached(path: str) -> bool:
+    return cache.cache.get(path + "?") is not None
+
+
+def test_cached_from_primary(client, movie_id):
+    path = "/movies/by_id/{}".format(movie_id)
+    assert client.get(path).status_code == 200
+    assert cached(path)
+
+
+def test_not_cached_after_write(client, sql, movie_id, monkeypatch):
+    monkeypatch.setattr(main, "READ_YOUR_WRITES", 5)
+    path = "/movies/by_id/{}".format(movie_id)
+    client.get(path)
+    client.cookies.set(main.LAST_WRITE_COOKIE, "{:.3f}".format(time.time()))
+    with sql.counting():
+        assert client.get(path).status_code == 200
+    # read on the primary although the entry is there, and not stored
+    assert sql.count > 0
+    cache.cache.clear()
+    client.get(path)
+    assert not cached(path)
+
+
+def test_replica_read_cached_briefly(client, movie_id, monkeypatch):
+    replica = create_engine(SQLALCHEMY_DATABASE_URL)
+    monkeypatch.setattr(main, "ReadSessionLocal", lambda: SessionLocal(bind=replica))
+    path = "/movies/by_id/{}".format(movie_id)
+    try:
+        assert client.get(path).status_code == 200
+        assert cached(path)
+        expires = cache.cache._entries[path + "?"][0]
+        assert expires <= time.monotonic() + cache.CACHE_REPLICA_TTL
+    finally:
+        replica.dispose()
+
+
+@pytest.fixture
+def movie(client):
+    """ a new movie with a director and an actor, its detail cached; (path, movie, star, other star) """
+    star = client.post("/star/", json={"name": "Cache Actor", "birthdate": "1970-01-01"}).json()["id"]
+    other = client.post("/star/", json={"name": "Cache Other", "birthdate": "1971-01-01"}).json()["id"]
+    movie = client.post("/movie/", json={"title": "Cache Movie", "year": 1999, "duration": 90}).json()["id"]
+    assert client.put("/movies/actors/", params={"mid": movie}, json=[star]).status_code == 200
+    assert client.put("/movies/director/", params={"mid": movie, "sid": star}).status_code == 200
+    path = "/movies/by_id/{}".format(movie)
+    assert client.get(path).status_code == 200
+    assert cached(path)
+    return path, movie, star, other
+
+
+def test_cast_edit_invalidates(client, movie):
+    path, movie_id, star, other = movie
+    assert client.post("/movies/actor/", params={"mid": movie_id, "sid": other}).status_code == 200
+    assert not cached(path)
+    assert {actor["id"] for actor in client.get(path).json()["actors"]} == {star, other}
+    assert client.put("/movies/actors/batch", json=[{"mid": movie_id, "sids": [other]}]).status_code == 200
+    assert [actor["id"] for actor in client.get(path).json()["actors"]] == [other]
+
+
+def test_director_change_invalidates(client, movie):
+    path, movie_id, star, other = movie
+    director_path = "/director/by_id_movie/{}".format(movie_id)
+    assert client.get(director_path).json()["id"] == star
+    assert client.put("/movies/director/", params={"mid": movie_id, "sid": other}).status_code == 200
+    assert client.get(path).json()["director"]["id"] == other
+    assert client.get(director_path).json()["id"] == other
+
+
+def test_star_change_invalidates(client, movie):
+    path, movie_id, star, other = movie
+    assert client.put("/star/", json={"id": star, "name": "Cache Renamed", "birthdate": "1970-01-01"}).status_code == 200
+    assert client.get(path).json()["director"]["name"] == "Cache Renamed"
+
+
+def test_delete_invalidates(client, movie):
+    path, movie_id, star, other = movie
+    star_path = "/stars/by_id/{}".format(other)
+    assert client.get(star_path).status_code == 200
+    assert client.delete("/star/{}".format(other)).status_code == 200
+    assert client.get(star_path).status_code == 404
+    assert client.delete("/movie/{}".format(movie_id)).status_code == 200
+    assert client.get(path).status_code == 404
+
+
+def test_load_racing_a_write_not_stored(client, movie):
+    path, movie_id, star, other = movie
+    cache.cache.clear()
+    real = main.crud.get_movie
+
+    def get_movie_then_write(db, movie_id):
+        db_movie = real(db, movie_id=movie_id)
+        # a write committed while the response is built
+        cache.invalidate("movie:{}".format(movie_id))
+        return db_movie
+
+    main.crud.get_movie = get_movie_then_write
+    try:
+        assert client.get(path).status_code == 200
+    finally:
+        main.crud.get_movie = real
+    assert not cached(path)
+
+
+def test_other_worker_write_clears(client, movie, monkeypatch):
+    path, movie_id, star, other = movie
+    monkeypatch.setattr(versions, "INDEX_VERSION_CHECK", 0)
+    client.get(path)
+    db = SessionLocal()
+    try:
+        db.execute(text("UPDATE movies SET title = 'Cache Elsewhere' WHERE id = :id"), {"id": movie_id})
+        # the version row of bump, without the hooks of this process
+        db.execute(versions.table.insert())
+        db.commit()
+    finally:
+        db.close()
+    assert client.get(path).json()["title"] == "Cache Elsewhere"
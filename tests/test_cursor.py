@@ -0,0 +1,48 @@
+"""
+cursors of /movies/ and /stars: values of the wrong type for the sort are a
+400, on the database (main) and on the snapshot (main_snapshot).
+"""
+import pytest
+from fastapi.testclient import TestClient
+
+import main_snapshot, pagination, snapshot
+from database import SessionLocal
+
+
+@pytest.fixture(scope="module")
+def snapshot_client(seeded):
+    db = SessionLocal()
+    try:
+        snapshot.build(db)
+    finally:
+        db.close()
+    return TestClient(main_snapshot.app)
+
+
+BAD_CURSORS = [
+    ("/movies/", "year", ["1990", 12]),
+    ("/movies/", "year", [1990, None]),
+    ("/movies/", "id", [True]),
+    ("/stars", "name", [12, 3]),
+    ("/stars", "id", ["3"]),
+]
+
+
+@pytest.mark.parametrize("path, sort, values", BAD_CURSORS)
+def test_snapshot_bad_cursor(snapshot_client, path, sort, values):
+    response = snapshot_client.get(path, params={"sort": sort, "after": pagination.encode_cursor(sort, values)})
+    assert response.status_code == 400, response.text
+
+
+@pytest.mark.parametrize("path, sort, values", BAD_CURSORS)
+def test_database_bad_cursor(client, path, sort, values):
+    response = client.get(path, params={"sort": sort, "after": pagination.encode_cursor(sort, values)})
+    assert response.status_code == 400, response.text
+
+
+@pytest.mark.parametrize("path, sort", [("/movies/", "year"), ("/stars", "name")])
+def test_snapshot_next_page(snapshot_client, client, path, sort):
+    first = snapshot_client.get(path, params={"sort": sort, "limit": 5})
+    after = first.headers["X-Next-Cursor"]
+    pages = [app.get(path, params={"sort": sort, "limit": 5, "after": after}).json() for app in (snapshot_client, client)]
+    assert pages[0] == pages[1] and len(pages[0]) == 5
@@ -0,0 +1,38 @@
+"""
+cast edits patch the rows of the graph in place: the queries answer as on
+a graph built from the edited casts.
+"""
+from array import array
+
+from graph import Graph
+
+
+def build(casts):
+    return Graph({movie_id: array('i', cast) for movie_id, cast in casts.items()})
+
+
+def answers(graph: Graph, star_ids):
+    return ({star_id: graph.costars(star_id, 10) for star_id in star_ids},
+            {(a, b): graph.path(a, b) for a in star_ids for b in star_ids},
+            sorted(graph.most_connected(100)))
+
+
+def test_cast_edits_in_place():
+    casts = {1: [10, 11], 2: [11, 12], 3: [12, 13]}
+    graph = build(casts)
+    graph.most_connected(10)
+    # a movie losing and gaining actors, a new star, a new movie
+    edits = [(2, [12, 14]), (4, [13, 10]), (1, [])]
+    for movie_id, cast in edits:
+        graph.set_cast(movie_id, cast)
+        casts[movie_id] = cast
+    star_ids = [10, 11, 12, 13, 14]
+    assert answers(graph, star_ids) == answers(build(casts), star_ids)
+    assert graph.path(10, 14) == ([10, 13, 12, 14], [4, 3, 2])
+
+
+def test_remove_star():
+    graph = build({1: [10, 11], 2: [11, 12]})
+    graph.remove_star(11)
+    assert graph.costars(10, 10) == [] and graph.path(10, 12) is None
+    assert graph.costars(11, 10) == []
@@ -0,0 +1,110 @@
+"""
+the lookups of crud are served by the indexes of models.py (EXPLAIN QUERY
+PLAN of the statements they send, sqlite), and lifecycle.migrate brings a
+database created before them up to date.
+"""
+import os
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+import crud, lifecycle, models, pagination, stats
+from database import SessionLocal
+
+
+def plans(sql, run):
+    """ EXPLAIN QUERY PLAN details of the statements sent by run(db), rolled back """
+    db = SessionLocal()
+    try:
+        with sql.counting():
+            run(db)
+        connection = db.connection()
+        return [" | ".join(row[-1] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters))
+                for statement, parameters in sql.executed]
+    finally:
+        db.rollback()
+        db.close()
+
+
+@pytest.mark.parametrize("run, index", [
+    (lambda db: crud.get_movies_by_range_year(db, year_min=1980, year_max=1989), "ix_movies_year_id"),
+    (lambda db: crud.get_movies_by_title_year(db, title="Psycho", year=1960), "ix_movies_title_year"),
+    (lambda db: crud.get_movies(db, limit=10, sort="year"), "ix_movies_year_id"),
+    (lambda db: crud.get_stars(db, limit=10, sort="name"), "ix_stars_name_id"),
+    (lambda db: crud.get_star_by_birthyear(db, year=1950), "ix_stars_birthdate"),
+    (lambda db: crud.filter_movies(db, director_id=1), "ix_movies_id_director"),
+    # movies of an actor: the stat_actor rows recomputed after a cast change
+    (lambda db: stats._refresh(db, models.StatActor.__table__, stats._actor_source, [1]), "ix_play_id_actor"),
+])
+def test_query_uses_index(sql, run, index):
+    details = plans(sql, run)
+    assert any(index in detail for detail in details), details
+
+
+@pytest.mark.parametrize("run, index", [
+    (lambda db: crud.get_movies(db, limit=10, sort="year", after=pagination.encode_cursor("year", [1990, 1])),
+     "ix_movies_year_id"),
+    (lambda db: crud.get_stars(db, limit=10, sort="name", after=pagination.encode_cursor("name", ["M", 1])),
+     "ix_stars_name_id"),
+])
+def test_cursor_seeks_index(sql, run, index):
+    # a SCAN of the index would read every row before the cursor, as OFFSET does
+    details = plans(sql, run)
+    assert any("SEARCH" in detail and index in detail for detail in details), details
+
+
+def test_actors_of_movies_use_play_key(sql):
+    def run(db):
+        movie_ids = [movie_id for movie_id, in db.query(models.play_table.c.id_movie).distinct().limit(3)]
+        crud.get_movies_by_ids(db, ids=movie_ids, detail=True)
+    details = plans(sql, run)
+    # the selectin load of the actors searches play by its primary key (id_movie, id_actor)
+    assert any("INDEX sqlite_autoindex_play_1 (id_movie=?)" in detail for detail in details), details
+
+
+@pytest.fixture
+def old_database(tmp_path):
+    """ schema of sql/my_cine_ddl.sql before the indexes: no key on play, duplicated rows """
+    engine = create_engine("sqlite:///" + os.path.join(tmp_path, "old.db"))
+    with engine.begin() as connection:
+        for statement in (
+                "CREATE TABLE stars (id integer primary key, name varchar(150) not null, birthdate date)",
+                "CREATE TABLE movies (id integer primary key, title varchar(400) not null, year smallint not null,"
+                " duration smallint, id_director integer references stars(id))",
+                "CREATE TABLE play (id_actor integer references stars(id), id_movie integer references movies(id))",
+                "INSERT INTO stars VALUES (1, 'A', NULL), (2, 'B', NULL)",
+                "INSERT INTO movies VALUES (1, 'M', 2000, 90, 1)",
+                "INSERT INTO play VALUES (1, 1), (1, 1), (2, 1), (NULL, 1)"):
+            connection.execute(text(statement))
+    return engine
+
+
+def test_migrate_old_database(old_database):
+    assert lifecycle.pending_migrations(old_database) == ["play_primary_key", "indexes"]
+    done = lifecycle.migrate(old_database)
+    assert "play_primary_key" in done and "indexes" in done and "table catalog_versions" in done
+    inspector = inspect(old_database)
+    assert inspector.get_pk_constraint("play")["constrained_columns"] == ["id_movie", "id_actor"]
+    for table in models.Base.metadata.sorted_tables:
+        assert {index.name for index in table.indexes} <= {index["name"] for index in inspector.get_indexes(table.name)}
+    with old_database.connect() as connection:
+        assert sorted(connection.execute(text("SELECT id_movie, id_actor FROM play"))) == [(1, 1), (1, 2)]
+    assert lifecycle.pending_migrations(old_database) == []
+    assert lifecycle.migrate(old_database) == []
+
+
+def test_migrate_after_failed_step(old_database):
+    """ the copy of a step stopped before the rename, then the old play of one stopped after it """
+    with old_database.begin() as connection:
+        connection.execute(text("CREATE TABLE {} (id_movie integer, id_actor integer)".format(lifecycle.PLAY_COPY)))
+        connection.execute(text("INSERT INTO {} VALUES (1, 1)".format(lifecycle.PLAY_COPY)))
+    assert "play_primary_key" in lifecycle.migrate(old_database)
+    with old_database.begin() as connection:
+        connection.execute(text("CREATE TABLE {} (id_movie integer, id_actor integer)".format(lifecycle.PLAY_REPLACED)))
+    assert lifecycle.pending_migrations(old_database) == ["play_primary_key"]
+    assert lifecycle.migrate(old_database) == ["play_primary_key"]
+    tables = inspect(old_database).get_table_names()
+    assert lifecycle.PLAY_COPY not in tables and lifecycle.PLAY_REPLACED not in tables
+    with old_database.begin() as connection:
+        lifecycle._add_play_key(connection)
+        assert sorted(connection.execute(text("SELECT id_movie, id_actor FROM play"))) == [(1, 1), (1, 2)]
@@ -0,0 +1,69 @@
+"""
+Server-Timing of a request: rows from cursor.rowcount (sqlite reports none
+for selects) and serialization measured in the request handler of the route,
+fastapi itself untouched.
+"""
+import re
+
+import pytest
+from sqlalchemy import event
+
+
+def server_timing(response) -> dict:
+    return {name: (float(duration), desc) for name, duration, desc in
+            re.findall(r'(\w+);dur=([\d.]+)(?:;desc="([^"]*)")?', response.headers["server-timing"])}
+
+
+@pytest.fixture
+def rowcounts(seeded):
+    counts = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        counts.append(max(cursor.rowcount or 0, 0))
+    event.listen(seeded, "after_cursor_execute", record)
+    yield counts
+    event.remove(seeded, "after_cursor_execute", record)
+
+
+@pytest.mark.parametrize("method, path, body", [
+    ("get", "/movies/?limit=7", None), ("get", "/stars?limit=3", None),
+    ("post", "/star/", {"name": "Metrics Star"})])
+def test_rows(client, rowcounts, method, path, body):
+    response = client.request(method, path, json=body)
+    assert response.status_code == 200
+    assert server_timing(response)["db"][1] == "{} queries, {} rows".format(len(rowcounts), sum(rowcounts))
+
+
+def test_write_rows(client, rowcounts):
+    response = client.post("/star/", json={"name": "Metrics Star"})
+    assert int(server_timing(response)["db"][1].split()[2]) >= 1
+
+
+def test_serialize_time(client):
+    from fastapi import routing
+    assert routing.serialize_response.__module__ == "fastapi.routing"
+    response = client.get("/movies/", params={"limit": 50})
+    assert len(response.json()) == 50
+    timing = server_timing(response)
+    assert timing["serialize"][0] > 0
+    assert timing["serialize"][0] + timing["app"][0] <= timing["total"][0]
+
+
+def test_pool_metrics_by_engine(tmp_path):
+    from sqlalchemy import create_engine
+    from database import TimedQueuePool, pool_metrics
+    import metrics
+    primary, replica = (create_engine("sqlite:///{}".format(tmp_path / name), poolclass=TimedQueuePool,
+                                      connect_args={"check_same_thread": False}) for name in ("p.db", "r.db"))
+    for _ in range(2):
+        primary.connect().close()
+    primary.dispose()
+    primary.connect().close()
+    assert pool_metrics(primary)["checkouts"] == 3 and pool_metrics(replica)["checkouts"] == 0
+    text = metrics.pool_exposition({"primary": pool_metrics(primary), "replica0": pool_metrics(replica)})
+    assert 'db_pool_checkouts_total{pool="primary"} 3' in text
+    assert 'db_pool_checkouts_total{pool="replica0"} 0' in text
+
+
+def test_metrics_pools(client):
+    assert 'db_pool_checkouts_total{pool="primary"}' in client.get("/metrics").text
+    assert "replicas" in client.get("/db/pool").json()
@@ -0,0 +1,17 @@
+"""
+GET /movies/search: skip and limit out of range are a 422, not a 500 or a
+silently clamped page.
+"""
+import pytest
+
+
+@pytest.mark.parametrize("params", [{"limit": 0}, {"limit": -1}, {"limit": 1001}, {"skip": -1}])
+def test_out_of_range(client, params):
+    response = client.get("/movies/search", params=params)
+    assert response.status_code == 422, response.text
+
+
+def test_limit_bounds(client):
+    assert len(client.get("/movies/search", params={"limit": 1}).json()) == 1
+    response = client.get("/movies/search", params={"limit": 1000, "skip": 0})
+    assert response.status_code == 200 and len(response.json()) == 1000
@@ -0,0 +1,71 @@
+"""
+SQL statements per request: the routes loading relationships must not issue
+one query per movie (N+1), whatever the number of rows they return.
+"""
+import pytest
+from sqlalchemy import func
+
+import cache, models, versions
+from database import SessionLocal
+
+
+@pytest.fixture(scope="module")
+def sample(seeded):
+    """ movies with a director and a cast, a title part matching several of them """
+    db = SessionLocal()
+    try:
+        movies = db.query(models.Movie.id) \
+                .filter(models.Movie.id_director.isnot(None), models.Movie.actors.any()) \
+                .order_by(models.Movie.id) \
+                .limit(20) \
+                .all()
+        part = "The"
+        count = db.query(func.count(models.Movie.id)) \
+                .filter(models.Movie.title.like("%{}%".format(part)), models.Movie.actors.any()) \
+                .scalar()
+        return {"ids": [movie_id for movie_id, in movies], "part": part, "matches": count}
+    finally:
+        db.close()
+
+
+def budget_routes(sample):
+    """ (method, url, json body, max statements) """
+    ids = sample["ids"]
+    return [
+        ("GET", "/movies/by_id/{}".format(ids[0]), None, 2),
+        ("GET", "/director/by_id_movie/{}".format(ids[0]), None, 1),
+        ("GET", "/actor/by_movie_title?movieTitle={}".format(sample["part"]), None, 2),
+        ("POST", "/movies/by_ids", ids, 1),
+        ("POST", "/movies/by_ids/detail", ids, 2),
+        ("POST", "/stars/by_ids", ids, 1),
+    ]
+
+
+@pytest.mark.parametrize("position", range(6))
+def test_statement_budget(client, sql, sample, position, monkeypatch):
+    method, url, body, budget = budget_routes(sample)[position]
+    # the catalog version check of the cache (once a second) is not the route's
+    monkeypatch.setattr(versions, "INDEX_VERSION_CHECK", 3600)
+    cache.check_catalog()
+    with sql.counting():
+        response = client.request(method, url, json=body)
+    assert response.status_code == 200, response.text
+    assert sql.count <= budget, "{} {}: {} statements (budget {})\n{}".format(
+        method, url, sql.count, budget, "\n".join(sql.statements))
+
+
+def test_actors_by_title_independent_of_matches(client, sql, sample):
+    assert sample["matches"] > 2
+    with sql.counting():
+        response = client.get("/actor/by_movie_title", params={"movieTitle": sample["part"]})
+    assert len(response.json()) == sample["matches"]
+    assert sql.count <= 2
+
+
+def test_cached_movie_detail_needs_no_query(client, sql, sample):
+    url = "/movies/by_id/{}".format(sample["ids"][1])
+    first = client.get(url)
+    with sql.counting():
+        second = client.get(url)
+    assert second.json() == first.json()
+    assert sql.count == 0
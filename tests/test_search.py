@@ -0,0 +1,53 @@
+"""
+search on sqlite (in-process trigram index): every word of the query is the
+prefix of a word of the result. The sql of postgresql and mysql applies the
+same rule (compiled only, no server here).
+"""
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import mysql, postgresql
+
+import models, search
+
+
+@pytest.mark.parametrize("kind, q", [("stars", "ton"), ("stars", "son"), ("stars", "ell"),
+                                     ("stars", "tom hea"), ("movies", "the"), ("movies", "ter")])
+def test_words_are_prefixes(client, kind, q):
+    field = "name" if kind == "stars" else "title"
+    response = client.get("/search/{}".format(kind), params={"q": q, "limit": 100})
+    assert response.status_code == 200
+    for row in response.json():
+        assert all(any(word.startswith(term) for word in search.words(row[field])) for term in search.words(q)), row
+
+
+def test_inner_match_is_not_a_prefix():
+    index = search.NgramIndex()
+    index.add(1, "Tom Heaton")
+    index.add(2, "Tony Curtis")
+    index.add(3, "Fred Sorenson")
+    assert [doc_id for doc_id, _ in index.search("ton", 10)] == [2]
+    assert [doc_id for doc_id, _ in index.search("son", 10)] == []
+    assert index.search("tony", 10, prefix=False)[0][0] == 2
+    assert index.search("ton", 10, prefix=False) == []
+
+
+def compiled(dialect, name: str, query: str, prefix: bool):
+    """ (sql, bound values) """
+    filters, order_by = search.sql_search(name, "stars", query, prefix)
+    statement = select([models.Star.id]).where(*filters).order_by(*order_by).compile(dialect=dialect)
+    return str(statement), set(statement.params.values())
+
+
+def test_postgresql_sql():
+    sql, values = compiled(postgresql.dialect(), "postgresql", "Alfred hitch", True)
+    # :q <% name: the query is similar to a part of the name, not the other way round
+    assert "stars.name %%> %(name_1)s" in sql and "word_similarity(" in sql
+    assert "~*" in sql and {"Alfred hitch", r"\malfred", r"\mhitch"} <= values
+    sql, values = compiled(postgresql.dialect(), "postgresql", "Alfred hitch", False)
+    assert "stars.name %%>> %(name_1)s" in sql and "strict_word_similarity(" in sql
+    assert {r"\malfred\M", r"\mhitch\M"} <= values
+
+
+def test_mysql_sql():
+    sql, values = compiled(mysql.dialect(), "mysql", "Alfred hitch", True)
+    assert "REGEXP" in sql and {"+alfred* +hitch*", r"\balfred", r"\bhitch"} <= values
@@ -0,0 +1,35 @@
+"""
+concurrent snapshot builds each write a temporary file of their own: the
+installed snapshot is always one whole build, no temporary file is left.
+"""
+import os
+import threading
+
+import snapshot
+from database import SessionLocal
+
+
+def test_concurrent_builds(seeded, tmp_path):
+    db = SessionLocal()
+    try:
+        sections = snapshot.build_sections(db)
+    finally:
+        db.close()
+    path = str(tmp_path / "catalog.snap")
+    start = threading.Barrier(4)
+
+    def build():
+        start.wait()
+        snapshot.write(path, sections)
+
+    threads = [threading.Thread(target=build) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert os.listdir(str(tmp_path)) == ["catalog.snap"]
+    reference = str(tmp_path / "reference.snap")
+    snapshot.write(reference, sections)
+    with open(path, "rb") as built, open(reference, "rb") as alone:
+        assert built.read() == alone.read()
+    assert snapshot.Snapshot(path).meta["movies"] == len(sections["movie_id"])
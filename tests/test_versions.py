@@ -0,0 +1,98 @@
+"""
+the in-memory copies of the catalog follow the writes of another worker
+(catalog version) and not only those of their own crud hooks.
+"""
+import pytest
+from sqlalchemy import text
+
+import analytics, graph, search, versions
+from database import SessionLocal
+
+
+@pytest.fixture
+def db(seeded, monkeypatch):
+    # check the version on every read
+    monkeypatch.setattr(versions, "INDEX_VERSION_CHECK", 0)
+    db = SessionLocal()
+    yield db
+    db.close()
+
+
+def other_worker(*statements):
+    """ a write that the crud hooks of this process don't see """
+    other = SessionLocal()
+    try:
+        for statement in statements:
+            other.execute(text(statement))
+        # the version row of bump, without moving the copies of this process
+        other.execute(versions.table.insert())
+        other.commit()
+    finally:
+        other.close()
+
+
+def test_search_sees_other_worker(db):
+    assert search.search(db, "stars", "Zyxwv") == []
+    other_worker("INSERT INTO stars (id, name) VALUES (991001, 'Zyxwv Other')")
+    assert [star.id for star in search.search(db, "stars", "Zyxwv")] == [991001]
+
+
+def test_own_write_keeps_index(client, db):
+    index = search.get_index(db, "stars")
+    response = client.post("/star/", json={"name": "Qwxyz Own", "birthdate": "1970-01-01"})
+    assert response.status_code == 200, response.text
+    db.rollback()
+    assert [star.name for star in search.search(db, "stars", "Qwxyz")] == ["Qwxyz Own"]
+    assert search.get_index(db, "stars") is index
+
+
+def test_graph_sees_other_worker(db):
+    movie_id, = db.execute(text("SELECT min(id) FROM movies")).first()
+    db.rollback()
+    graph.get_graph(db)
+    other_worker("INSERT INTO stars (id, name) VALUES (991002, 'Graph Other')",
+                 "INSERT INTO play (id_movie, id_actor) VALUES ({}, 991002)".format(movie_id))
+    assert 991002 in graph.get_graph(db).star_index
+
+
+def test_max_age(db, monkeypatch):
+    built = graph.get_graph(db)
+    monkeypatch.setattr(versions, "INDEX_MAX_AGE", 1e-9)
+    assert graph.get_graph(db) is not built
+
+
+def test_analytics_sees_other_worker(db):
+    if not analytics.available():
+        pytest.skip("numpy not installed")
+    before = {row["year"]: row["count_movies"] for row in analytics.query(db, "by_year", year_min=1901, year_max=1901)}
+    other_worker("INSERT INTO movies (id, title, year) VALUES (991003, 'Analytics Other', 1901)")
+    after = {row["year"]: row["count_movies"] for row in analytics.query(db, "by_year", year_min=1901, year_max=1901)}
+    assert after[1901] == before.get(1901, 0) + 1
+
+
+def test_own_bump_in_flight(db, monkeypatch):
+    """ a reader between the insert of a version by this worker and the move of its copies """
+    tracker = versions.Tracker()
+    try:
+        tracker.load(db)
+        db.rollback()
+        monkeypatch.setattr(versions, "_bumping", 1)
+        other_worker()
+        assert not tracker.stale(db)
+        monkeypatch.setattr(versions, "_bumping", 0)
+        assert tracker.stale(db)
+    finally:
+        versions._trackers.remove(tracker)
+
+
+def test_bumps_out_of_order():
+    tracker = versions.Tracker()
+    tracker.version = 5
+    try:
+        tracker.applied(7)
+        tracker.applied(8)
+        assert tracker.version == 5
+        tracker.applied(6)
+        assert tracker.version == 8 and not tracker.ahead
+    finally:
+        versions._trackers.remove(tracker)
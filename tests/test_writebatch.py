@@ -0,0 +1,119 @@
+"""
+group commit on a sqlite database of its own: writes submitted together from
+several threads, some conflicting or failing, are committed in one group.
+"""
+import threading
+from functools import partial
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, event, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+import crud, models, versions
+from writebatch import WriteBatcher
+
+items = Table("items", MetaData(), Column("id", Integer, primary_key=True), Column("name", String(20), unique=True))
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    # the bumps of these groups are not versions of the catalog of the other tests
+    monkeypatch.setattr(versions, "_trackers", [])
+    engine = create_engine("sqlite:///{}".format(tmp_path / "batch.db"), connect_args={"check_same_thread": False})
+    items.create(engine)
+    versions.table.create(engine)
+    yield engine
+    engine.dispose()
+
+
+def names(engine):
+    with engine.connect() as connection:
+        return sorted(connection.execute(select([items.c.name])).scalars())
+
+
+def run_together(batcher, fns):
+    """ submit every fn from a thread of its own at once: result or exception of each """
+    outcomes = [None] * len(fns)
+    barrier = threading.Barrier(len(fns))
+    def submit(i):
+        barrier.wait()
+        try:
+            outcomes[i] = batcher.submit(fns[i])
+        except Exception as e:
+            outcomes[i] = e
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(fns))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return outcomes
+
+
+def insert(name, hooks=None, fail=False):
+    def fn(db):
+        db.execute(items.insert().values(name=name))
+        crud._commit(db)
+        crud._after_commit(db, partial(hooks.append, name))
+        if fail:
+            raise ValueError(name)
+        return name
+    return fn
+
+
+def batcher(engine, size, **session_kwargs):
+    factory = sessionmaker(bind=engine, autoflush=False)
+    return WriteBatcher(lambda **kwargs: factory(**kwargs, **session_kwargs), size=size, window=5)
+
+
+def test_savepoints(engine):
+    hooks = []
+    writes = batcher(engine, 5)
+    with engine.connect() as connection:
+        before = versions.current(connection)
+    outcomes = run_together(writes, [insert("a", hooks), insert("b", hooks), insert("a", hooks),
+                                     insert("c", hooks, fail=True), insert("d", hooks)])
+    # the duplicate and the failing write are rolled back alone, the others committed
+    assert sorted(o for o in outcomes if isinstance(o, str)) == ["a", "b", "d"]
+    assert sum(isinstance(o, IntegrityError) for o in outcomes) == 1
+    assert [str(o) for o in outcomes if isinstance(o, ValueError)] == ["c"]
+    assert names(engine) == ["a", "b", "d"]
+    # hooks of the committed writes only, one version for the group
+    assert sorted(hooks) == ["a", "b", "d"]
+    with engine.connect() as connection:
+        assert versions.current(connection) == before + 1
+    assert writes.stats.as_dict()["batches"] == 1 and writes.stats.errors == 2
+
+
+def test_hooks_after_commit(engine):
+    seen = []
+    def hook():
+        # the group is committed: visible from another connection
+        seen.append(names(engine))
+    def fn(db):
+        db.execute(items.insert().values(name="e"))
+        crud._after_commit(db, hook)
+        assert seen == []
+    outcomes = run_together(batcher(engine, 2), [fn, insert("f", [])])
+    assert outcomes[0] is None and outcomes[1] == "f"
+    assert seen == [["e", "f"]]
+
+
+def test_failed_commit(engine):
+    hooks = []
+    writes = batcher(engine, 3)
+    def fail_commit(session):
+        raise RuntimeError("commit failed")
+    factory = writes.session_factory
+    def failing_session(**kwargs):
+        session = factory(**kwargs)
+        event.listen(session, "before_commit", fail_commit)
+        return session
+    writes.session_factory = failing_session
+    outcomes = run_together(writes, [insert("g", hooks), insert("h", hooks), insert("i", hooks, fail=True)])
+    # every caller gets the error of the commit, but the one that failed before
+    assert [str(o) for o in outcomes] == ["commit failed", "commit failed", "i"]
+    assert names(engine) == [] and hooks == []
+    with engine.connect() as connection:
+        assert versions.current(connection) == 0
+    assert writes.stats.failed_commits == 1
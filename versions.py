@@ -0,0 +1,142 @@
+"""
+versions.py : catalog version, keeps the in-memory copies of the workers fresh
+
+search (sqlite), graph and analytics keep in-memory copies of the catalog
+that the crud hooks update, in the worker that wrote only. After the commit
+of every crud write (and its hooks) or bulk load, bump inserts a row in
+catalog_versions in a short transaction of its own: the version is the
+highest row, no row is updated, so the writers don't wait for each other
+(the autoincrement of the table, a sequence on postgresql, is not
+transactional). Each copy records the version it was loaded at and the
+versions of the writes of its own worker (bump). Before serving, a copy is
+reloaded when:
+    - the database has a version that isn't one of its worker's: another
+      worker or process wrote, checked at most every INDEX_VERSION_CHECK
+      seconds (1)
+    - it was loaded more than INDEX_MAX_AGE seconds ago (3600, 0 never),
+      for the writes that bypass crud and bulk (sql scripts)
+A version is only taken after the commit of its write: a copy loaded at a
+version has the rows of every write up to it. A replica lagging behind
+shows an older version, not a reason to reload.
+"""
+import os
+import threading
+import time
+from typing import List, Optional, Set
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import models
+
+# versions applied ahead of a missing one kept per copy, beyond it reloads
+MAX_AHEAD = 1000
+# catalog_versions keeps the last PRUNE_EVERY rows or so
+PRUNE_EVERY = 1000
+INDEX_VERSION_CHECK = float(os.environ.get("INDEX_VERSION_CHECK", "1"))
+INDEX_MAX_AGE = float(os.environ.get("INDEX_MAX_AGE", "3600"))
+
+table = models.CatalogVersion.__table__
+
+
+def current(db: Session) -> int:
+    """ version of the catalog in db, 0 before the first write """
+    return db.execute(select([func.max(table.c.version)])).scalar() or 0
+
+
+_trackers: List["Tracker"] = []
+# bumps of this worker between their insert and the move of the copies
+_bumping = 0
+_lock = threading.Lock()
+
+
+def bump(db: Session) -> int:
+    """ after the commit of a write whose changes are applied to the copies of this
+        worker: the new version, committed, that these copies move to
+    """
+    global _bumping
+    with _lock:
+        _bumping += 1
+    version = None
+    try:
+        # a connection of its own: the orm objects of db are not expired again
+        with db.get_bind().begin() as connection:
+            version = connection.execute(table.insert()).inserted_primary_key[0]
+            if version % PRUNE_EVERY == 0:
+                connection.execute(table.delete().where(table.c.version <= version - PRUNE_EVERY))
+        return version
+    finally:
+        with _lock:
+            _bumping -= 1
+            if version is not None:
+                for tracker in _trackers:
+                    tracker.applied(version)
+
+
+class Tracker:
+    """ version and load time of one in-memory copy """
+
+    def __init__(self):
+        self.version: Optional[int] = None
+        # versions of this worker applied before the one following self.version
+        # (bumps of concurrent writes end in any order), and set when too many
+        self.ahead: Set[int] = set()
+        self.outdated = False
+        self.loaded_at = 0.0
+        self.checked_at = 0.0
+        with _lock:
+            _trackers.append(self)
+
+    def load(self, db: Session):
+        """ called before the copy reads its rows: they are at least this version """
+        version = current(db)
+        with _lock:
+            self.version = version
+            self.ahead.clear()
+            self.outdated = False
+            self.loaded_at = self.checked_at = time.monotonic()
+
+    def reset(self):
+        with _lock:
+            self.version = None
+            self.ahead.clear()
+
+    def applied(self, version: int):
+        """ a write of this worker is applied to the copy, under _lock """
+        if self.version is None or version <= self.version:
+            return
+        if version == self.version + 1:
+            self.version = version
+            while self.version + 1 in self.ahead:
+                self.version += 1
+                self.ahead.discard(self.version)
+        else:
+            self.ahead.add(version)
+            if len(self.ahead) > MAX_AHEAD:
+                # a write of another worker is missing: nothing will fill the gap
+                self.ahead.clear()
+                self.outdated = True
+
+    def stale(self, db: Session) -> bool:
+        """ the copy must be reloaded before serving """
+        now = time.monotonic()
+        with _lock:
+            if self.version is None:
+                return False
+            if self.outdated or INDEX_MAX_AGE and now - self.loaded_at > INDEX_MAX_AGE:
+                return True
+            if now - self.checked_at < INDEX_VERSION_CHECK:
+                return False
+            self.checked_at = now
+        newer = current(db)
+        with _lock:
+            if self.version is None or newer <= self.version:
+                return False
+            if newer - self.version > MAX_AHEAD:
+                return True
+            missing = sum(version not in self.ahead for version in range(self.version + 1, newer + 1))
+            if missing <= _bumping:
+                # may be the bumps of this worker not applied yet: check again next time
+                self.checked_at = 0.0
+                return False
+            return True
@@ -0,0 +1,195 @@
+"""
+writebatch.py : group commit of the write routes
+
+With WRITE_BATCH=1 the mutation routes of main.py don't commit on their
+own: they queue their write and wait. One flusher thread takes the queued
+writes, up to WRITE_BATCH_SIZE (100) or what arrived within
+WRITE_BATCH_WINDOW_MS (5) of the first one, and runs them in one
+transaction, each inside a savepoint: a write that raises is rolled back
+alone and its caller gets the exception, the others are committed together
+(one commit, one fsync). If the commit itself fails, every write of the
+group gets that error.
+
+crud mutations call crud._commit / crud._after_commit: in a batch session
+the commit is a flush and the search, graph, analytics and cache updates
+are deferred until the group is committed, followed by one bump of the
+catalog version for the group (versions.py).
+
+stats (GET /writes/stats): writes, batches, errors, batch size, flush
+latency percentiles (from the first write queued to the commit) and
+throughput.
+"""
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import versions
+from database import SessionLocal
+
+WRITE_BATCH = os.environ.get("WRITE_BATCH", "0") == "1"
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "100"))
+WRITE_BATCH_WINDOW_MS = float(os.environ.get("WRITE_BATCH_WINDOW_MS", "5"))
+
+AFTER_COMMIT = "after_commit"
+LATENCY_SAMPLES = 1000
+
+logger = logging.getLogger("uvicorn")
+
+
+def in_batch(db: Session) -> bool:
+    return AFTER_COMMIT in db.info
+
+
+class BatchStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.errors = 0
+        self.batches = 0
+        self.failed_commits = 0
+        self.max_batch = 0
+        self.flush_time = 0.0
+        self.started = None
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def observe(self, size: int, errors: int, committed: bool, flush_time: float, latency: float):
+        with self._lock:
+            if self.started is None:
+                self.started = time.monotonic() - latency
+            self.writes += size
+            self.errors += errors
+            self.batches += 1
+            self.failed_commits += not committed
+            self.max_batch = max(self.max_batch, size)
+            self.flush_time += flush_time
+            self._latencies.append(latency)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            elapsed = time.monotonic() - self.started if self.started is not None else 0
+            percentile = lambda p: round(latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000, 3) \
+                if latencies else None
+            return {
+                "enabled": WRITE_BATCH,
+                "writes": self.writes,
+                "errors": self.errors,
+                "batches": self.batches,
+                "failed_commits": self.failed_commits,
+                "mean_batch": round(self.writes / self.batches, 2) if self.batches else 0,
+                "max_batch": self.max_batch,
+                "flush_time_total": round(self.flush_time, 6),
+                "flush_latency_ms": {"p50": percentile(50), "p95": percentile(95), "p99": percentile(99)},
+                "writes_per_second": round(self.writes / elapsed, 2) if elapsed else 0,
+            }
+
+
+class _Write:
+    __slots__ = ("fn", "queued", "done", "result", "error")
+
+    def __init__(self, fn: Callable[[Session], Any]):
+        self.fn = fn
+        self.queued = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WriteBatcher:
+
+    def __init__(self, session_factory: Callable[..., Session], size: int = WRITE_BATCH_SIZE,
+                 window: float = WRITE_BATCH_WINDOW_MS / 1000):
+        self.session_factory = session_factory
+        self.size = size
+        self.window = window
+        self.stats = BatchStats()
+        self._queue: "queue.Queue[_Write]" = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[[Session], Any]):
+        """ fn(session) committed with the writes queued around it, its result or exception;
+            fn must not keep orm objects: they are detached once the group is committed
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-batch", daemon=True)
+                self._thread.start()
+        write = _Write(fn)
+        self._queue.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _run(self):
+        while True:
+            writes = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(writes) < self.size:
+                try:
+                    writes.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.flush(writes)
+            except Exception as e:
+                # never leave the callers waiting
+                logger.exception("write batch: flush failed")
+                for write in writes:
+                    write.result, write.error = None, write.error or e
+                    write.done.set()
+
+    def flush(self, writes: List[_Write]):
+        start = time.perf_counter()
+        hooks: List[Callable[[], Any]] = []
+        committed = False
+        db = self.session_factory(expire_on_commit=False)
+        db.info[AFTER_COMMIT] = hooks
+        try:
+            if db.get_bind().dialect.name == "sqlite":
+                # pysqlite opens its transaction on the first dml only: without it the
+                # first SAVEPOINT would start one and its RELEASE would commit it
+                db.execute(text("BEGIN"))
+            for write in writes:
+                deferred = len(hooks)
+                try:
+                    with db.begin_nested():
+                        write.result = write.fn(db)
+                except Exception as e:
+                    del hooks[deferred:]
+                    write.result, write.error = None, e
+            db.commit()
+            committed = True
+        except Exception as e:
+            db.rollback()
+            for write in writes:
+                write.result, write.error = None, write.error or e
+        finally:
+            db.close()
+        if committed:
+            for hook in hooks:
+                try:
+                    hook()
+                except Exception:
+                    logger.exception("write batch: after commit hook failed")
+            if any(write.error is None for write in writes):
+                try:
+                    versions.bump(db)
+                except Exception:
+                    logger.exception("write batch: catalog version bump failed")
+        self.stats.observe(len(writes), sum(write.error is not None for write in writes), committed,
+                           time.perf_counter() - start, time.monotonic() - writes[0].queued)
+        for write in writes:
+            write.done.set()
+
+
+writes = WriteBatcher(SessionLocal)